@@ -0,0 +1,374 @@
+# anomaly_core.py
+"""
+Streamlit-free anomaly detection: per-country Isolation Forests (parallel and
+incremental), the batched robust scorer and the scorer registry.
+anomaly_detector.py wraps these for the dashboard; cli.py uses them directly.
+"""
+import os
+import time
+import hashlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import pandas as pd
+import numpy as np
+
+import datastore
+from profiling import timed
+
+def _available_cpus() -> int:
+    # Respect container CPU pinning where the platform exposes it
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+# Default worker count for the global scan, capped so one scan does not take every CPU of a
+# shared server; 1 keeps everything in-process
+MAX_DEFAULT_WORKERS = 4
+ANOMALY_WORKERS = int(os.getenv("ANOMALY_WORKERS", str(min(_available_cpus(), MAX_DEFAULT_WORKERS))))
+# Pool workers are started fresh rather than forked: the scan runs inside the threaded
+# Streamlit server (and from jobs.py threads), and a forked child can inherit locks held
+# by other threads and deadlock
+ANOMALY_START_METHOD = os.getenv("ANOMALY_START_METHOD", "forkserver")
+
+def _pool_context():
+    # forkserver where the platform has it (Linux, macOS), spawn elsewhere
+    method = ANOMALY_START_METHOD
+    if method not in multiprocessing.get_all_start_methods():
+        method = "spawn"
+    return multiprocessing.get_context(method)
+
+# Feature columns of each fitted model, in the order they were fitted
+MODEL_FEATURES = {"measles": ["measles"], "rubella": ["rubella"], "joint": ["measles", "rubella"]}
+
+@timed("anomaly_fit")
+def _fit_country(country_data: pd.DataFrame, contamination: float = 0.1):
+    """
+    Fit the Isolation Forests for one country's rows (already filtered).
+    Returns (augmented dataframe with anomaly flags and scores, fitted models),
+    or (None, None) if there are fewer than 3 years.
+    """
+    # scikit-learn takes seconds to import; only the Isolation Forest engine needs it
+    from sklearn.ensemble import IsolationForest
+    country_data = country_data.sort_values("year").copy()
+
+    if len(country_data) < 3:
+        return None, None
+
+    # Prepare features for each disease separately
+    measles_features = country_data[["measles"]].values if "measles" in country_data else None
+    rubella_features = country_data[["rubella"]].values if "rubella" in country_data else None
+
+    # Joint features (both diseases)
+    joint_features = country_data[["measles", "rubella"]].dropna().values if {"measles","rubella"}.issubset(country_data.columns) else None
+
+    result = country_data.copy()
+    models = {}
+
+    # Measles anomalies
+    if measles_features is not None and len(measles_features) >= 3:
+        iso_m = IsolationForest(contamination=contamination, random_state=42)
+        result["measles_anomaly"] = iso_m.fit_predict(measles_features)
+        result["measles_anomaly_score"] = iso_m.score_samples(measles_features)
+        models["measles"] = iso_m
+
+    # Rubella anomalies
+    if rubella_features is not None and len(rubella_features) >= 3:
+        iso_r = IsolationForest(contamination=contamination, random_state=42)
+        result["rubella_anomaly"] = iso_r.fit_predict(rubella_features)
+        result["rubella_anomaly_score"] = iso_r.score_samples(rubella_features)
+        models["rubella"] = iso_r
+
+    # Joint anomalies
+    if joint_features is not None and len(joint_features) >= 3:
+        iso_j = IsolationForest(contamination=contamination, random_state=42, n_estimators=100)
+        result["joint_anomaly"] = iso_j.fit_predict(joint_features)
+        result["joint_anomaly_score"] = iso_j.score_samples(joint_features)
+        models["joint"] = iso_j
+
+    return result, models
+
+def _score_country(country_data: pd.DataFrame, contamination: float = 0.1):
+    # Fit and score one country; None if there are fewer than 3 years
+    return _fit_country(country_data, contamination)[0]
+
+def _apply_models(rows: pd.DataFrame, models: dict) -> pd.DataFrame:
+    # Score rows with already-fitted forests (no refit), filling the same columns
+    result = rows.sort_values("year").copy()
+    for name, model in models.items():
+        features = result[MODEL_FEATURES[name]]
+        if name == "joint":
+            features = features.dropna()
+        if features.empty:
+            continue
+        # Created with the full-scan dtypes first; .loc writes into missing columns would make floats
+        if f"{name}_anomaly" not in result:
+            result[f"{name}_anomaly"] = np.ones(len(result), dtype="int64")
+            result[f"{name}_anomaly_score"] = np.full(len(result), np.nan)
+        result.loc[features.index, f"{name}_anomaly"] = model.predict(features.values).astype("int64")
+        result.loc[features.index, f"{name}_anomaly_score"] = model.score_samples(features.values)
+    return result
+
+def _history_digest(rows: pd.DataFrame) -> str:
+    # Content fingerprint of a country's rows, used to detect changed history
+    return hashlib.sha1(pd.util.hash_pandas_object(rows, index=False).to_numpy().tobytes()).hexdigest()
+
+def _state_entry(rows: pd.DataFrame, result, models) -> dict:
+    return {"n_rows": len(rows), "last_year": rows["year"].max(), "digest": _history_digest(rows),
+            "models": models, "result": result}
+
+def _extend_entry(rows: pd.DataFrame, entry: dict):
+    """
+    Reuse a country's saved state when its earlier history is unchanged and only
+    later years were appended: the new rows are scored with the saved forests.
+    Returns the updated entry, or None when the country has to be refitted.
+    """
+    if entry is None:
+        return None
+    rows = rows.sort_values("year")
+    n = entry["n_rows"]
+    if len(rows) < n or _history_digest(rows.iloc[:n]) != entry["digest"]:
+        return None
+    new_rows = rows.iloc[n:]
+    if new_rows.empty:
+        return entry
+    if entry["models"] is None or not (new_rows["year"] > entry["last_year"]).all():
+        return None
+    result = pd.concat([entry["result"], _apply_models(new_rows, entry["models"])])
+    # concat turns categoricals with different categories into object; a full scan keeps the frame's dtypes
+    result = result.astype({c: rows[c].dtype for c in rows.columns if c in result.columns})
+    return _state_entry(rows, result, entry["models"])
+
+def load_anomaly_state(name: str = "anomaly_state") -> dict:
+    # Saved per-country forests and results from the last incremental scan ({} if none)
+    state = datastore.load_object(name)
+    return state if isinstance(state, dict) else {}
+
+def save_anomaly_state(state: dict, name: str = "anomaly_state") -> bool:
+    return datastore.save_object(name, state)
+
+def _score_batch(batch, contamination: float, keep_models: bool = False):
+    # Worker entry point: score a list of (country, rows) pairs
+    out = []
+    for country, rows in batch:
+        result, models = _fit_country(rows, contamination)
+        out.append((country, result, models if keep_models else None))
+    return out
+
+@timed("anomaly_score:isolation_forest")
+def score_isolation_forest(df_wide: pd.DataFrame, contamination: float = 0.1) -> pd.DataFrame:
+    """
+    Reference engine: three Isolation Forests per country (see _score_country).
+    Countries with fewer than 3 years are dropped.
+    """
+    results = [_score_country(rows, contamination) for _, rows in df_wide.groupby("country", sort=False, observed=True)]
+    results = [r for r in results if r is not None]
+    return pd.concat(results) if results else pd.DataFrame()
+
+def _robust_z(values: pd.Series, key: np.ndarray) -> pd.Series:
+    # |x - median| / scaled MAD per series; falls back to mean absolute deviation when MAD is 0
+    med = values.groupby(key).transform("median")
+    dev = (values - med).abs()
+    scale = 1.4826 * dev.groupby(key).transform("median")
+    scale = scale.where(scale > 0, 1.2533 * dev.groupby(key).transform("mean"))
+    return (dev / scale.where(scale > 0)).where(scale > 0, 0.0).where(values.notna())
+
+def _flag_lowest(score: pd.Series, key: np.ndarray, contamination: float) -> np.ndarray:
+    # Same rule as IsolationForest.predict: -1 below the per-series contamination percentile
+    threshold = score.groupby(key).quantile(contamination).reindex(key).to_numpy()
+    return np.where(score.to_numpy() < threshold, -1, 1)
+
+@timed("anomaly_score:robust")
+def score_robust(df_wide: pd.DataFrame, contamination: float = 0.1) -> pd.DataFrame:
+    """
+    Batched engine: scores every country at once with robust z-scores (median/MAD)
+    on the case level and on the log year-over-year change, taking the larger of
+    the two. Scores are the negated z (lower = more anomalous, as with
+    IsolationForest.score_samples); flags use the same contamination percentile rule.
+    Countries with fewer than 3 years are dropped.
+    """
+    codes = pd.factorize(df_wide["country"])[0]
+    order = np.lexsort((df_wide["year"].to_numpy(dtype="float64", na_value=np.nan), codes))
+    df = df_wide.iloc[order]
+    key = codes[order]
+    keep = np.bincount(key, minlength=key.max() + 1)[key] >= 3 if len(key) else np.zeros(0, dtype=bool)
+    df, key = df[keep].copy(), key[keep]
+
+    scores = {}
+    for disease in ["measles", "rubella"]:
+        if disease not in df:
+            continue
+        x = df[disease].astype("float64")
+        log_x = np.log1p(x.clip(lower=0))
+        log_yoy = log_x - log_x.groupby(key).shift(1)
+        score = -np.fmax(_robust_z(x, key), _robust_z(log_yoy, key))
+        df[f"{disease}_anomaly"] = _flag_lowest(score, key, contamination)
+        df[f"{disease}_anomaly_score"] = score
+        scores[disease] = score
+
+    if len(scores) == 2:
+        joint = np.fmin(scores["measles"], scores["rubella"]).where(scores["measles"].notna() & scores["rubella"].notna())
+        df["joint_anomaly"] = np.where(joint.notna(), _flag_lowest(joint, key, contamination), np.nan)
+        df["joint_anomaly_score"] = joint
+    return df
+
+# Pluggable scorers: each takes (df_wide, contamination) and returns the wide rows
+# with *_anomaly (-1 anomaly / 1 normal) and *_anomaly_score columns added
+SCORERS = {
+    "isolation_forest": score_isolation_forest,
+    "robust": score_robust,
+}
+DEFAULT_ENGINE = os.getenv("ANOMALY_ENGINE", "isolation_forest")
+
+def compare_scorers(df_wide: pd.DataFrame, contamination: float = 0.1, engines=("isolation_forest", "robust")) -> dict:
+    """
+    Run two engines on the same data and report wall time and flag agreement
+    (share of rows with the same -1/1 label) per disease column.
+    """
+    timings, results = {}, {}
+    for engine in engines:
+        start = time.perf_counter()
+        results[engine] = SCORERS[engine](df_wide, contamination)
+        timings[engine] = time.perf_counter() - start
+    a, b = (results[e].sort_index() for e in engines)
+    agreement = {}
+    for col in ["measles_anomaly", "rubella_anomaly", "joint_anomaly"]:
+        if col in a and col in b:
+            both = a[col].notna() & b[col].notna()
+            agreement[col] = float((a.loc[both, col] == b.loc[both, col]).mean())
+    return {"seconds": timings, "agreement": agreement}
+
+def build_country_store(df_wide: pd.DataFrame) -> dict:
+    """
+    Partition the wide frame once into {country: rows sorted by year},
+    so per-country lookups do not scan the whole dataset.
+    """
+    return {country: rows.sort_values("year") for country, rows in df_wide.groupby("country", sort=False, observed=True)}
+
+def _state_countries(state: dict, contamination: float) -> dict:
+    # Per-country entries of an incremental state; reset when contamination changes
+    if state.get("contamination") != contamination:
+        state.clear()
+        state.update(contamination=contamination, countries={})
+    return state["countries"]
+
+def detect_anomalies_for_country(df_wide: pd.DataFrame, country: str, contamination: float = 0.1, state: dict = None):
+    """
+    Detect anomalies using Isolation Forest for a single country.
+    Returns augmented dataframe with anomaly flags and scores, or None.
+    With `state` (see scan_anomalies), only newly appended years are scored.
+    """
+    rows = df_wide[df_wide["country"] == country]
+    if state is None:
+        result = _score_country(rows, contamination)
+    else:
+        entries = _state_countries(state, contamination)
+        entry = _extend_entry(rows, entries.get(country))
+        if entry is None:
+            entry = _state_entry(rows.sort_values("year"), *_fit_country(rows, contamination))
+        entries[country] = entry
+        result = entry["result"]
+    return result
+
+@timed("anomaly_scan")
+def scan_anomalies(df_wide: pd.DataFrame, contamination: float = 0.1, n_jobs: int = None, store: dict = None,
+                   engine: str = DEFAULT_ENGINE, state: dict = None, progress=None, on_result=None):
+    """
+    Run anomaly detection across all countries and return aggregated results.
+    With the isolation_forest engine, countries are spread over `n_jobs` worker
+    processes (default ANOMALY_WORKERS, started with ANOMALY_START_METHOD); results are concatenated in country
+    order, so they do not depend on n_jobs. Batched engines score everything in one call.
+    Pass a build_country_store() result as `store` to skip re-partitioning.
+
+    Incremental mode: pass a `state` dict (e.g. from load_anomaly_state) and it is
+    updated in place with each country's fitted forests and results. On the next
+    call, countries whose earlier years are unchanged only have their appended
+    years scored; the rest are refitted.
+
+    `progress` is an optional callable receiving the completed fraction, and
+    `on_result` one receiving (country, result or None if skipped) as each
+    country finishes, e.g. to show partial results. An exception raised by
+    either stops the scan; batches not yet started in the pool are dropped.
+    Returns (combined results, countries skipped for having fewer than 3 years).
+    """
+    report = progress or (lambda fraction: None)
+    emit = on_result or (lambda country, result: None)
+    if engine != "isolation_forest":
+        combined = SCORERS[engine](df_wide, contamination).reset_index(drop=True)
+        scored = set(combined["country"]) if not combined.empty else set()
+        skipped = [c for c in pd.unique(df_wide["country"]) if c not in scored]
+        if on_result is not None:
+            for country, rows in (combined.groupby("country", sort=False, observed=True) if scored else []):
+                emit(country, rows)
+            for country in skipped:
+                emit(country, None)
+        report(1.0)
+        return combined, skipped
+
+    n_jobs = max(1, n_jobs or ANOMALY_WORKERS)
+    if store is None:
+        store = build_country_store(df_wide)
+    groups = list(store.items())
+    if not groups:
+        return pd.DataFrame(), []
+
+    results = {}
+    to_fit = groups
+    entries = None
+    if state is not None:
+        entries = _state_countries(state, contamination)
+        for country in [c for c in entries if c not in store]:
+            del entries[country]
+        to_fit = []
+        for country, rows in groups:
+            entry = _extend_entry(rows, entries.get(country))
+            if entry is None:
+                to_fit.append((country, rows))
+            else:
+                entries[country] = entry
+                results[country] = entry["result"]
+                emit(country, entry["result"])
+
+    def collect(country, result, models):
+        results[country] = result
+        if entries is not None:
+            entries[country] = _state_entry(store[country].sort_values("year"), result, models)
+        emit(country, result)
+
+    report(len(results) / len(groups))
+    if n_jobs == 1 or len(to_fit) <= 1:
+        for country, rows in to_fit:
+            collect(country, *_fit_country(rows, contamination))
+            report(len(results) / len(groups))
+    else:
+        # A few batches per worker keeps the pool busy without per-country IPC overhead
+        size = max(1, len(to_fit) // (n_jobs * 4))
+        batches = [to_fit[i:i + size] for i in range(0, len(to_fit), size)]
+        with ProcessPoolExecutor(max_workers=n_jobs, mp_context=_pool_context()) as pool:
+            futures = [pool.submit(_score_batch, batch, contamination, entries is not None) for batch in batches]
+            try:
+                for future in as_completed(futures):
+                    for country, result, models in future.result():
+                        collect(country, result, models)
+                    report(len(results) / len(groups))
+            except BaseException:
+                pool.shutdown(cancel_futures=True)
+                raise
+
+    skipped = [country for country, _ in groups if results[country] is None]
+    all_anomalies = [results[country] for country, _ in groups if results[country] is not None]
+    if not all_anomalies:
+        return pd.DataFrame(), skipped
+    return pd.concat(all_anomalies, ignore_index=True), skipped
+
+def top_anomalies(results: pd.DataFrame, n: int = 20) -> pd.DataFrame:
+    """
+    The `n` most anomalous flagged country-years of a scan: rows flagged -1 by any
+    model, ranked by their lowest score (lower = more anomalous, for every engine).
+    """
+    flags = [c for c in ["measles_anomaly", "rubella_anomaly", "joint_anomaly"] if c in results]
+    if results.empty or not flags:
+        return pd.DataFrame()
+    flagged = results[(results[flags] == -1).any(axis=1)].copy()
+    flagged["score"] = flagged[[f"{c}_score" for c in flags]].min(axis=1)
+    cols = [c for c in ["country", "region", "year", "measles", "rubella", "score"] if c in flagged]
+    return flagged.sort_values("score")[cols].head(int(n)).reset_index(drop=True)
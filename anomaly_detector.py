@@ -1,69 +1,88 @@
 # anomaly_detector.py
 import pandas as pd
-import numpy as np
-from sklearn.ensemble import IsolationForest
 import streamlit as st
 
+from apputil import MAX_CACHED_DATASETS
+# Scoring lives in anomaly_core.py (no Streamlit); re-exported here for the app
+from anomaly_core import (
+    ANOMALY_WORKERS, SCORERS, DEFAULT_ENGINE, build_country_store, compare_scorers,
+    score_isolation_forest, score_robust, scan_anomalies, load_anomaly_state, save_anomaly_state, top_anomalies,
+)
+import anomaly_core
+import jobs
+import registry
+
+@st.cache_resource(max_entries=MAX_CACHED_DATASETS)
+def load_country_store(data_id: str, _df_wide: pd.DataFrame) -> dict:
+    # One shared per-country partition per dataset
+    return build_country_store(_df_wide)
+
+# The per-country partitions hold an evicted dataset's rows; drop them with it
+registry.on_evict(lambda evicted: load_country_store.clear())
+
 @st.cache_data(show_spinner=True)
-def detect_anomalies_for_country(df_wide: pd.DataFrame, country: str, contamination: float = 0.1):
+def detect_anomalies(data_id: str, country: str, _df_wide: pd.DataFrame, contamination: float = 0.1,
+                     engine: str = DEFAULT_ENGINE):
+    """
+    Detect anomalies for one country of a loaded dataset with the chosen engine.
+    The cache key is (data_id, country, contamination, engine); the frame itself
+    is never hashed and is only used to build the per-country store on first use.
+    """
+    rows = load_country_store(data_id, _df_wide).get(country)
+    result = None if rows is None else SCORERS[engine](rows, contamination)
+    if result is not None and result.empty:
+        result = None
+    if result is None:
+        st.warning(f"Not enough data for {country} (need at least 3 years)")
+    return result
+
+def detect_anomalies_for_country(df_wide: pd.DataFrame, country: str, contamination: float = 0.1, state: dict = None):
     """
     Detect anomalies using Isolation Forest for a single country.
     Returns augmented dataframe with anomaly flags and scores.
+    Uncached; the app goes through detect_anomalies() instead.
+    With `state` (see get_global_anomalies), only newly appended years are scored.
     """
-    # Filter country data
-    country_data = df_wide[df_wide["country"] == country].sort_values("year").copy()
-    
-    if len(country_data) < 3:
+    result = anomaly_core.detect_anomalies_for_country(df_wide, country, contamination, state)
+    if result is None:
         st.warning(f"Not enough data for {country} (need at least 3 years)")
-        return None
-    
-    # Prepare features for each disease separately
-    measles_features = country_data[["measles"]].values if "measles" in country_data else None
-    rubella_features = country_data[["rubella"]].values if "rubella" in country_data else None
-    
-    # Joint features (both diseases)
-    joint_features = country_data[["measles", "rubella"]].dropna().values if {"measles","rubella"}.issubset(country_data.columns) else None
-    
-    result = country_data.copy()
-    
-    # Measles anomalies
-    if measles_features is not None and len(measles_features) >= 3:
-        iso_m = IsolationForest(contamination=contamination, random_state=42)
-        result["measles_anomaly"] = iso_m.fit_predict(measles_features)
-        result["measles_anomaly_score"] = iso_m.score_samples(measles_features)
-    
-    # Rubella anomalies
-    if rubella_features is not None and len(rubella_features) >= 3:
-        iso_r = IsolationForest(contamination=contamination, random_state=42)
-        result["rubella_anomaly"] = iso_r.fit_predict(rubella_features)
-        result["rubella_anomaly_score"] = iso_r.score_samples(rubella_features)
-    
-    # Joint anomalies
-    if joint_features is not None and len(joint_features) >= 3:
-        iso_j = IsolationForest(contamination=contamination, random_state=42, n_estimators=100)
-        result["joint_anomaly"] = iso_j.fit_predict(joint_features)
-        result["joint_anomaly_score"] = iso_j.score_samples(joint_features)
-    
     return result
 
-def get_global_anomalies(df_wide: pd.DataFrame, top_n: int = 20, contamination: float = 0.1):
+def get_global_anomalies(df_wide: pd.DataFrame, top_n: int = 20, contamination: float = 0.1, n_jobs: int = None,
+                         store: dict = None, engine: str = DEFAULT_ENGINE, state: dict = None):
     """
-    Run anomaly detection across all countries and return aggregated results.
+    Run anomaly detection across all countries and return aggregated results,
+    driving a Streamlit progress bar. See anomaly_core.scan_anomalies for the
+    worker pool, engines and incremental `state`.
     """
-    all_anomalies = []
-    countries = df_wide["country"].unique()
-    
     progress_bar = st.progress(0)
-    for idx, country in enumerate(countries):
-        country_result = detect_anomalies_for_country(df_wide, country, contamination)
-        if country_result is not None:
-            all_anomalies.append(country_result)
-        progress_bar.progress((idx + 1) / len(countries))
-    
+    combined, skipped = scan_anomalies(df_wide, contamination, n_jobs=n_jobs, store=store, engine=engine,
+                                       state=state, progress=progress_bar.progress)
     progress_bar.empty()
-    
-    if not all_anomalies:
-        return pd.DataFrame()
-    
-    combined = pd.concat(all_anomalies, ignore_index=True)
+    if skipped:
+        st.warning(f"Skipped {len(skipped)} countries with fewer than 3 years of data")
     return combined
+
+def global_scan_key(data_id: str, contamination: float, engine: str = DEFAULT_ENGINE) -> tuple:
+    # Background job key; identical scans from any session share one job
+    return ("anomaly_scan", data_id, round(float(contamination), 4), engine)
+
+def submit_global_scan(data_id: str, df_wide: pd.DataFrame, contamination: float = 0.1,
+                       engine: str = DEFAULT_ENGINE, n_jobs: int = None) -> tuple:
+    """
+    Start the world-wide scan of a loaded dataset as a background job (see jobs.py)
+    and return its key for jobs.poll()/jobs.cancel(). The job streams a
+    (country, result or None) item per country as its partial results and
+    returns scan_anomalies' (combined results, skipped countries).
+    """
+    key = global_scan_key(data_id, contamination, engine)
+    store = load_country_store(data_id, df_wide)
+    jobs.submit(key, lambda progress, partial: scan_anomalies(
+        df_wide, contamination, n_jobs=n_jobs, store=store, engine=engine, progress=progress,
+        on_result=lambda country, result: partial((country, result))))
+    return key
+
+def partial_scan_results(snapshot: dict) -> pd.DataFrame:
+    # Combined per-country results a scan job has streamed so far
+    frames = [result for _, result in snapshot["partial"] if result is not None]
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
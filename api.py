@@ -0,0 +1,408 @@
+# api.py
+"""
+Read-only HTTP/JSON API over the dashboard aggregates (no Streamlit).
+
+    python api.py Measles_Rubella_Final.xlsx --port 8502
+    python api.py Measles_Rubella_Final.xlsx --load-test --clients 32 --requests 200
+
+Endpoints (GET, JSON):
+  /datasets            datasets served, with their diseases, regions and years
+  /trend               yearly totals; ?by=region for the regional trends
+  /rankings            countries by total cases; ?top=N (default 10)
+  /country/<name>      one country's yearly series with rolling means and YoY
+  /anomalies           most anomalous flagged country-years; ?top=N, ?country=<name>
+                       for every scored year of one country, ?contamination=, ?engine=
+                       (default ANOMALY_ENGINE, as in the app)
+
+Filters match apply_filters: disease (Measles, Rubella, Both or a per-100k
+metric; default Measles), region (repeated or comma-separated; default all)
+and year_min/year_max (default the dataset's span). dataset=<id prefix> picks
+one of the served datasets (default the first).
+
+Datasets are loaded through the process-wide registry, and their aggregation
+cube and anomaly scans are built once. Responses are memoized by (dataset,
+endpoint, normalized parameters). A dataset never changes under its content
+hash, so the ETag comes from that key and If-None-Match is answered with 304
+before any work. Bodies of GZIP_MIN_BYTES or more are gzipped for clients
+that accept it. The server is threaded HTTP/1.1 with keep-alive.
+"""
+import argparse
+import gzip
+import hashlib
+import http.client
+import json
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote, unquote, urlsplit
+
+import numpy as np
+import pandas as pd
+
+import core
+import registry
+
+# How many encoded responses stay memoized (least recently used is evicted first)
+MAX_CACHED_RESPONSES = int(os.getenv("API_MAX_CACHED_RESPONSES", "512"))
+GZIP_MIN_BYTES = int(os.getenv("API_GZIP_MIN_BYTES", "1024"))
+# Idle keep-alive connections are closed after this many seconds
+KEEPALIVE_SECONDS = int(os.getenv("API_KEEPALIVE_SECONDS", "30"))
+ACCESS_LOG = os.getenv("API_ACCESS_LOG", "0") == "1"
+
+_lock = threading.Lock()
+_served = []                    # data_ids, default first
+_contexts = OrderedDict()       # data_id -> frames, cube and filter domains
+_scans = OrderedDict()          # (data_id, contamination, engine) -> anomaly scan results
+_responses = OrderedDict()      # request key -> (etag, body, gzipped body or None)
+_loading = {}                   # memo key -> lock held while it is being built
+
+class ApiError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+def _memo(store: OrderedDict, key, build, limit: int = None):
+    # Build store[key] once; concurrent requests for the same key wait for that build
+    with _lock:
+        if key in store:
+            store.move_to_end(key)
+            return store[key]
+        key_lock = _loading.setdefault(key, threading.Lock())
+    with key_lock:
+        with _lock:
+            if key in store:
+                return store[key]
+        try:
+            value = build()
+        except BaseException:
+            with _lock:
+                _loading.pop(key, None)
+            raise
+        # Stored before the key lock is dropped, so a request arriving now finds the value
+        with _lock:
+            store[key] = value
+            _loading.pop(key, None)
+            while limit is not None and len(store) > limit:
+                store.popitem(last=False)
+        return value
+
+def _context(data_id: str) -> dict:
+    def build():
+        base_wide, base_long = registry.get(data_id, lambda: _missing(data_id))
+        years = base_long["year"].dropna()
+        return {
+            "wide": base_wide,
+            "cube": core.build_cube(base_long),
+            "diseases": sorted(set(base_long["disease"].unique()) | {"Both"}),
+            "regions": sorted(base_long["region"].dropna().unique().tolist()),
+            "years": (int(years.min()), int(years.max())) if len(years) else (0, 0),
+        }
+    return _memo(_contexts, data_id, build, limit=registry.MAX_DATASETS)
+
+def _missing(data_id: str):
+    # Served datasets are pinned by preload(); one registered by other means may have been evicted
+    raise ApiError(410, f"dataset {data_id[:12]} is no longer loaded")
+
+def _records(df: pd.DataFrame) -> list:
+    # JSON-ready rows: NaN becomes null, numpy scalars become Python numbers
+    df = df.astype(object).where(df.notna(), None)
+    return df.to_dict("records")
+
+def _json_default(obj):
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, pd.Timestamp):
+        return obj.isoformat()
+    raise TypeError(f"{type(obj).__name__} is not JSON serializable")
+
+def _param(query: dict, name: str, default=None):
+    values = query.get(name)
+    return values[-1] if values else default
+
+def _int(query: dict, name: str, default: int, minimum: int = None) -> int:
+    try:
+        value = int(_param(query, name, default))
+    except ValueError:
+        raise ApiError(400, f"{name} must be an integer")
+    if minimum is not None and value < minimum:
+        raise ApiError(400, f"{name} must be at least {minimum}")
+    return value
+
+def _filters(ctx: dict, query: dict) -> dict:
+    """Normalized apply_filters arguments of a request; invalid values raise ApiError(400)."""
+    disease = _param(query, "disease", "Measles")
+    if disease not in ctx["diseases"]:
+        raise ApiError(400, f"disease must be one of {', '.join(ctx['diseases'])}")
+    regions = sorted({r for v in query.get("region", []) for r in v.split(",") if r})
+    year_range = (_int(query, "year_min", ctx["years"][0]), _int(query, "year_max", ctx["years"][1]))
+    return {"disease": disease, "regions": regions, "year_range": year_range}
+
+def _resolve_dataset(query: dict) -> str:
+    prefix = _param(query, "dataset", "")
+    matches = [d for d in _served if d.startswith(prefix)]
+    if not matches:
+        raise ApiError(404, f"unknown dataset {prefix!r}")
+    return matches[0]
+
+def _trend(ctx, f, query):
+    by = ["region", "year"] if _param(query, "by") == "region" else ["year"]
+    df = core.cube_query(ctx["cube"], by, f["disease"], f["regions"], f["year_range"]).sort_values(by)
+    return {"by": by, "rows": _records(df)}
+
+def _rankings(ctx, f, query):
+    df = core.cube_query(ctx["cube"], ["country"], f["disease"], f["regions"], f["year_range"])[["country", "value"]]
+    top = _int(query, "top", 10, minimum=1)
+    return {"countries": len(df), "rows": _records(df.sort_values("value", ascending=False).head(top))}
+
+def _country(ctx, f, query, name: str):
+    df = core.cube_query(ctx["cube"], ["year"], f["disease"], f["regions"], f["year_range"], countries=[name])
+    if df.empty:
+        raise ApiError(404, f"no data for {name!r} with these filters")
+    df = df.sort_values("year").drop(columns="count")
+    df["yoy"] = df["value"].pct_change()
+    return {"country": name, "rows": _records(df)}
+
+def _anomalies(ctx, f, query, data_id: str):
+    import anomaly_core
+    try:
+        contamination = float(_param(query, "contamination", "0.1"))
+    except ValueError:
+        contamination = float("nan")
+    # The range Isolation Forest accepts; NaN fails the comparison too
+    if not 0 < contamination <= 0.5:
+        raise ApiError(400, "contamination must be a number in (0, 0.5]")
+    engine = _param(query, "engine", anomaly_core.DEFAULT_ENGINE)
+    if engine not in anomaly_core.SCORERS:
+        raise ApiError(400, f"engine must be one of {', '.join(anomaly_core.SCORERS)}")
+    results = _memo(_scans, (data_id, contamination, engine),
+                    lambda: anomaly_core.scan_anomalies(ctx["wide"], contamination, engine=engine)[0],
+                    limit=registry.MAX_DATASETS)
+    if results.empty:
+        return {"rows": []}
+    lo, hi = f["year_range"]
+    keep = results["year"].between(lo, hi)
+    if f["regions"]:
+        keep &= results["region"].isin(f["regions"])
+    country = _param(query, "country")
+    if country is not None:
+        return {"country": country, "rows": _records(results[keep & (results["country"] == country)])}
+    return {"rows": _records(anomaly_core.top_anomalies(results[keep], _int(query, "top", 20, minimum=1)))}
+
+def _datasets():
+    out = []
+    for data_id in _served:
+        ctx = _context(data_id)
+        out.append({"dataset": data_id, "diseases": ctx["diseases"], "regions": ctx["regions"],
+                    "years": list(ctx["years"])})
+    return {"datasets": out}
+
+def _encode(payload: dict, etag: str):
+    body = json.dumps(payload, separators=(",", ":"), default=_json_default).encode()
+    return etag, body, gzip.compress(body, 6) if len(body) >= GZIP_MIN_BYTES else None
+
+def respond(path: str, query: dict):
+    """
+    (etag, body, gzipped body or None) for one request, built on the first
+    request with that key. Raises ApiError for bad requests.
+    """
+    parts = [unquote(p) for p in path.strip("/").split("/") if p]
+    if parts == ["datasets"]:
+        key = ["datasets", _served]
+        build = _datasets
+    else:
+        data_id = _resolve_dataset(query)
+        ctx = _context(data_id)
+        f = _filters(ctx, query)
+        extra = {k: v[-1] for k, v in sorted(query.items()) if k not in {"dataset", "disease", "region",
+                                                                         "year_min", "year_max"}}
+        key = [data_id, parts, f["disease"], f["regions"], list(f["year_range"]), extra]
+        if parts == ["trend"]:
+            build = lambda: _trend(ctx, f, query)
+        elif parts == ["rankings"]:
+            build = lambda: _rankings(ctx, f, query)
+        elif len(parts) == 2 and parts[0] == "country":
+            build = lambda: _country(ctx, f, query, parts[1])
+        elif parts == ["anomalies"]:
+            build = lambda: _anomalies(ctx, f, query, data_id)
+        else:
+            raise ApiError(404, f"unknown endpoint /{'/'.join(parts)}")
+    key = json.dumps(key, default=str)
+    etag = 'W/"' + hashlib.sha1(key.encode()).hexdigest()[:20] + '"'
+    return etag, lambda: _memo(_responses, key, lambda: _encode(build(), etag), limit=MAX_CACHED_RESPONSES)
+
+def _etag_matches(header: str, etag: str) -> bool:
+    if not header:
+        return False
+    tags = [t.strip() for t in header.split(",")]
+    return "*" in tags or any(t.removeprefix("W/") == etag.removeprefix("W/") for t in tags)
+
+def _accepts_gzip(header: str) -> bool:
+    # Accept-Encoding codings with their q-values; an explicit gzip entry wins over "*"
+    weights = {}
+    for item in (header or "").split(","):
+        coding, *params = [p.strip() for p in item.split(";")]
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if coding:
+            weights[coding.lower()] = q
+    q = weights.get("gzip", weights.get("x-gzip", weights.get("*", 0.0)))
+    return q > 0
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "MeaslesAPI/1.0"
+    timeout = KEEPALIVE_SECONDS
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        try:
+            etag, load = respond(url.path, parse_qs(url.query))
+            if _etag_matches(self.headers.get("If-None-Match"), etag):
+                self._send(304, etag=etag)
+                return
+            _, body, gz = load()
+        except ApiError as e:
+            self._send(e.status, json.dumps({"error": str(e)}).encode())
+            return
+        except Exception as e:
+            self._send(500, json.dumps({"error": f"{type(e).__name__}: {e}"}).encode())
+            return
+        if gz is not None and _accepts_gzip(self.headers.get("Accept-Encoding")):
+            self._send(200, gz, etag=etag, gzipped=True)
+        else:
+            self._send(200, body, etag=etag)
+
+    def _send(self, status: int, body: bytes = b"", etag: str = None, gzipped: bool = False):
+        self.send_response(status)
+        if etag:
+            self.send_header("ETag", etag)
+            self.send_header("Cache-Control", "no-cache")
+            self.send_header("Vary", "Accept-Encoding")
+        if status != 304:
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            if gzipped:
+                self.send_header("Content-Encoding", "gzip")
+        self.end_headers()
+        if status != 304:
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if ACCESS_LOG:
+            super().log_message(format, *args)
+
+class Server(ThreadingHTTPServer):
+    # One thread per keep-alive connection; a deep backlog for bursts of readers
+    daemon_threads = True
+    request_queue_size = 128
+
+def serve(data_ids, host: str = "127.0.0.1", port: int = 8502) -> Server:
+    """
+    Serve already-registered datasets (the first is the default). Returns the
+    bound server; call serve_forever() on it (port 0 picks a free port).
+    """
+    _served[:] = list(data_ids)
+    return Server((host, port), Handler)
+
+def load_test(host: str, port: int, paths, clients: int = 16, requests: int = 100) -> dict:
+    """
+    `clients` threads, each on one keep-alive connection, cycle through `paths`
+    for `requests` requests, revalidating with If-None-Match once they hold an ETag.
+    Returns request count, seconds, requests/s, status counts and latency percentiles.
+    """
+    latencies, statuses, errors = [], {}, []
+    record = threading.Lock()
+
+    def client(n: int):
+        conn = http.client.HTTPConnection(host, port, timeout=60)
+        etags = {}
+        try:
+            for i in range(requests):
+                path = paths[(n + i) % len(paths)]
+                headers = {"Accept-Encoding": "gzip"}
+                if path in etags:
+                    headers["If-None-Match"] = etags[path]
+                start = time.perf_counter()
+                conn.request("GET", path, headers=headers)
+                resp = conn.getresponse()
+                resp.read()
+                elapsed = time.perf_counter() - start
+                if resp.getheader("ETag"):
+                    etags[path] = resp.getheader("ETag")
+                with record:
+                    latencies.append(elapsed)
+                    statuses[resp.status] = statuses.get(resp.status, 0) + 1
+        except Exception as e:
+            with record:
+                errors.append(repr(e))
+        finally:
+            conn.close()
+
+    threads = [threading.Thread(target=client, args=(n,)) for n in range(clients)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    seconds = time.perf_counter() - start
+    ms = np.array(latencies) * 1000
+    return {
+        "requests": len(latencies), "seconds": round(seconds, 3),
+        "requests_per_s": round(len(latencies) / seconds, 1) if seconds else None,
+        "statuses": statuses, "errors": errors,
+        "p50_ms": round(float(np.percentile(ms, 50)), 2) if len(ms) else None,
+        "p95_ms": round(float(np.percentile(ms, 95)), 2) if len(ms) else None,
+    }
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Serve the dashboard aggregates as a read-only JSON API.")
+    parser.add_argument("workbooks", nargs="*", help="Workbooks to serve (default: DEFAULT_DATASET)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8502)
+    parser.add_argument("--load-test", action="store_true",
+                        help="Start on a free port, run a local load test against it and exit")
+    parser.add_argument("--clients", type=int, default=16, help="Concurrent connections for --load-test")
+    parser.add_argument("--requests", type=int, default=100, help="Requests per connection for --load-test")
+    args = parser.parse_args(argv)
+
+    paths = args.workbooks or ([registry.DEFAULT_DATASET] if registry.DEFAULT_DATASET else [])
+    if not paths:
+        parser.error("no workbook given and DEFAULT_DATASET is not set")
+    data_ids = [registry.preload(path) for path in paths]
+
+    if not args.load_test:
+        server = serve(data_ids, args.host, args.port)
+        print(f"serving {len(data_ids)} dataset(s) on http://{args.host}:{server.server_address[1]}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+        return 0
+
+    server = serve(data_ids, "127.0.0.1", 0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    ctx = _context(data_ids[0])
+    top = core.cube_query(ctx["cube"], ["country"], "Measles", [], ctx["years"]).nlargest(5, "value")["country"]
+    paths = ["/trend", "/trend?by=region", "/rankings?top=20", "/trend?disease=Both&year_min=2018",
+             "/anomalies"] + [f"/country/{quote(str(c))}" for c in top]
+    try:
+        result = load_test("127.0.0.1", server.server_address[1], paths, args.clients, args.requests)
+    finally:
+        server.shutdown()
+        server.server_close()
+    print(json.dumps(result, indent=2))
+    return 1 if result["errors"] or any(s >= 500 for s in result["statuses"]) else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,464 +2,474 @@
 import streamlit as st
 import pandas as pd
 import numpy as np
-import plotly.express as px
 import plotly.graph_objects as go
-from plotly.subplots import make_subplots
 
-from apputil import load_data_via_uploader
+from apputil import (
+    load_data_via_uploader, load_long_index, apply_filters, load_cube, cube_query, ROLL_WINDOWS,
+    EXPORT_FORMATS, export_download, load_country_codes, load_figure, load_memory_report,
+    start_timing, finish_timing, render_timing_panel, load_similarity_index,
+)
+import charts
+import registry
+import similarity
 
 st.set_page_config(page_title="Measles/Rubella Dashboard", layout="wide", initial_sidebar_state="expanded")
 
-# Initialize session state for country selection
-if "selected_country" not in st.session_state:
-    st.session_state.selected_country = None
-
-# Header with description
-st.markdown("<h1 style='text-align:center; font-size:44px; margin-bottom:10px;'>Measles & Rubella Interactive Dashboard</h1>", unsafe_allow_html=True)
-st.markdown("<p style='text-align:center; color:#666; font-size:16px;'>Explore global disease trends, regional patterns, and country-specific insights</p>", unsafe_allow_html=True)
-
-# Load data via uploader
-base_wide, base_long = load_data_via_uploader()
-
-# Sidebar filters
-st.sidebar.header("🎛️ Filters")
-disease_options = ["Measles","Rubella","Both"]
-if {"Measles_per100k","Rubella_per100k"}.issubset(set(base_long["disease"].unique())):
-    disease_options += ["Measles_per100k","Rubella_per100k"]
-disease_sel = st.sidebar.selectbox("📊 Disease metric", disease_options, index=0)
-
-years_all = sorted([int(y) for y in base_long["year"].dropna().unique().tolist()])
-yr_min, yr_max = (years_all[0], years_all[-1]) if years_all else (2012, 2025)
-year_range = st.sidebar.slider("📅 Year range", min_value=int(yr_min), max_value=int(yr_max), value=(int(yr_min), int(yr_max)), step=1)
-
-regions = sorted(base_long["region"].dropna().unique().tolist())
-regions_sel = st.sidebar.multiselect("🌍 Regions", regions, default=regions)
-
-st.sidebar.markdown("---")
-st.sidebar.subheader("📈 Analysis Options")
-top_n = st.sidebar.number_input("Top N countries", min_value=5, max_value=50, value=10, step=1)
-roll_window = st.sidebar.select_slider("Rolling window (years)", options=[1,3,5,7], value=3)
-show_yoy = st.sidebar.checkbox("Show YoY growth", value=True)
-
-# Helpers
-def apply_filters(long_df, disease_sel, regions, year_range):
-    df = long_df.copy()
-    if disease_sel == "Both":
-        df = df[df["disease"].isin(["Measles","Rubella"])]
-    else:
-        df = df[df["disease"] == disease_sel]
-    df = df[(df["year"] >= year_range[0]) & (df["year"] <= year_range[1])]
-    if regions:
-        df = df[df["region"].isin(regions)]
-    return df
-
-def fmt_pct(x):
-    return "—" if pd.isna(x) else f"{x*100:.1f}%"
-
-def fmt_number(x):
-    if x >= 1_000_000:
-        return f"{x/1_000_000:.1f}M"
-    elif x >= 1_000:
-        return f"{x/1_000:.1f}K"
-    return f"{int(x)}"
-
-long_f = apply_filters(base_long, disease_sel, regions_sel, year_range)
-
-# Preview (collapsible)
-with st.expander("🔍 Preview data"):
-    st.dataframe(base_wide.head(20), use_container_width=True)
-
-# KPI section with better styling
-st.markdown("### 📊 Key Metrics")
-kcol1, kcol2, kcol3, kcol4, kcol5 = st.columns(5)
-tot_period = long_f["value"].sum() if not long_f.empty else 0
-latest_year = int(long_f["year"].max()) if not long_f.empty else None
-latest_total = long_f[long_f["year"]==latest_year]["value"].sum() if latest_year else 0
-prev_total = long_f[long_f["year"]==latest_year-1]["value"].sum() if latest_year and (latest_year-1) in long_f["year"].unique() else np.nan
-yoy_latest = (latest_total/prev_total-1) if prev_total and prev_total>0 else np.nan
-
-# Calculate average cases per year
-avg_per_year = tot_period / len(long_f["year"].unique()) if not long_f.empty else 0
-
-with kcol1: 
-    st.metric("Total Cases", fmt_number(tot_period), help="Total cases in selected period")
-with kcol2: 
-    st.metric(f"Cases in {latest_year if latest_year else '—'}", fmt_number(latest_total) if latest_year else "—")
-with kcol3: 
-    st.metric("YoY Change", fmt_pct(yoy_latest), delta=fmt_pct(yoy_latest) if not pd.isna(yoy_latest) else None)
-with kcol4: 
-    st.metric("Countries", f"{long_f['country'].nunique():,}", help="Number of countries with data")
-with kcol5:
-    st.metric("Avg/Year", fmt_number(avg_per_year), help="Average cases per year")
-
-st.markdown("---")
-
-# Create tabs for better organization
-tab1, tab2, tab3, tab4 = st.tabs(["🌐 Global & Regional", "🗺️ Geographic Analysis", "🔍 Country Deep Dive", "⚠️ Anomaly Detection"])
-
-with tab1:
-    # 1) Global Trends
-    st.subheader("📈 Global Trend Over Time")
-    global_agg = (long_f.groupby(["disease","year"], as_index=False)["value"].sum().sort_values("year"))
-    if not global_agg.empty:
-        if disease_sel == "Both":
-            g = global_agg.groupby("year", as_index=False)["value"].sum()
-            g["rolling"] = g["value"].rolling(roll_window, min_periods=1).mean()
-            g["yoy"] = g["value"].pct_change()
-            title = "Global Cases (Measles + Rubella)"
+# Opt-in per-rerun stage timings (APP_ENV=development or PROFILE_STAGES=1)
+timing = start_timing()
+
+# Everything below runs inside try/finally so an st.stop() or an exception still stops the timers
+try:
+    # Initialize session state for country selection
+    if "selected_country" not in st.session_state:
+        st.session_state.selected_country = None
+
+    # Header with description
+    st.markdown("<h1 style='text-align:center; font-size:44px; margin-bottom:10px;'>Measles & Rubella Interactive Dashboard</h1>", unsafe_allow_html=True)
+    st.markdown("<p style='text-align:center; color:#666; font-size:16px;'>Explore global disease trends, regional patterns, and country-specific insights</p>", unsafe_allow_html=True)
+
+    # Load data via uploader
+    base_wide, base_long = load_data_via_uploader()
+
+    # Sidebar filters
+    st.sidebar.header("🎛️ Filters")
+    disease_options = ["Measles","Rubella","Both"]
+    if {"Measles_per100k","Rubella_per100k"}.issubset(set(base_long["disease"].unique())):
+        disease_options += ["Measles_per100k","Rubella_per100k"]
+    disease_sel = st.sidebar.selectbox("📊 Disease metric", disease_options, index=0)
+
+    years_all = sorted([int(y) for y in base_long["year"].dropna().unique().tolist()])
+    yr_min, yr_max = (years_all[0], years_all[-1]) if years_all else (2012, 2025)
+    year_range = st.sidebar.slider("📅 Year range", min_value=int(yr_min), max_value=int(yr_max), value=(int(yr_min), int(yr_max)), step=1)
+
+    regions = sorted(base_long["region"].dropna().unique().tolist())
+    regions_sel = st.sidebar.multiselect("🌍 Regions", regions, default=regions)
+
+    st.sidebar.markdown("---")
+    st.sidebar.subheader("📈 Analysis Options")
+    top_n = st.sidebar.number_input("Top N countries", min_value=5, max_value=50, value=10, step=1)
+    roll_window = st.sidebar.select_slider("Rolling window (years)", options=list(ROLL_WINDOWS), value=3)
+    roll_col = f"roll{roll_window}"
+    show_yoy = st.sidebar.checkbox("Show YoY growth", value=True)
+
+    # Anomaly controls live with the other sidebar inputs so they keep their values on every tab
+    st.sidebar.markdown("---")
+    st.sidebar.subheader("⚠️ Anomaly Detection")
+    run_anomaly = st.sidebar.checkbox("Enable anomaly detection", value=False)
+    contamination = st.sidebar.slider("Contamination (expected % anomalies)", min_value=0.05, max_value=0.3, value=0.1, step=0.05)
+    anomaly_engine = None
+    if run_anomaly:
+        try:
+            from anomaly_detector import SCORERS, DEFAULT_ENGINE
+            engines = list(SCORERS)
+            anomaly_engine = st.sidebar.selectbox("Detection engine", engines, index=engines.index(DEFAULT_ENGINE))
+        except ImportError:
+            pass
+
+    # Helpers
+    def fmt_pct(x):
+        return "—" if pd.isna(x) else f"{x*100:.1f}%"
+
+    def fmt_number(x):
+        if x >= 1_000_000:
+            return f"{x/1_000_000:.1f}M"
+        elif x >= 1_000:
+            return f"{x/1_000:.1f}K"
+        return f"{int(x)}"
+
+    long_index = load_long_index(st.session_state["dataset_id"], base_long)
+    long_f = apply_filters(long_index, disease_sel, regions_sel, year_range)
+
+    # All KPIs and chart aggregates are answered from the per-dataset cube
+    cube = load_cube(st.session_state["dataset_id"], base_long)
+    year_tot = cube_query(cube, ["year"], disease_sel, regions_sel, year_range).sort_values("year")
+    rank_df = (cube_query(cube, ["country"], disease_sel, regions_sel, year_range)[["country","value"]]
+               .sort_values("value", ascending=False))
+
+    # Preview (collapsible)
+    with st.expander("🔍 Preview data"):
+        st.dataframe(base_wide.head(20), use_container_width=True)
+        mem = load_memory_report(st.session_state["dataset_id"], base_wide, base_long)
+        st.caption(f"In memory: {mem['held_mb'].sum():.1f} MB "
+                   f"({1 - mem['held_mb'].sum() / mem['default_mb'].sum():.0%} less than with default dtypes), "
+                   f"shared by {max(registry.sessions(st.session_state['dataset_id']), 1)} session(s)")
+
+    # KPI section with better styling
+    st.markdown("### 📊 Key Metrics")
+    kcol1, kcol2, kcol3, kcol4, kcol5 = st.columns(5)
+    tot_period = year_tot["value"].sum() if not year_tot.empty else 0
+    latest_year = int(year_tot["year"].max()) if not year_tot.empty else None
+    latest_total = year_tot.loc[year_tot["year"]==latest_year, "value"].sum() if latest_year else 0
+    prev_total = year_tot.loc[year_tot["year"]==latest_year-1, "value"].sum() if latest_year and (year_tot["year"]==latest_year-1).any() else np.nan
+    yoy_latest = (latest_total/prev_total-1) if prev_total and prev_total>0 else np.nan
+
+    # Calculate average cases per year
+    avg_per_year = tot_period / len(year_tot) if not year_tot.empty else 0
+
+    with kcol1: 
+        st.metric("Total Cases", fmt_number(tot_period), help="Total cases in selected period")
+    with kcol2: 
+        st.metric(f"Cases in {latest_year if latest_year else '—'}", fmt_number(latest_total) if latest_year else "—")
+    with kcol3: 
+        st.metric("YoY Change", fmt_pct(yoy_latest), delta=fmt_pct(yoy_latest) if not pd.isna(yoy_latest) else None)
+    with kcol4: 
+        st.metric("Countries", f"{len(rank_df):,}", help="Number of countries with data")
+    with kcol5:
+        st.metric("Avg/Year", fmt_number(avg_per_year), help="Average cases per year")
+
+    st.markdown("---")
+
+    # Figures are memoized per (dataset, filters, chart parameters), so reruns that do not
+    # touch these inputs (e.g. picking an anomaly country) reuse them as-is
+    data_id = st.session_state["dataset_id"]
+    filter_key = (disease_sel, tuple(regions_sel), tuple(year_range))
+
+    def render_overview():
+        # 1) Global Trends
+        st.subheader("📈 Global Trend Over Time")
+        fig_global = load_figure("global", data_id, filter_key + (roll_window, show_yoy),
+                                 lambda: charts.global_trend_figure(cube, disease_sel, regions_sel, year_range, roll_window, show_yoy))
+        if fig_global is not None:
+            st.plotly_chart(fig_global, use_container_width=True)
         else:
-            g = global_agg[global_agg["disease"]==disease_sel][["year","value"]].copy()
-            g["rolling"] = g["value"].rolling(roll_window, min_periods=1).mean()
-            g["yoy"] = g["value"].pct_change()
-            title = f"Global Cases ({disease_sel})"
-        
-        fig_global = go.Figure()
-        fig_global.add_trace(go.Bar(x=g["year"], y=g["value"], name="Annual Cases", 
-                                    marker_color="#e3f2fd", marker_line_color="#1976d2", marker_line_width=1))
-        if roll_window > 1:
-            fig_global.add_trace(go.Scatter(x=g["year"], y=g["rolling"], name=f"{roll_window}Y Rolling Avg", 
-                                            mode="lines+markers", line=dict(color="#d32f2f", width=3),
-                                            marker=dict(size=6)))
-        if show_yoy:
-            fig_global.add_trace(go.Scatter(x=g["year"], y=g["yoy"], name="YoY Growth", mode="lines+markers",
-                                            line=dict(color="#1976d2", width=2, dash="dash"), 
-                                            marker=dict(size=5), yaxis="y2"))
-            fig_global.update_layout(
-                yaxis2=dict(title="YoY Growth Rate", overlaying="y", side="right", tickformat=".0%",
-                           showgrid=False)
-            )
-        fig_global.update_layout(
-            title=title, height=450, 
-            margin=dict(l=20,r=20,t=50,b=10), 
-            yaxis=dict(title="Number of Cases"),
-            hovermode="x unified",
-            legend=dict(orientation="h", yanchor="bottom", y=1.02, xanchor="center", x=0.5)
-        )
-        st.plotly_chart(fig_global, use_container_width=True)
-    else:
-        st.info("No data for selected filters.")
-
-    # 2) Regional Trends
-    st.subheader("🌍 Regional Trends")
-    reg_agg = (long_f.groupby(["region","year"], as_index=False)["value"].sum().sort_values(["region","year"]))
-    if not reg_agg.empty:
-        reg_agg["rolling"] = reg_agg.groupby("region")["value"].transform(lambda s: s.rolling(roll_window, min_periods=1).mean())
-        
-        fig_reg = go.Figure()
-        colors = px.colors.qualitative.Set2
-        for idx, reg in enumerate(reg_agg["region"].unique()):
-            dreg = reg_agg[reg_agg["region"]==reg]
-            color = colors[idx % len(colors)]
-            # Actual values
-            fig_reg.add_trace(go.Scatter(
-                x=dreg["year"], y=dreg["value"], name=reg,
-                mode="lines+markers", line=dict(color=color, width=2),
-                marker=dict(size=6)
-            ))
-            # Rolling average (dotted)
-            if roll_window > 1:
-                fig_reg.add_trace(go.Scatter(
-                    x=dreg["year"], y=dreg["rolling"], 
-                    name=f"{reg} (avg)", mode="lines", 
-                    line=dict(color=color, width=2, dash="dot"),
-                    showlegend=False, opacity=0.6
-                ))
-        
-        fig_reg.update_layout(
-            height=450, 
-            margin=dict(l=20,r=20,t=10,b=10),
-            yaxis=dict(title="Cases"),
-            xaxis=dict(title="Year"),
-            hovermode="x unified",
-            legend=dict(orientation="v", yanchor="top", y=1, xanchor="right", x=1)
-        )
-        st.plotly_chart(fig_reg, use_container_width=True)
-    else:
-        st.info("No regional data for selected filters.")
-
-with tab2:
-    col_rank, col_map = st.columns([1, 1.5])
-    
-    with col_rank:
-        # 3) Country Rankings
-        st.subheader("Countries with Highest Reported Cases")
-        rank_df = (long_f.groupby("country", as_index=False)["value"].sum().sort_values("value", ascending=False))
-        show_top = rank_df.head(int(top_n))
-        
-        if not show_top.empty:
-            fig_bar = px.bar(
-                show_top, y="country", x="value", 
-                orientation="h",
-                labels={"value":"Total Cases", "country":"Country"},
-                title=f"Highest reported cases in top {min(int(top_n), len(show_top))} countries",
-                color="value",
-                color_continuous_scale="Reds"
-            )
-            fig_bar.update_layout(
-                height=600, 
-                margin=dict(l=20,r=20,t=50,b=10),
-                showlegend=False,
-                yaxis=dict(autorange="reversed")
-            )
-            st.plotly_chart(fig_bar, use_container_width=True)
+            st.info("No data for selected filters.")
+
+        # 2) Regional Trends
+        st.subheader("🌍 Regional Trends")
+        fig_reg = load_figure("regional", data_id, filter_key + (roll_window,),
+                              lambda: charts.regional_figure(cube, disease_sel, regions_sel, year_range, roll_window))
+        if fig_reg is not None:
+            st.plotly_chart(fig_reg, use_container_width=True)
         else:
-            st.info("No ranking data available.")
+            st.info("No regional data for selected filters.")
+
+    def render_geography():
+        col_rank, col_map = st.columns([1, 1.5])
     
-    with col_map:
-        # 4) Choropleth Map
-        st.subheader("🗺️ Geographic Distribution")
-        st.info("⚠️ Note: Some countries/territories may not appear on the map due to naming variations or political recognition issues in the geographic database. All countries remain available in rankings and country-specific analysis.")
-        map_year = st.slider("Select year", min_value=year_range[0], max_value=year_range[1], value=year_range[1], step=1)
-        map_df = long_f[long_f["year"]==map_year].groupby("country", as_index=False)["value"].sum()
-        
-        if not map_df.empty:
-            fig_map = px.choropleth(
-                map_df, locations="country", locationmode="country names",
-                color="value", color_continuous_scale="YlOrRd",
-                hover_name="country", hover_data={"value":":,.0f"},
-                title=f"{disease_sel if disease_sel!='Both' else 'Measles + Rubella'} Cases in {map_year}",
-                labels={"value": "Cases"}
-            )
-            fig_map.update_layout(
-                height=600, 
-                margin=dict(l=20,r=20,t=50,b=10),
-                geo=dict(showframe=True, framecolor="#1976d2", framewidth=2, showcoastlines=True, projection_type='orthographic')
-            )
-            fig_map.update_traces(marker_line_width=1.0, marker_line_color="#333333")
-            st.plotly_chart(fig_map, use_container_width=True)
-        else:
-            st.info("No data for selected map year.")
+        with col_rank:
+            # 3) Country Rankings
+            st.subheader("Countries with Highest Reported Cases")
+            fig_bar = load_figure("ranking", data_id, filter_key + (int(top_n),),
+                                  lambda: charts.ranking_figure(rank_df, top_n))
+            if fig_bar is not None:
+                st.plotly_chart(fig_bar, use_container_width=True)
+            else:
+                st.info("No ranking data available.")
+    
+        with col_map:
+            # 4) Choropleth Map
+            st.subheader("🗺️ Geographic Distribution")
+            iso3_by_country, unmatched = load_country_codes(data_id, base_wide)
+            if unmatched:
+                st.info(f"⚠️ {len(unmatched)} countries/territories have no map code and are not drawn: {', '.join(unmatched)}. "
+                        "They remain available in rankings and country-specific analysis.")
+            # Every year of the range ships as an animation frame; the year slider runs in the browser
+            fig_map = load_figure("map", data_id, filter_key,
+                                  lambda: charts.map_figure(cube, disease_sel, regions_sel, year_range, iso3_by_country))
+            if fig_map is not None:
+                st.plotly_chart(fig_map, use_container_width=True)
+            else:
+                st.info("No data for selected years.")
 
-with tab3:
-    # 5) Country Trend
-    st.subheader("📊 Country-Specific Analysis")
-    rank_df = (long_f.groupby("country", as_index=False)["value"].sum().sort_values("value", ascending=False))
+    def render_country():
+        # 5) Country Trend
+        st.subheader("📊 Country-Specific Analysis")
     
-    col1, col2 = st.columns([2, 1])
-    with col1:
-        sel_cty = st.selectbox("Select a country", rank_df["country"].tolist() if not rank_df.empty else [], key="country_select")
-    with col2:
-        show_comparison = st.checkbox("Compare with global average", value=False)
+        col1, col2 = st.columns([2, 1])
+        with col1:
+            sel_cty = st.selectbox("Select a country", rank_df["country"].tolist() if not rank_df.empty else [], key="country_select", persist_state="page")
+        with col2:
+            show_comparison = st.checkbox("Compare with global average", value=False, key="show_comparison", persist_state="page")
     
-    if sel_cty:
-        cty_ts = (long_f[long_f["country"]==sel_cty].groupby("year", as_index=False)["value"].sum().sort_values("year"))
+        if sel_cty:
+            cty_ts = (cube_query(cube, ["year"], disease_sel, regions_sel, year_range, countries=[sel_cty])[["year","value",roll_col]]
+                      .rename(columns={roll_col: "rolling"}).sort_values("year"))
         
-        if not cty_ts.empty:
-            cty_ts["rolling"] = cty_ts["value"].rolling(roll_window, min_periods=1).mean()
-            cty_ts["yoy"] = cty_ts["value"].pct_change()
-            
-            # Main chart
-            fig_cty = go.Figure()
-            fig_cty.add_trace(go.Bar(
-                x=cty_ts["year"], y=cty_ts["value"], name="Annual Cases",
-                marker_color="#bbdefb", marker_line_color="#1976d2", marker_line_width=1
-            ))
-            fig_cty.add_trace(go.Scatter(
-                x=cty_ts["year"], y=cty_ts["rolling"], name=f"{roll_window}Y Rolling Avg",
-                line=dict(color="#d32f2f", width=3), mode="lines+markers",
-                marker=dict(size=6)
-            ))
+            if not cty_ts.empty:
+                cty_ts["yoy"] = cty_ts["value"].pct_change()
             
-            # Add global average comparison if requested
-            if show_comparison:
-                global_avg = long_f.groupby("year", as_index=False)["value"].mean()
-                global_avg = global_avg[global_avg["year"].isin(cty_ts["year"])]
-                fig_cty.add_trace(go.Scatter(
-                    x=global_avg["year"], y=global_avg["value"], 
-                    name="Global Avg (per country)",
-                    line=dict(color="#ff9800", width=2, dash="dash"),
-                    mode="lines"
+                # Main chart (long series are thinned to the chart width and drawn with WebGL)
+                cty_plot = charts.downsample(cty_ts, "value")
+                Scatter = charts.scatter_type(len(cty_plot) * (1 + show_comparison + show_yoy))
+                fig_cty = go.Figure()
+                fig_cty.add_trace(go.Bar(
+                    x=cty_plot["year"], y=cty_plot["value"], name="Annual Cases",
+                    marker_color="#bbdefb", marker_line_color="#1976d2", marker_line_width=1
                 ))
-            
-            if show_yoy:
-                fig_cty.add_trace(go.Scatter(
-                    x=cty_ts["year"], y=cty_ts["yoy"], name="YoY Growth", yaxis="y2",
-                    line=dict(color="#1976d2", dash="dash", width=2),
-                    mode="lines+markers", marker=dict(size=5)
+                fig_cty.add_trace(Scatter(
+                    x=cty_plot["year"], y=cty_plot["rolling"], name=f"{roll_window}Y Rolling Avg",
+                    line=dict(color="#d32f2f", width=3), mode="lines+markers",
+                    marker=dict(size=6)
                 ))
+            
+                # Add global average comparison if requested
+                if show_comparison:
+                    global_avg = year_tot.assign(value=year_tot["value"] / year_tot["count"])[["year","value"]]
+                    global_avg = global_avg[global_avg["year"].isin(cty_plot["year"])]
+                    fig_cty.add_trace(Scatter(
+                        x=global_avg["year"], y=global_avg["value"], 
+                        name="Global Avg (per country)",
+                        line=dict(color="#ff9800", width=2, dash="dash"),
+                        mode="lines"
+                    ))
+            
+                if show_yoy:
+                    fig_cty.add_trace(Scatter(
+                        x=cty_plot["year"], y=cty_plot["yoy"], name="YoY Growth", yaxis="y2",
+                        line=dict(color="#1976d2", dash="dash", width=2),
+                        mode="lines+markers", marker=dict(size=5)
+                    ))
+                    fig_cty.update_layout(
+                        yaxis2=dict(title="YoY Growth Rate", overlaying="y", side="right", 
+                                   tickformat=".0%", showgrid=False)
+                    )
+            
                 fig_cty.update_layout(
-                    yaxis2=dict(title="YoY Growth Rate", overlaying="y", side="right", 
-                               tickformat=".0%", showgrid=False)
+                    title=f"<b>{sel_cty}</b> - {disease_sel if disease_sel!='Both' else 'Measles + Rubella'}",
+                    height=500, 
+                    margin=dict(l=20,r=20,t=50,b=10), 
+                    yaxis=dict(title="Number of Cases"),
+                    hovermode="x unified",
+                    legend=dict(orientation="h", yanchor="bottom", y=1.02, xanchor="center", x=0.5)
                 )
+                st.plotly_chart(fig_cty, use_container_width=True)
             
-            fig_cty.update_layout(
-                title=f"<b>{sel_cty}</b> - {disease_sel if disease_sel!='Both' else 'Measles + Rubella'}",
-                height=500, 
-                margin=dict(l=20,r=20,t=50,b=10), 
-                yaxis=dict(title="Number of Cases"),
-                hovermode="x unified",
-                legend=dict(orientation="h", yanchor="bottom", y=1.02, xanchor="center", x=0.5)
-            )
-            st.plotly_chart(fig_cty, use_container_width=True)
-            
-            # Summary statistics for selected country
-            col1, col2, col3, col4 = st.columns(4)
-            with col1:
-                st.metric("Total Cases", f"{int(cty_ts['value'].sum()):,}")
-            with col2:
-                st.metric("Peak Year", f"{int(cty_ts.loc[cty_ts['value'].idxmax(), 'year'])}")
-            with col3:
-                st.metric("Peak Cases", f"{int(cty_ts['value'].max()):,}")
-            with col4:
-                avg_annual = cty_ts['value'].mean()
-                st.metric("Avg Annual", f"{int(avg_annual):,}")
-        else:
-            st.info(f"No data available for {sel_cty} in selected period.")
+                # Summary statistics for selected country
+                col1, col2, col3, col4 = st.columns(4)
+                with col1:
+                    st.metric("Total Cases", f"{int(cty_ts['value'].sum()):,}")
+                with col2:
+                    st.metric("Peak Year", f"{int(cty_ts.loc[cty_ts['value'].idxmax(), 'year'])}")
+                with col3:
+                    st.metric("Peak Cases", f"{int(cty_ts['value'].max()):,}")
+                with col4:
+                    avg_annual = cty_ts['value'].mean()
+                    st.metric("Avg Annual", f"{int(avg_annual):,}")
+            else:
+                st.info(f"No data available for {sel_cty} in selected period.")
+
+        # Similar-country search over the precomputed trend index (one matrix-vector product per query)
+        sim_index = load_similarity_index(data_id, disease_sel, tuple(year_range), cube)
+        if sel_cty:
+            with st.expander("🔎 Countries with similar trends", expanded=False):
+                similar_df = similarity.similar(sim_index, sel_cty, k=int(top_n), regions=regions_sel)
+                if similar_df.empty:
+                    st.info(f"Not enough years of varying data to match {sel_cty} "
+                            f"(need at least {similarity.MIN_YEARS}).")
+                else:
+                    st.caption("Ranked by correlation of yearly log cases over the selected years")
+                    st.dataframe(similar_df, use_container_width=True, hide_index=True,
+                                 column_config={"similarity": st.column_config.ProgressColumn(
+                                     "Similarity", format="%.2f", min_value=-1, max_value=1)})
+                    picks = [sel_cty] + similar_df["country"].head(4).tolist()
+                    st.button("Compare these countries", key="compare_similar",
+                              on_click=lambda: st.session_state.update(compare_countries=picks))
     
-    # Country Comparison Tool
-    st.markdown("---")
-    with st.expander("⚖️ Country Comparison Tool", expanded=False):
-        st.write("Compare multiple countries side-by-side")
+        # Country Comparison Tool
+        st.markdown("---")
+        with st.expander("⚖️ Country Comparison Tool", expanded=False):
+            st.write("Compare multiple countries side-by-side")
         
-        available_countries = rank_df["country"].tolist() if not rank_df.empty else []
+            available_countries = rank_df["country"].tolist() if not rank_df.empty else []
         
-        compare_countries = st.multiselect(
-            "Select countries to compare (2-5 recommended)",
-            available_countries,
-            default=available_countries[:3] if len(available_countries) >= 3 else available_countries
-        )
+            compare_countries = st.multiselect(
+                "Select countries to compare (2-5 recommended)",
+                available_countries,
+                default=available_countries[:3] if len(available_countries) >= 3 else available_countries,
+                key="compare_countries", persist_state="page"
+            )
         
-        if compare_countries and len(compare_countries) >= 2:
-            comparison_data = long_f[long_f["country"].isin(compare_countries)]
-            yearly_comparison = comparison_data.groupby(["country", "year"])["value"].sum().reset_index()
+            if compare_countries and len(compare_countries) >= 2:
+                yearly_comparison = cube_query(cube, ["country", "year"], disease_sel, regions_sel, year_range,
+                                               countries=compare_countries)[["country", "year", "value"]]
             
-            # Line chart comparison
-            fig_compare = px.line(
-                yearly_comparison, 
-                x="year", 
-                y="value", 
-                color="country",
-                markers=True,
-                labels={"value": "Cases", "year": "Year"},
-                title="Side-by-Side Country Comparison"
-            )
-            fig_compare.update_layout(
-                height=400,
-                hovermode="x unified",
-                legend=dict(orientation="h", yanchor="bottom", y=1.02)
-            )
-            st.plotly_chart(fig_compare, use_container_width=True)
+                # Line chart comparison
+                fig_compare = load_figure("comparison", data_id, filter_key + (tuple(compare_countries),),
+                                          lambda: charts.comparison_figure(yearly_comparison, compare_countries))
+                st.plotly_chart(fig_compare, use_container_width=True)
             
-            # Summary statistics table
-            st.write("#### Comparison Statistics")
-            comp_stats = []
-            for country in compare_countries:
-                country_data = yearly_comparison[yearly_comparison["country"] == country]["value"]
-                comp_stats.append({
-                    "Country": country,
-                    "Total": f"{int(country_data.sum()):,}",
-                    "Average": f"{int(country_data.mean()):,}",
-                    "Peak": f"{int(country_data.max()):,}",
-                    "Min": f"{int(country_data.min()):,}",
-                    "Std Dev": f"{int(country_data.std()):,}"
-                })
-            st.dataframe(pd.DataFrame(comp_stats), use_container_width=True, hide_index=True)
+                # Summary statistics table
+                st.write("#### Comparison Statistics")
+                comp_stats = similarity.comparison_stats(sim_index, compare_countries)
+                for col in comp_stats.columns[1:]:
+                    comp_stats[col] = comp_stats[col].map(lambda x: "—" if pd.isna(x) else f"{int(x):,}")
+                st.dataframe(comp_stats, use_container_width=True, hide_index=True)
+            else:
+                st.info("Select at least 2 countries to compare")
+
+    def render_global_scan(scan_key, polling: bool):
+        # Runs as a fragment: while the shared scan job is active only this panel reruns, once a second
+        import jobs
+        from anomaly_detector import submit_global_scan, partial_scan_results, top_anomalies
+
+        snap = jobs.poll(scan_key)
+        active = snap is not None and snap["status"] in jobs.ACTIVE
+        if polling and not active:
+            # The scan just ended; a full rerun redraws the panel without polling
+            st.rerun()
+        if snap is None or snap["status"] in ("cancelled", "error"):
+            if snap is not None and snap["status"] == "error":
+                st.error(f"The last scan failed: {snap['error']}")
+            elif snap is not None:
+                st.info("The last scan was cancelled.")
+            if st.button("▶️ Scan all countries", help="Runs in the background; other tabs stay usable meanwhile"):
+                submit_global_scan(data_id, base_wide, contamination, anomaly_engine)
+                st.rerun()
+            return
+
+        n_countries = base_wide["country"].nunique()
+        if active:
+            col1, col2 = st.columns([4, 1])
+            with col1:
+                text = ("Queued behind another scan..." if snap["status"] == "queued" else
+                        f"Scanned {len(snap['partial']):,} of {n_countries:,} countries ({snap['seconds']:.0f}s)")
+                st.progress(snap["progress"], text=text)
+            with col2:
+                if st.button("⏹️ Cancel scan", use_container_width=True):
+                    jobs.cancel(scan_key)
+                    st.rerun()
+            results = partial_scan_results(snap)
         else:
-            st.info("Select at least 2 countries to compare")
+            results, skipped = snap["result"]
+            st.caption(f"Scanned {n_countries:,} countries in {snap['seconds']:.1f}s")
+            if skipped:
+                st.warning(f"Skipped {len(skipped)} countries with fewer than 3 years of data")
 
-with tab4:
-    # 6) Anomaly Detection
-    st.subheader("🔍 Anomaly Detection")
-    st.markdown("Detect unusual patterns in disease case data using Isolation Forest algorithm")
+        top = top_anomalies(results, top_n)
+        if not top.empty:
+            st.dataframe(top.style.format({"score": "{:.3f}"}), use_container_width=True, hide_index=True)
+        elif not active:
+            st.info("✅ No anomalies detected with current settings.")
 
-    st.sidebar.markdown("---")
-    st.sidebar.subheader("⚠️ Anomaly Detection")
-    run_anomaly = st.sidebar.checkbox("Enable anomaly detection", value=False)
-    contamination = st.sidebar.slider("Contamination (expected % anomalies)", min_value=0.05, max_value=0.3, value=0.1, step=0.05)
+    def render_anomalies():
+        # 6) Anomaly Detection
+        st.subheader("🔍 Anomaly Detection")
+        st.markdown("Detect unusual patterns in disease case data using Isolation Forest or a fast robust z-score engine")
 
-    if run_anomaly:
-        try:
-            from anomaly_detector import detect_anomalies_for_country
+        if run_anomaly:
+            try:
+                from anomaly_detector import detect_anomalies
             
-            st.write("### Country-specific anomaly analysis")
-            anomaly_country = st.selectbox("Select country for anomaly analysis", 
-                                           rank_df["country"].tolist() if not rank_df.empty else [],
-                                           key="anomaly_country_select")
+                st.write("### Country-specific anomaly analysis")
+                anomaly_country = st.selectbox("Select country for anomaly analysis", 
+                                               rank_df["country"].tolist() if not rank_df.empty else [],
+                                               key="anomaly_country_select", persist_state="page")
             
-            if anomaly_country:
-                with st.spinner(f"Running anomaly detection for {anomaly_country}..."):
-                    anomaly_result = detect_anomalies_for_country(base_wide, anomaly_country, contamination)
+                if anomaly_country:
+                    with st.spinner(f"Running anomaly detection for {anomaly_country}..."):
+                        anomaly_result = detect_anomalies(st.session_state["dataset_id"], anomaly_country, base_wide, contamination,
+                                                          engine=anomaly_engine)
                 
-                if anomaly_result is not None and not anomaly_result.empty:
-                    fig_anom = go.Figure()
-                    if "measles" in anomaly_result:
-                        fig_anom.add_trace(go.Scatter(
-                            x=anomaly_result["year"], y=anomaly_result["measles"],
-                            mode="lines+markers", name="Measles cases",
-                            line=dict(color="#1f77b4", width=2)
-                        ))
-                        if "measles_anomaly" in anomaly_result:
-                            anom_m = anomaly_result[anomaly_result["measles_anomaly"] == -1]
+                    if anomaly_result is not None and not anomaly_result.empty:
+                        fig_anom = go.Figure()
+                        if "measles" in anomaly_result:
                             fig_anom.add_trace(go.Scatter(
-                                x=anom_m["year"], y=anom_m["measles"],
-                                mode="markers", name="Measles anomaly",
-                                marker=dict(size=14, color="red", symbol="x", line=dict(width=2))
+                                x=anomaly_result["year"], y=anomaly_result["measles"],
+                                mode="lines+markers", name="Measles cases",
+                                line=dict(color="#1f77b4", width=2)
                             ))
-                    if "rubella" in anomaly_result:
-                        fig_anom.add_trace(go.Scatter(
-                            x=anomaly_result["year"], y=anomaly_result["rubella"],
-                            mode="lines+markers", name="Rubella cases",
-                            line=dict(color="#ff7f0e", width=2), yaxis="y2"
-                        ))
-                        if "rubella_anomaly" in anomaly_result:
-                            anom_r = anomaly_result[anomaly_result["rubella_anomaly"] == -1]
+                            if "measles_anomaly" in anomaly_result:
+                                anom_m = anomaly_result[anomaly_result["measles_anomaly"] == -1]
+                                fig_anom.add_trace(go.Scatter(
+                                    x=anom_m["year"], y=anom_m["measles"],
+                                    mode="markers", name="Measles anomaly",
+                                    marker=dict(size=14, color="red", symbol="x", line=dict(width=2))
+                                ))
+                        if "rubella" in anomaly_result:
                             fig_anom.add_trace(go.Scatter(
-                                x=anom_r["year"], y=anom_r["rubella"],
-                                mode="markers", name="Rubella anomaly",
-                                marker=dict(size=14, color="darkred", symbol="x", line=dict(width=2)),
-                                yaxis="y2"
+                                x=anomaly_result["year"], y=anomaly_result["rubella"],
+                                mode="lines+markers", name="Rubella cases",
+                                line=dict(color="#ff7f0e", width=2), yaxis="y2"
                             ))
-                    fig_anom.update_layout(
-                        height=500,
-                        yaxis=dict(title="Measles cases"),
-                        yaxis2=dict(title="Rubella cases", overlaying="y", side="right"),
-                        legend=dict(orientation="h", yanchor="bottom", y=1.02, xanchor="center", x=0.5),
-                        hovermode="x unified"
-                    )
-                    st.plotly_chart(fig_anom, use_container_width=True)
+                            if "rubella_anomaly" in anomaly_result:
+                                anom_r = anomaly_result[anomaly_result["rubella_anomaly"] == -1]
+                                fig_anom.add_trace(go.Scatter(
+                                    x=anom_r["year"], y=anom_r["rubella"],
+                                    mode="markers", name="Rubella anomaly",
+                                    marker=dict(size=14, color="darkred", symbol="x", line=dict(width=2)),
+                                    yaxis="y2"
+                                ))
+                        fig_anom.update_layout(
+                            height=500,
+                            yaxis=dict(title="Measles cases"),
+                            yaxis2=dict(title="Rubella cases", overlaying="y", side="right"),
+                            legend=dict(orientation="h", yanchor="bottom", y=1.02, xanchor="center", x=0.5),
+                            hovermode="x unified"
+                        )
+                        st.plotly_chart(fig_anom, use_container_width=True)
                     
-                    st.write("#### 📋 Detected Anomalies")
-                    anom_years = anomaly_result[
-                        (anomaly_result.get("measles_anomaly", 1) == -1) | 
-                        (anomaly_result.get("rubella_anomaly", 1) == -1) |
-                        (anomaly_result.get("joint_anomaly", 1) == -1)
-                    ]
+                        st.write("#### 📋 Detected Anomalies")
+                        anom_years = anomaly_result[
+                            (anomaly_result.get("measles_anomaly", 1) == -1) | 
+                            (anomaly_result.get("rubella_anomaly", 1) == -1) |
+                            (anomaly_result.get("joint_anomaly", 1) == -1)
+                        ]
                     
-                    if not anom_years.empty:
-                        display_cols = ["year", "measles", "rubella"]
-                        if "measles_anomaly_score" in anom_years.columns:
-                            display_cols.append("measles_anomaly_score")
-                        if "rubella_anomaly_score" in anom_years.columns:
-                            display_cols.append("rubella_anomaly_score")
+                        if not anom_years.empty:
+                            display_cols = ["year", "measles", "rubella"]
+                            if "measles_anomaly_score" in anom_years.columns:
+                                display_cols.append("measles_anomaly_score")
+                            if "rubella_anomaly_score" in anom_years.columns:
+                                display_cols.append("rubella_anomaly_score")
                         
-                        st.dataframe(
-                            anom_years[display_cols].style.format({
-                                "measles_anomaly_score": "{:.3f}", 
-                                "rubella_anomaly_score": "{:.3f}"
-                            }),
-                            use_container_width=True
-                        )
+                            st.dataframe(
+                                anom_years[display_cols].style.format({
+                                    "measles_anomaly_score": "{:.3f}", 
+                                    "rubella_anomaly_score": "{:.3f}"
+                                }),
+                                use_container_width=True
+                            )
+                        else:
+                            st.info("✅ No anomalies detected for this country with current settings.")
                     else:
-                        st.info("✅ No anomalies detected for this country with current settings.")
-                else:
-                    st.warning(f"Could not perform anomaly detection for {anomaly_country}. Insufficient data.")
-        except ImportError:
-            st.error("❌ Anomaly detector module not found. Please ensure 'anomaly_detector.py' is available.")
-    else:
-        st.info("👈 Enable anomaly detection in the sidebar to analyze unusual patterns.")
-
-# Download section
-st.markdown("---")
-st.subheader("💾 Download Data")
-if not long_f.empty:
-    col1, col2 = st.columns([3, 1])
-    with col1:
-        st.write(f"Download filtered dataset ({len(long_f):,} rows)")
-    with col2:
-        st.download_button(
-            "📥 Download CSV",
-            data=long_f.sort_values(["country","region","disease","year"]).to_csv(index=False).encode("utf-8"),
-            file_name=f"measles_rubella_{disease_sel}_{year_range[0]}-{year_range[1]}.csv",
-            mime="text/csv",
-            use_container_width=True
-        )
+                        st.warning(f"Could not perform anomaly detection for {anomaly_country}. Insufficient data.")
+
+                import jobs
+                from anomaly_detector import global_scan_key
+
+                st.write(f"### Most anomalous country-years worldwide (top {int(top_n)})")
+                scan_key = global_scan_key(data_id, contamination, anomaly_engine)
+                snap = jobs.poll(scan_key)
+                polling = snap is not None and snap["status"] in jobs.ACTIVE
+                st.fragment(render_global_scan, run_every=1.0 if polling else None)(scan_key, polling)
+            except ImportError:
+                st.error("❌ Anomaly detector module not found. Please ensure 'anomaly_detector.py' is available.")
+        else:
+            st.info("👈 Enable anomaly detection in the sidebar to analyze unusual patterns.")
+
+    # Views: tabs are stateful, so only the open tab's view runs on a rerun.
+    # New sections are added here and cost nothing while they are not shown.
+    VIEWS = {
+        "🌐 Global & Regional": render_overview,
+        "🗺️ Geographic Analysis": render_geography,
+        "🔍 Country Deep Dive": render_country,
+        "⚠️ Anomaly Detection": render_anomalies,
+    }
+    for tab, render in zip(st.tabs(list(VIEWS), key="active_view", on_change="rerun"), VIEWS.values()):
+        if tab.open:
+            with tab:
+                render()
+
+    # Download section
+    st.markdown("---")
+    st.subheader("💾 Download Data")
+    if not long_f.empty:
+        col1, col2, col3 = st.columns([2, 1, 1])
+        with col1:
+            st.write(f"Download filtered dataset ({len(long_f):,} rows)")
+        with col2:
+            export_fmt = st.selectbox("Format", list(EXPORT_FORMATS), index=0, label_visibility="collapsed")
+        with col3:
+            # Built only when clicked, then memoized on disk per filter combination
+            ext, mime = EXPORT_FORMATS[export_fmt]
+            st.download_button(
+                f"📥 Download {export_fmt}",
+                data=export_download(st.session_state["dataset_id"], disease_sel, regions_sel, year_range, export_fmt, long_f),
+                file_name=f"measles_rubella_{disease_sel}_{year_range[0]}-{year_range[1]}{ext}",
+                mime=mime,
+                use_container_width=True
+            )
+
+    render_timing_panel(timing)
+finally:
+    finish_timing(timing)
@@ -1,71 +1,260 @@
 # apputil.py
 import pandas as pd
-import numpy as np
 import streamlit as st
 import os
+import time
+import json
+import threading
+import hashlib
+import datastore
+import ingest
+import registry
+import profiling
+import similarity
+# The pipeline itself lives in core.py (no Streamlit); re-exported here for the app
+from core import (
+    ROLL_WINDOWS, _read_excel_from_bytes, normalize_and_transform, add_rolls_yoy,
+    build_long_index, apply_filters, build_cube, cube_query, cube_measures,
+    dataset_id, load_workbook, EXPORT_FORMATS, write_export, country_codes, memory_report,
+)
 APP_ENV = os.getenv("APP_ENV", "production")
+# How many distinct uploaded datasets stay memoized (least recently used is evicted first)
+MAX_CACHED_DATASETS = int(os.getenv("MAX_CACHED_DATASETS", "4"))
+# How many built chart figures stay memoized across filter combinations
+MAX_CACHED_FIGURES = int(os.getenv("MAX_CACHED_FIGURES", "64"))
+# Disk budget of memoized download files; least recently used are deleted first
+MAX_EXPORT_CACHE_MB = float(os.getenv("MAX_EXPORT_CACHE_MB", "512"))
 
-@st.cache_data(show_spinner=True)
-def _read_excel_from_bytes(file_bytes: bytes) -> pd.DataFrame:
-    return pd.read_excel(file_bytes)
-
-def normalize_and_transform(df: pd.DataFrame):
-    # Standardize columns
-    df = df.rename(columns={
-        "Region":"region","Country":"country","Year":"year",
-        "Measles_Cases":"measles","Rubella_Cases":"rubella",
-        "Population":"population",
-        "Measles_Cases_Per_100K":"measles_per100k",
-        "Rubella_Cases_Per_100K":"rubella_per100k",
-    })
-    for c in ["region","country"]:
-        df[c] = df[c].astype(str).str.strip()
-    df["year"] = pd.to_numeric(df["year"], errors="coerce").astype("Int64")
-    for c in ["measles","rubella","population","measles_per100k","rubella_per100k"]:
-        if c in df.columns:
-            df[c] = pd.to_numeric(df[c], errors="coerce")
-
-    # Build long-form totals
-    measles_long = df[["region","country","year","measles"]].rename(columns={"measles":"value"}).assign(disease="Measles")
-    rubella_long = df[["region","country","year","rubella"]].rename(columns={"rubella":"value"}).assign(disease="Rubella")
-    long_df = pd.concat([measles_long, rubella_long], ignore_index=True).sort_values(["country","disease","year"])
-
-    # Rolling averages and YoY per country+disease
-    def add_rolls_yoy(g):
-        g = g.sort_values("year")
-        g["roll3"] = g["value"].rolling(3, min_periods=1).mean()
-        g["roll5"] = g["value"].rolling(5, min_periods=1).mean()
-        prev = g["value"].shift(1)
-        g["yoy"] = np.where((prev.notna()) & (prev != 0), g["value"]/prev - 1, np.nan)
-        return g
-
-    long_df = long_df.groupby(["country","disease"], group_keys=False).apply(add_rolls_yoy)
-
-    # Optional per-100k variants
-    extras = []
-    if "measles_per100k" in df.columns:
-        m100 = df[["region","country","year","measles_per100k"]].rename(columns={"measles_per100k":"value"}).assign(disease="Measles_per100k")
-        m100 = m100.sort_values(["country","year"]).groupby("country", group_keys=False).apply(add_rolls_yoy)
-        extras.append(m100)
-    if "rubella_per100k" in df.columns:
-        r100 = df[["region","country","year","rubella_per100k"]].rename(columns={"rubella_per100k":"value"}).assign(disease="Rubella_per100k")
-        r100 = r100.sort_values(["country","year"]).groupby("country", group_keys=False).apply(add_rolls_yoy)
-        extras.append(r100)
-    if extras:
-        long_df = pd.concat([long_df] + extras, ignore_index=True)
-
-    return df, long_df
+def _session_id() -> str:
+    from streamlit.runtime.scriptrunner import get_script_run_ctx
+    ctx = get_script_run_ctx(suppress_warning=True)
+    return ctx.session_id if ctx else "local"
+
+def _from_registry(data_id: str, loader):
+    # Register this session as a viewer first, so the new dataset is not evicted on arrival
+    from streamlit import runtime
+    registry.acquire(_session_id(), data_id)
+    if runtime.exists():
+        registry.prune(runtime.get_instance().is_active_session)
+    if registry.has(data_id):
+        return registry.get(data_id, loader)
+    with st.spinner("Loading dataset..."):
+        return registry.get(data_id, loader)
+
+def load_dataset(data_id: str, file_bytes: bytes):
+    """
+    Parse and normalize a workbook through the process-wide registry, so all
+    sessions uploading the same file share one read-only copy.
+    Falls back to the on-disk columnar cache before re-parsing the Excel file.
+    """
+    return _from_registry(data_id, lambda: load_workbook(data_id, file_bytes))
+
+@st.cache_resource(max_entries=MAX_CACHED_DATASETS)
+def load_long_index(data_id: str, _base_long: pd.DataFrame) -> dict:
+    # One shared, read-only filter index per dataset
+    return build_long_index(_base_long)
+
+@st.cache_resource(max_entries=MAX_CACHED_DATASETS)
+def load_cube(data_id: str, _base_long: pd.DataFrame) -> dict:
+    # One shared aggregation cube per dataset
+    return build_cube(_base_long)
+
+def _drop_derived_caches(evicted):
+    # Filter indexes, cubes and similarity indexes hold copies of an evicted dataset's frames.
+    # st.cache_resource clears per function, so the remaining datasets rebuild theirs on next use.
+    for loader in (load_long_index, load_cube, load_similarity_index):
+        loader.clear()
+
+@st.cache_resource(max_entries=MAX_CACHED_DATASETS)
+def load_country_codes(data_id: str, _base_wide: pd.DataFrame):
+    # ({country: iso3}, unmatched names) per dataset, from the iso3 column set at normalization
+    return country_codes(_base_wide)
+
+@st.cache_resource(max_entries=MAX_CACHED_FIGURES, show_spinner=False)
+def load_similarity_index(data_id: str, disease_sel: str, year_range: tuple, _cube: dict) -> dict:
+    # One shared similar-country index per (dataset, disease metric, year range); regions narrow it at query time
+    return similarity.build_similarity_index(_cube, disease_sel, year_range)
+
+registry.on_evict(_drop_derived_caches)
+
+@st.cache_data(max_entries=MAX_CACHED_DATASETS, show_spinner=False)
+def load_memory_report(data_id: str, _base_wide: pd.DataFrame, _base_long: pd.DataFrame) -> pd.DataFrame:
+    # Held vs default-dtype memory of the loaded frames, once per dataset
+    return memory_report({"wide": _base_wide, "long": _base_long})
+
+@st.cache_resource(max_entries=MAX_CACHED_FIGURES, show_spinner=False)
+def load_figure(chart: str, data_id: str, params: tuple, _build):
+    """
+    Memoize a Plotly figure under (chart, dataset, filters/chart parameters).
+    `_build` is not hashed, so `params` must hold everything the figure depends on.
+    The figure is shared between sessions and must not be modified by callers.
+    """
+    return _build()
+
+def load_uploaded_files(data_id: str, _files):
+    """
+    Stream several uploads (xlsx/csv/parquet) through the chunked ingestion
+    layer into one dataset, shared through the registry under the combined content hash.
+    """
+    return _from_registry(data_id, lambda: ingest.load_ingested(ingest.ingest(_files, key=data_id)))
+
+@st.cache_resource(show_spinner="Loading default dataset...")
+def load_default_dataset():
+    # Preloaded and pinned once per process when DEFAULT_DATASET is set
+    return registry.preload()
+
+def export_file(data_id: str, disease_sel, regions, year_range, fmt: str, long_f: pd.DataFrame) -> str:
+    """
+    Path of the download file for one filter combination, written on first request.
+    Files are memoized on disk by filter signature, so repeated downloads (from any
+    session) are served without re-encoding; the directory is kept within
+    MAX_EXPORT_CACHE_MB by deleting the least recently used files.
+    """
+    signature = json.dumps([data_id, disease_sel, sorted(regions), list(year_range), fmt])
+    name = hashlib.sha256(signature.encode()).hexdigest()[:24] + EXPORT_FORMATS[fmt][0]
+    path = os.path.join(datastore.CACHE_DIR, "exports", name)
+    try:
+        os.utime(path)  # mark as recently used for _prune_exports
+        return path
+    except FileNotFoundError:
+        pass
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    write_export(long_f, path, fmt)
+    _prune_exports(keep=path)
+    return path
+
+def _prune_exports(keep: str):
+    # Delete the least recently used download files until the directory fits MAX_EXPORT_CACHE_MB
+    root = os.path.dirname(keep)
+    files = []
+    for entry in os.scandir(root):
+        if entry.is_file() and not entry.name.endswith(".tmp") and entry.path != keep:
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in files) + os.path.getsize(keep)
+    for _, size, path in sorted(files):
+        if total <= MAX_EXPORT_CACHE_MB * 2**20:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+
+def export_download(data_id: str, disease_sel, regions, year_range, fmt: str, long_f: pd.DataFrame):
+    """
+    Deferred data for st.download_button: nothing is encoded until the user clicks.
+    Arguments are bound now because the callable runs outside the script run.
+    The file is encoded in chunks on disk, but st.download_button serves bytes,
+    so each click still reads the finished file into memory once.
+    """
+    regions, year_range = list(regions), tuple(year_range)
+    def _data():
+        # A second attempt rewrites the file if another session pruned it in between
+        for attempt in range(2):
+            try:
+                with open(export_file(data_id, disease_sel, regions, year_range, fmt, long_f), "rb") as fh:
+                    return fh.read()
+            except FileNotFoundError:
+                if attempt:
+                    raise
+    return _data
+
+# cProfile registers one process-wide profiler (sys.monitoring on Python 3.12+), so only one
+# session profiles at a time
+_cprofile_lock = threading.Lock()
+
+def start_timing():
+    """
+    Begin the per-rerun stage trace when instrumentation is enabled (see profiling.py).
+    Returns the state finish_timing()/render_timing_panel() need, or None.
+    The caller must call finish_timing() in a `finally`, so an st.stop() or an
+    exception never leaves the profiler running.
+    """
+    if not profiling.ENABLED:
+        return None
+    timing = {"records": profiling.start_trace(), "start": time.perf_counter(), "profiler": None,
+              "total": None, "note": None}
+    if st.session_state.get("profile_cprofile"):
+        if not _cprofile_lock.acquire(blocking=False):
+            timing["note"] = "Another session is profiling; cProfile skipped for this rerun."
+            return timing
+        import cProfile
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Another profiler or monitoring tool is active in this process
+            _cprofile_lock.release()
+            timing["note"] = "cProfile is unavailable (another profiler is active in this process)."
+            return timing
+        timing["profiler"] = profiler
+    return timing
+
+def finish_timing(timing):
+    # Stop the trace and the profiler; safe to call more than once
+    if timing is None or timing["total"] is not None:
+        return
+    timing["total"] = time.perf_counter() - timing["start"]
+    profiler = timing["profiler"]
+    if profiler is not None:
+        try:
+            profiler.disable()
+        finally:
+            _cprofile_lock.release()
+        st.session_state["last_cprofile"] = profiling.profile_stats_bytes(profiler)
+    timing["records"] = profiling.stop_trace()
+
+def render_timing_panel(timing):
+    # Sidebar panel with this rerun's stage timings and trace downloads
+    if timing is None:
+        return
+    finish_timing(timing)
+    total, records = timing["total"], timing["records"]
+
+    with st.sidebar.expander("⏱️ Rerun timings", expanded=False):
+        st.caption(f"Last rerun: {total * 1000:,.0f} ms; {len(records)} timed calls (cached stages do not appear)")
+        if records:
+            summary = pd.DataFrame(profiling.summarize(records))
+            summary["ms"] = summary.pop("seconds") * 1000
+            st.dataframe(summary.sort_values("ms", ascending=False), hide_index=True, use_container_width=True,
+                         column_config={"ms": st.column_config.NumberColumn(format="%.1f"),
+                                        "rss_delta_mb": st.column_config.NumberColumn("RSS Δ MB", format="%.1f")})
+        st.download_button("Download trace (JSON)", mime="application/json", file_name="rerun_trace.json",
+                           data=profiling.to_json(records, rerun_seconds=total,
+                                                  dataset_id=st.session_state.get("dataset_id")))
+        st.checkbox("Profile reruns with cProfile", key="profile_cprofile")
+        if timing["note"]:
+            st.caption(timing["note"])
+        if "last_cprofile" in st.session_state:
+            st.download_button("Download cProfile (.prof)", data=st.session_state["last_cprofile"],
+                               file_name="rerun.prof", mime="application/octet-stream")
 
 def load_data_via_uploader():
     # Users can browse and upload; no path needed
-    uploaded = st.file_uploader("Upload the Excel file (e.g., Measles_Rubella_Final.xlsx)", type=["xlsx"])
-    if uploaded is None:
-        st.info("Please upload your Excel file to begin.")  # prompt stays until user uploads
-        st.stop()
+    uploaded = st.file_uploader("Upload the Excel file (e.g., Measles_Rubella_Final.xlsx) or CSV/Parquet extracts",
+                                type=["xlsx", "csv", "parquet"], accept_multiple_files=True)
+    if not uploaded:
+        default_id = load_default_dataset() if registry.DEFAULT_DATASET else None
+        if default_id is None:
+            st.info("Please upload your Excel file to begin.")  # prompt stays until user uploads
+            st.stop()
+        st.caption(f"Showing the default dataset ({os.path.basename(registry.DEFAULT_DATASET)}); upload a file to replace it.")
+        st.session_state["dataset_id"] = default_id
+        return _from_registry(default_id, lambda: load_workbook(default_id, registry.read_file(registry.DEFAULT_DATASET)))
     try:
-        raw = _read_excel_from_bytes(uploaded.read())
+        if len(uploaded) == 1 and uploaded[0].name.lower().endswith(".xlsx"):
+            file_bytes = uploaded[0].getvalue()
+            data_id = dataset_id(file_bytes)
+            base_wide, base_long = load_dataset(data_id, file_bytes)
+        else:
+            data_id = ingest.sources_digest(uploaded)
+            base_wide, base_long = load_uploaded_files(data_id, uploaded)
     except Exception as e:
         st.error(f"Could not read the uploaded file: {e}")
         st.stop()
-    base_wide, base_long = normalize_and_transform(raw)
+    st.session_state["dataset_id"] = data_id
     return base_wide, base_long
@@ -0,0 +1,285 @@
+# bench.py
+"""
+Performance benchmarks for the data pipeline on synthetic data.
+
+    python bench.py                        # scales 1 and 10, compared against bench_baseline.json
+    python bench.py --scales 1 10 100 --save-baseline
+    python bench.py --scales 1000 --skip excel
+    python bench.py --scales 1 --forest   # include the Isolation Forest scan (slow)
+    python bench.py --scales --startup    # time-to-first-paint of a fresh app process only
+
+synthetic_raw() produces workbooks in the Measles_Rubella_Final.xlsx schema at
+any size: more countries, sub-national units (reported as separate
+"Country / unit" rows) and more periods per unit. The schema only has a Year
+column, so finer periods such as weeks are numbered consecutively on it.
+Scale 1 matches the bundled workbook (193 countries x 14 years); scale N
+multiplies the row count by N.
+
+--startup runs app.py in fresh interpreters (Streamlit's AppTest, with the
+bundled workbook as DEFAULT_DATASET) and reports the time to the first full
+render, with an empty ("cold") and a pre-populated ("warm") dataset cache.
+
+Each stage is timed (best of --repeat) with its peak traced memory; results are
+compared against the stored baseline and stages slower than --tolerance times
+the baseline are reported as regressions (exit code 1 with --check). Timed runs
+are never traced; peak memory comes from one extra traced run. A baseline from
+a machine with another CPU count or library versions is not compared (exit
+code 2 with --check).
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+import core
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BASELINE_PATH = os.path.join(HERE, "bench_baseline.json")
+WORKBOOK = os.path.join(HERE, "Measles_Rubella_Final.xlsx")
+REGIONS = ["Afr", "Amr", "Emr", "Eur", "Sear", "Wpr"]
+# Excel tops out at ~1M rows and the per-country forests are slow; larger scales skip these
+MAX_EXCEL_ROWS = 30_000
+MAX_FOREST_ROWS = 3_000
+
+def synthetic_raw(countries: int = 193, units: int = 1, periods: int = 14, start_year: int = 2012,
+                  seed: int = 0) -> pd.DataFrame:
+    """
+    Raw frame in the workbook schema: `countries` x `units` series with `periods`
+    rows each. Case counts follow a per-series log-normal level with occasional
+    outbreak years, so rolling means, YoY and anomaly scores have work to do.
+    """
+    rng = np.random.default_rng(seed)
+    n_series = countries * units
+    names = np.array([f"Country {c:04d}" + (f" / Unit {u:02d}" if units > 1 else "")
+                      for c in range(countries) for u in range(units)])
+    regions = np.array(REGIONS)[np.arange(countries).repeat(units) % len(REGIONS)]
+    population = rng.lognormal(15, 1.5, n_series).round()
+
+    def _cases(level):
+        base = rng.lognormal(level, 1.2, n_series)[:, None] * rng.lognormal(0, 0.4, (n_series, periods))
+        outbreak = rng.random((n_series, periods)) < 0.05
+        return np.where(outbreak, base * rng.uniform(5, 20, (n_series, periods)), base).round()
+
+    measles, rubella = _cases(4.0), _cases(1.5)
+    pop = population[:, None].repeat(periods, axis=1)
+    return pd.DataFrame({
+        "Region": regions.repeat(periods),
+        "Country": names.repeat(periods),
+        "Year": np.tile(np.arange(start_year, start_year + periods), n_series),
+        "Measles_Cases": measles.ravel(),
+        "Rubella_Cases": rubella.ravel(),
+        "Population": pop.ravel(),
+        "Measles_Cases_Per_100K": (measles / pop * 1e5).ravel(),
+        "Rubella_Cases_Per_100K": (rubella / pop * 1e5).ravel(),
+    })
+
+def synthetic_scale(scale: int, seed: int = 0) -> pd.DataFrame:
+    # Spread a row multiplier over units, periods and countries (in that order)
+    units = periods = 1
+    rest = scale
+    for factor, cap in [("units", 10), ("periods", 4)]:
+        f = min(cap, rest)
+        while rest % f:
+            f -= 1
+        if factor == "units":
+            units = f
+        else:
+            periods = f
+        rest //= f
+    return synthetic_raw(countries=193 * rest, units=units, periods=14 * periods, seed=seed)
+
+def _measure(fn, repeat: int, trace: bool = True):
+    """
+    Best wall time of `repeat` untraced runs, and the peak traced memory of one
+    more run (tracemalloc slows Python-heavy code down, so it never overlaps a
+    timed run). trace=False skips the memory run and reports no peak.
+    """
+    best = None
+    for _ in range(max(repeat, 1)):
+        start = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    peak = None
+    if trace:
+        tracemalloc.start()
+        try:
+            fn()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return result, best, peak
+
+def run_scale(scale: int, repeat: int = 3, skip=(), forest: bool = False) -> dict:
+    """Benchmark every pipeline stage at one scale. Returns {stage: {"seconds", "peak_mb"}}."""
+    raw = synthetic_scale(scale)
+    results = {}
+
+    def record(stage, fn, times=repeat, trace=True):
+        out, seconds, peak = _measure(fn, times, trace)
+        results[stage] = {"seconds": round(seconds, 5), "peak_mb": None if peak is None else round(peak / 2**20, 2)}
+        return out
+
+    if "excel" not in skip and len(raw) <= MAX_EXCEL_ROWS:
+        buf = io.BytesIO()
+        raw.to_excel(buf, index=False)
+        record("read_excel", lambda: core._read_excel_from_bytes(buf.getvalue()), times=1)
+
+    base_wide, base_long = record("normalize_and_transform", lambda: core.normalize_and_transform(raw))
+    compact = record("compact_frames", lambda: core.compact_frames(base_wide, base_long))[1]
+    index = record("build_long_index", lambda: core.build_long_index(compact))
+    regions = REGIONS[:3]
+    record("apply_filters", lambda: [core.apply_filters(index, d, regions, (2014, 2020))
+                                     for d in ["Measles", "Rubella", "Both"]])
+    cube = record("build_cube", lambda: core.build_cube(compact))
+    record("cube_query", lambda: [core.cube_query(cube, by, "Both", regions, (2014, 2020))
+                                  for by in [["year"], ["country"], ["region", "year"], ["disease", "year"]]])
+    import similarity
+    sim_index = record("build_similarity", lambda: similarity.build_similarity_index(cube, "Measles", (2012, 2100)))
+    names = sim_index["countries"][:50]
+    record("similar_query", lambda: [similarity.similar(sim_index, c, k=10) for c in names])
+
+    # get_global_anomalies is the Streamlit wrapper around this scan
+    import anomaly_core
+    record("anomalies_robust", lambda: anomaly_core.scan_anomalies(base_wide, engine="robust")[0])
+    if forest and len(raw) <= MAX_FOREST_ROWS:
+        record("anomalies_isolation_forest",
+               lambda: anomaly_core.scan_anomalies(base_wide, engine="isolation_forest")[0], times=1, trace=False)
+    return {"rows": len(raw), "stages": results}
+
+_FIRST_PAINT = """
+import json, time
+start = time.perf_counter()
+from streamlit.testing.v1 import AppTest
+at = AppTest.from_file({app!r}, default_timeout=600)
+at.run()
+print(json.dumps({{"seconds": time.perf_counter() - start, "exceptions": len(at.exception)}}))
+"""
+
+def first_paint_seconds(cache_dir: str) -> float:
+    # One fresh interpreter: imports, dataset load and the first script run of app.py
+    env = dict(os.environ, DEFAULT_DATASET=WORKBOOK, DATA_CACHE_DIR=cache_dir)
+    out = subprocess.run([sys.executable, "-c", _FIRST_PAINT.format(app=os.path.join(HERE, "app.py"))],
+                         env=env, cwd=HERE, capture_output=True, text=True, check=True)
+    result = json.loads(out.stdout.strip().splitlines()[-1])
+    if result["exceptions"]:
+        raise RuntimeError("app.py raised during the startup benchmark")
+    return result["seconds"]
+
+def run_startup(repeat: int = 3) -> dict:
+    """Best time-to-first-paint of fresh app processes with a cold and a warm dataset cache."""
+    stages = {}
+    for mode in ["cold", "warm"]:
+        times = []
+        for _ in range(repeat):
+            with tempfile.TemporaryDirectory() as cache_dir:
+                if mode == "warm":
+                    subprocess.run([sys.executable, os.path.join(HERE, "cli.py"), WORKBOOK, "--warm"],
+                                   env=dict(os.environ, DATA_CACHE_DIR=cache_dir), check=True, capture_output=True)
+                times.append(first_paint_seconds(cache_dir))
+        stages[f"first_paint_{mode}"] = {"seconds": round(min(times), 5), "peak_mb": None}
+    return {"rows": None, "stages": stages}
+
+# Fields that must match for timings to be comparable (the kernel build in "platform" may differ)
+COMPARABLE_MACHINE = ("python", "pandas", "numpy", "cpus")
+
+def same_machine(a: dict, b: dict) -> bool:
+    return all((a or {}).get(k) == (b or {}).get(k) for k in COMPARABLE_MACHINE)
+
+def machine() -> dict:
+    return {"python": platform.python_version(), "pandas": pd.__version__, "numpy": np.__version__,
+            "cpus": os.cpu_count(), "platform": platform.platform()}
+
+def compare(current: dict, baseline: dict, tolerance: float) -> tuple:
+    """
+    Stages slower than tolerance x baseline as (scale, stage, baseline s, current s, ratio),
+    and the (scale, stage) pairs the baseline has no timing for, which are not checked.
+    """
+    slower, missing = [], []
+    for scale, run in current["scales"].items():
+        base = baseline.get("scales", {}).get(scale, {}).get("stages", {})
+        for stage, m in run["stages"].items():
+            b = base.get(stage)
+            if not b or not b["seconds"] > 0:
+                missing.append((scale, stage))
+            elif m["seconds"] / b["seconds"] > tolerance:
+                slower.append((scale, stage, b["seconds"], m["seconds"], m["seconds"] / b["seconds"]))
+    return slower, missing
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the data pipeline on synthetic data.")
+    parser.add_argument("--scales", type=int, nargs="*", default=[1, 10], help="Row multipliers of the bundled workbook")
+    parser.add_argument("--startup", action="store_true", help="Also time the first paint of a fresh app process")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per stage (best time is kept)")
+    parser.add_argument("--skip", nargs="*", default=[], choices=["excel"])
+    parser.add_argument("--forest", action="store_true",
+                        help=f"Also time the Isolation Forest scan (scales up to {MAX_FOREST_ROWS:,} rows)")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true", help="Store this run as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=1.5, help="Allowed slowdown vs baseline")
+    parser.add_argument("--check", action="store_true", help="Exit 1 if any stage regressed or has no baseline")
+    parser.add_argument("--json", default=None, help="Also write the results to this file")
+    args = parser.parse_args(argv)
+
+    current = {"machine": machine(), "scales": {}}
+    for scale in args.scales:
+        run = run_scale(scale, args.repeat, set(args.skip), args.forest)
+        current["scales"][str(scale)] = run
+        print(f"scale {scale} ({run['rows']:,} rows)")
+        for stage, m in run["stages"].items():
+            peak = "" if m["peak_mb"] is None else f"  {m['peak_mb']:>8.1f} MB peak"
+            print(f"  {stage:<28} {m['seconds'] * 1000:>10.1f} ms{peak}")
+    if args.startup:
+        run = run_startup(args.repeat)
+        current["scales"]["startup"] = run
+        print("startup")
+        for stage, m in run["stages"].items():
+            print(f"  {stage:<28} {m['seconds'] * 1000:>10.1f} ms")
+
+    if args.json:
+        with open(args.json, "w") as fh:
+            json.dump(current, fh, indent=2)
+    if args.save_baseline:
+        # Scales not run this time keep their previous baseline
+        saved = {"machine": current["machine"], "scales": {}}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as fh:
+                saved["scales"] = json.load(fh).get("scales", {})
+        saved["scales"].update(current["scales"])
+        with open(args.baseline, "w") as fh:
+            json.dump(saved, fh, indent=2)
+        print(f"baseline saved to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print("no baseline yet; run with --save-baseline", file=sys.stderr)
+        return 0
+    with open(args.baseline) as fh:
+        baseline = json.load(fh)
+    if not same_machine(baseline.get("machine"), current["machine"]):
+        # Timings from another CPU count or library versions are not comparable at a fixed tolerance
+        print("baseline was recorded on a different machine/library versions "
+              f"({', '.join(COMPARABLE_MACHINE)}); not comparing. Record one here with --save-baseline.",
+              file=sys.stderr)
+        return 2 if args.check else 0
+    slower, missing = compare(current, baseline, args.tolerance)
+    for scale, stage, b, c, ratio in slower:
+        print(f"REGRESSION scale {scale} {stage}: {b * 1000:.1f} ms -> {c * 1000:.1f} ms ({ratio:.2f}x)")
+    for scale, stage in missing:
+        print(f"NO BASELINE scale {scale} {stage}: not compared; record one with --save-baseline")
+    if not slower:
+        print(f"no compared stage slower than {args.tolerance}x baseline")
+    # An unchecked stage is not a passing one
+    return 1 if (slower or missing) and args.check else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,225 @@
+# charts.py
+"""
+Plotly figure builders for the overview and geographic tabs (no Streamlit).
+Each takes the aggregation cube and the filter state and returns a figure,
+or None when the selection is empty; apputil.load_figure memoizes them.
+
+Line series longer than MAX_SERIES_POINTS (about a chart's width in pixels)
+are downsampled server-side with LTTB, and figures with more than WEBGL_POINTS
+line points are drawn with WebGL (Scattergl) instead of SVG traces.
+"""
+import os
+
+import numpy as np
+import plotly.graph_objects as go
+from plotly.colors import qualitative
+
+from core import cube_query
+from profiling import timed
+
+WEBGL_POINTS = int(os.getenv("CHART_WEBGL_POINTS", "1000"))
+MAX_SERIES_POINTS = int(os.getenv("CHART_MAX_POINTS", "1200"))
+
+def lttb_indices(x: np.ndarray, y: np.ndarray, n: int) -> np.ndarray:
+    """
+    Largest-Triangle-Three-Buckets: positions of `n` points of (x, y) that keep
+    the line's visual shape. Keeps the first and last point and, from each of
+    the n - 2 buckets in between, the point forming the largest triangle with
+    the previously kept point and the next bucket's mean.
+    """
+    size = len(x)
+    if n >= size or n < 3:
+        return np.arange(size)
+    edges = np.linspace(1, size - 1, n - 1).astype(int)
+    out = np.empty(n, dtype=int)
+    out[0], out[-1] = 0, size - 1
+    a = 0
+    for i in range(n - 2):
+        lo, hi = edges[i], edges[i + 1]
+        nhi = edges[i + 2] if i + 2 < len(edges) else size
+        avg_x, avg_y = x[hi:nhi].mean(), y[hi:nhi].mean()
+        area = np.abs((x[a] - avg_x) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (avg_y - y[a]))
+        a = lo + int(area.argmax())
+        out[i + 1] = a
+    return out
+
+def downsample(df, y: str, x: str = "year", n: int = None):
+    # Rows of one series (sorted by x) thinned with LTTB on column y; other columns follow the kept rows
+    n = MAX_SERIES_POINTS if n is None else n
+    if not n or len(df) <= n:
+        return df
+    idx = lttb_indices(df[x].to_numpy(dtype="float64", na_value=np.nan),
+                       np.nan_to_num(df[y].to_numpy(dtype="float64", na_value=np.nan)), n)
+    return df.iloc[idx]
+
+def scatter_type(points: int):
+    # Scatter class for a figure with this many line points: WebGL above WEBGL_POINTS, SVG below
+    return go.Scattergl if WEBGL_POINTS and points > WEBGL_POINTS else go.Scatter
+
+def _disease_label(disease_sel: str) -> str:
+    return disease_sel if disease_sel != "Both" else "Measles + Rubella"
+
+@timed("figure:global")
+def global_trend_figure(cube: dict, disease_sel, regions, year_range, roll_window: int, show_yoy: bool):
+    # Rolling averages are precomputed per series (roll<w> columns), so the window is a column lookup
+    roll_col = f"roll{roll_window}"
+    global_agg = (cube_query(cube, ["disease","year"], disease_sel, regions, year_range)[["disease","year","value",roll_col]]
+                  .sort_values("year"))
+    if global_agg.empty:
+        return None
+    if disease_sel == "Both":
+        g = global_agg.groupby("year", as_index=False)[["value", roll_col]].sum()
+        title = "Global Cases (Measles + Rubella)"
+    else:
+        g = global_agg[global_agg["disease"]==disease_sel][["year","value",roll_col]].copy()
+        title = f"Global Cases ({disease_sel})"
+    g = g.rename(columns={roll_col: "rolling"})
+    g["yoy"] = g["value"].pct_change()
+    g = downsample(g, "value")
+    Scatter = scatter_type(len(g) * ((roll_window > 1) + show_yoy))
+
+    fig = go.Figure()
+    fig.add_trace(go.Bar(x=g["year"], y=g["value"], name="Annual Cases",
+                         marker_color="#e3f2fd", marker_line_color="#1976d2", marker_line_width=1))
+    if roll_window > 1:
+        fig.add_trace(Scatter(x=g["year"], y=g["rolling"], name=f"{roll_window}Y Rolling Avg",
+                              mode="lines+markers", line=dict(color="#d32f2f", width=3),
+                              marker=dict(size=6)))
+    if show_yoy:
+        fig.add_trace(Scatter(x=g["year"], y=g["yoy"], name="YoY Growth", mode="lines+markers",
+                              line=dict(color="#1976d2", width=2, dash="dash"),
+                              marker=dict(size=5), yaxis="y2"))
+        fig.update_layout(
+            yaxis2=dict(title="YoY Growth Rate", overlaying="y", side="right", tickformat=".0%",
+                        showgrid=False)
+        )
+    fig.update_layout(
+        title=title, height=450,
+        margin=dict(l=20,r=20,t=50,b=10),
+        yaxis=dict(title="Number of Cases"),
+        hovermode="x unified",
+        legend=dict(orientation="h", yanchor="bottom", y=1.02, xanchor="center", x=0.5)
+    )
+    return fig
+
+@timed("figure:regional")
+def regional_figure(cube: dict, disease_sel, regions, year_range, roll_window: int):
+    roll_col = f"roll{roll_window}"
+    reg_agg = (cube_query(cube, ["region","year"], disease_sel, regions, year_range)[["region","year","value",roll_col]]
+               .rename(columns={roll_col: "rolling"}).sort_values(["region","year"]))
+    if reg_agg.empty:
+        return None
+    series = [(reg, downsample(dreg, "value")) for reg, dreg in reg_agg.groupby("region", sort=False, observed=True)]
+    Scatter = scatter_type(sum(len(dreg) for _, dreg in series) * (1 + (roll_window > 1)))
+    fig = go.Figure()
+    colors = qualitative.Set2
+    for idx, (reg, dreg) in enumerate(series):
+        color = colors[idx % len(colors)]
+        # Actual values
+        fig.add_trace(Scatter(
+            x=dreg["year"], y=dreg["value"], name=reg,
+            mode="lines+markers", line=dict(color=color, width=2),
+            marker=dict(size=6)
+        ))
+        # Rolling average (dotted)
+        if roll_window > 1:
+            fig.add_trace(Scatter(
+                x=dreg["year"], y=dreg["rolling"],
+                name=f"{reg} (avg)", mode="lines",
+                line=dict(color=color, width=2, dash="dot"),
+                showlegend=False, opacity=0.6
+            ))
+
+    fig.update_layout(
+        height=450,
+        margin=dict(l=20,r=20,t=10,b=10),
+        yaxis=dict(title="Cases"),
+        xaxis=dict(title="Year"),
+        hovermode="x unified",
+        legend=dict(orientation="v", yanchor="top", y=1, xanchor="right", x=1)
+    )
+    return fig
+
+@timed("figure:comparison")
+def comparison_figure(yearly, countries):
+    """One line per country of a country/year/value frame, in the order of `countries`."""
+    series = [(c, downsample(yearly[yearly["country"] == c].sort_values("year"), "value")) for c in countries]
+    Scatter = scatter_type(sum(len(rows) for _, rows in series))
+    fig = go.Figure()
+    for country, rows in series:
+        fig.add_trace(Scatter(x=rows["year"], y=rows["value"], name=str(country), mode="lines+markers",
+                              hovertemplate="%{y:,.0f}"))
+    fig.update_layout(
+        title="Side-by-Side Country Comparison",
+        height=400,
+        xaxis=dict(title="Year"),
+        yaxis=dict(title="Cases"),
+        hovermode="x unified",
+        legend=dict(orientation="h", yanchor="bottom", y=1.02, title_text="country")
+    )
+    return fig
+
+@timed("figure:ranking")
+def ranking_figure(rank_df, top_n: int):
+    # plotly.express is the slowest Plotly import; only the geographic tab needs it
+    import plotly.express as px
+    show_top = rank_df.head(int(top_n))
+    if show_top.empty:
+        return None
+    fig = px.bar(
+        show_top, y="country", x="value",
+        orientation="h",
+        labels={"value":"Total Cases", "country":"Country"},
+        title=f"Highest reported cases in top {min(int(top_n), len(show_top))} countries",
+        color="value",
+        color_continuous_scale="Reds"
+    )
+    fig.update_layout(
+        height=600,
+        margin=dict(l=20,r=20,t=50,b=10),
+        showlegend=False,
+        yaxis=dict(autorange="reversed")
+    )
+    return fig
+
+@timed("figure:map")
+def map_figure(cube: dict, disease_sel, regions, year_range, iso3_by_country: dict):
+    """
+    Orthographic choropleth with one animation frame per year of the range.
+    Scrubbing the year slider switches frames in the browser; the figure opens on
+    the last year and keeps one colour scale across all frames.
+    """
+    import plotly.express as px
+    map_df = cube_query(cube, ["country","year"], disease_sel, regions, year_range)[["country","year","value"]]
+    map_df["iso3"] = map_df["country"].map(iso3_by_country)
+    map_df = map_df.dropna(subset=["iso3"]).astype({"country": str, "iso3": str}).sort_values(["year","country"])
+    if map_df.empty:
+        return None
+    map_df["year"] = map_df["year"].astype(int)
+
+    label = _disease_label(disease_sel)
+    # ISO-3 codes are matched exactly by Plotly, no name lookup per render
+    fig = px.choropleth(
+        map_df, locations="iso3", locationmode="ISO-3",
+        color="value", color_continuous_scale="YlOrRd",
+        range_color=(0, max(float(map_df["value"].max()), 1.0)),
+        hover_name="country", hover_data={"value":":,.0f", "iso3":False},
+        animation_frame="year",
+        labels={"value": "Cases", "year": "Year"}
+    )
+    for frame in fig.frames:
+        frame.layout = go.Layout(title_text=f"{label} Cases in {frame.name}")
+    last = fig.frames[-1]
+    fig.update(data=last.data)
+    fig.update_layout(
+        title=f"{label} Cases in {last.name}",
+        height=600,
+        margin=dict(l=20,r=20,t=50,b=10),
+        geo=dict(showframe=True, framecolor="#1976d2", framewidth=2, showcoastlines=True, projection_type='orthographic')
+    )
+    if fig.layout.sliders:
+        fig.layout.sliders[0].active = len(fig.frames) - 1
+    fig.update_traces(marker_line_width=1.0, marker_line_color="#333333")
+    for frame in fig.frames:
+        frame.data[0].marker.line = dict(width=1.0, color="#333333")
+    return fig
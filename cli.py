@@ -0,0 +1,196 @@
+# cli.py
+"""
+Headless batch runner for the dashboard pipeline (no Streamlit import).
+
+    python cli.py Measles_Rubella_Final.xlsx --out exports --anomalies
+    python cli.py weekly_*.csv extra.parquet --stream --name weekly --out exports
+
+For every workbook it writes, under <out>/<workbook name>/:
+  wide, long                          normalized tables
+  agg_global, agg_region, agg_country aggregation cube levels
+  anomalies                           global anomaly scan (with --anomalies)
+
+With --stream all inputs (xlsx/csv/parquet) are combined into one dataset
+through the chunked ingestion layer (ingest.py) and processed one country
+bucket at a time; wide, long and anomalies are then written as part files.
+"""
+import argparse
+import os
+import sys
+import time
+
+import pandas as pd
+
+import core
+import ingest
+import profiling
+
+def _write(df: pd.DataFrame, path: str, fmt: str) -> str:
+    if fmt == "csv":
+        path += ".csv"
+        df.to_csv(path, index=False)
+    else:
+        path += ".parquet"
+        df.to_parquet(path, index=False)
+    return path
+
+def run_workbook(path: str, out_dir: str, fmt: str = "parquet", anomalies: bool = False,
+                 contamination: float = 0.1, engine: str = None, n_jobs: int = None, incremental: bool = False) -> dict:
+    """
+    Run the full pipeline for one workbook and write its outputs.
+    Returns {output name: file path}.
+    """
+    with open(path, "rb") as fh:
+        file_bytes = fh.read()
+    base_wide, base_long = core.load_workbook(core.dataset_id(file_bytes), file_bytes)
+
+    cube = core.build_cube(base_long)
+    region_year = cube["region_year"]["df"]
+    tables = {
+        "wide": base_wide,
+        "long": base_long,
+        "agg_global": region_year.groupby(["disease","year"], as_index=False, observed=True)[cube["measures"]].sum(),
+        "agg_region": region_year,
+        "agg_country": cube["cell"]["df"],
+    }
+
+    _, unmatched = core.country_codes(base_wide)
+    if unmatched:
+        print(f"  no ISO-3 code for {len(unmatched)} countries: {', '.join(unmatched)}", file=sys.stderr)
+
+    if anomalies:
+        # Imported lazily so plain exports never pay for scikit-learn
+        import anomaly_core
+        engine = engine or anomaly_core.DEFAULT_ENGINE
+        # Keyed by workbook name, not content hash, so next run's extended workbook finds this state
+        state_name = f"anomaly_state-{os.path.splitext(os.path.basename(path))[0]}-{engine}"
+        state = anomaly_core.load_anomaly_state(state_name) if incremental else None
+        tables["anomalies"], skipped = anomaly_core.scan_anomalies(
+            base_wide, contamination, n_jobs=n_jobs, engine=engine, state=state)
+        if incremental:
+            anomaly_core.save_anomaly_state(state, state_name)
+        if skipped:
+            print(f"  skipped {len(skipped)} countries with fewer than 3 years of data", file=sys.stderr)
+
+    target = os.path.join(out_dir, os.path.splitext(os.path.basename(path))[0])
+    os.makedirs(target, exist_ok=True)
+    return {name: _write(df, os.path.join(target, name), fmt) for name, df in tables.items()}
+
+def run_stream(paths, out_dir: str, name: str, fmt: str = "parquet", anomalies: bool = False,
+               contamination: float = 0.1, engine: str = None, n_jobs: int = None,
+               chunksize: int = ingest.CHUNK_ROWS) -> dict:
+    """
+    Ingest all `paths` as one dataset with bounded memory and write its outputs.
+    Returns {output name: file path or directory}.
+    """
+    key = ingest.ingest(paths, chunksize=chunksize)
+    target = os.path.join(out_dir, name)
+    written = {}
+    for part in ["wide", "long"] + (["anomalies"] if anomalies else []):
+        os.makedirs(os.path.join(target, part), exist_ok=True)
+        written[part] = os.path.join(target, part)
+
+    if anomalies:
+        import anomaly_core
+        engine = engine or anomaly_core.DEFAULT_ENGINE
+
+    # Every bucket holds whole countries, so cells concatenate and region roll-ups just re-sum
+    cells, region_years, measures = [], [], None
+    for i, (wide, long_df) in enumerate(zip(ingest.iter_store(key, "wide"), ingest.iter_store(key, "long"))):
+        _write(wide, os.path.join(target, "wide", f"part-{i:03d}"), fmt)
+        _write(long_df, os.path.join(target, "long", f"part-{i:03d}"), fmt)
+        cube = core.build_cube(long_df)
+        measures = cube["measures"]
+        cells.append(cube["cell"]["df"])
+        region_years.append(cube["region_year"]["df"])
+        if anomalies:
+            scored, _ = anomaly_core.scan_anomalies(wide, contamination, n_jobs=n_jobs, engine=engine)
+            _write(scored, os.path.join(target, "anomalies", f"part-{i:03d}"), fmt)
+
+    if measures is not None:
+        agg_region = (pd.concat(region_years, ignore_index=True)
+                      .astype({c: "object" for c in ["disease", "region"]})
+                      .groupby(["disease","region","year"], as_index=False)[measures].sum())
+        tables = {
+            "agg_global": agg_region.groupby(["disease","year"], as_index=False)[measures].sum(),
+            "agg_region": agg_region,
+            "agg_country": pd.concat(cells, ignore_index=True),
+        }
+        for table, df in tables.items():
+            written[table] = _write(df, os.path.join(target, table), fmt)
+    return written
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Normalize measles/rubella workbooks and export tables without the web app.")
+    parser.add_argument("workbooks", nargs="+", help="One or more .xlsx files (or .csv/.parquet with --stream)")
+    parser.add_argument("--out", default="exports", help="Output directory (default: exports)")
+    parser.add_argument("--format", choices=["parquet", "csv"], default="parquet")
+    parser.add_argument("--anomalies", action="store_true", help="Also run the global anomaly scan")
+    parser.add_argument("--contamination", type=float, default=0.1)
+    parser.add_argument("--engine", default=None, help="Anomaly engine (isolation_forest or robust)")
+    parser.add_argument("--jobs", type=int, default=None, help="Worker processes for the anomaly scan (default: ANOMALY_WORKERS, else the available CPUs, at most 4)")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Reuse saved anomaly models and only score newly appended years")
+    parser.add_argument("--stream", action="store_true",
+                        help="Combine all inputs (xlsx/csv/parquet) into one dataset using chunked ingestion")
+    parser.add_argument("--name", default=None, help="Dataset name for --stream output (default: first input name)")
+    parser.add_argument("--chunksize", type=int, default=ingest.CHUNK_ROWS, help="Rows per chunk for --stream")
+    parser.add_argument("--warm", action="store_true",
+                        help="Only load the workbooks into the dataset cache (e.g. during an image build); write no outputs")
+    parser.add_argument("--trace", default=None, help="Write per-stage timings (JSON) to this file")
+    parser.add_argument("--cprofile", default=None, help="Write a cProfile dump (.prof) of the run to this file")
+    args = parser.parse_args(argv)
+
+    if args.trace:
+        profiling.ENABLED = True
+        profiling.start_trace()
+    profiler = None
+    if args.cprofile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        return _run(args)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.cprofile)
+        if args.trace:
+            with open(args.trace, "w") as fh:
+                fh.write(profiling.to_json(profiling.stop_trace(), argv=sys.argv[1:]))
+
+def _run(args) -> int:
+
+    if args.stream:
+        name = args.name or os.path.splitext(os.path.basename(args.workbooks[0]))[0]
+        start = time.perf_counter()
+        written = run_stream(args.workbooks, args.out, name, args.format, args.anomalies, args.contamination,
+                             args.engine, args.jobs, args.chunksize)
+        print(f"{len(args.workbooks)} inputs: wrote {len(written)} outputs to {os.path.join(args.out, name)} "
+              f"in {time.perf_counter() - start:.1f}s")
+        return 0
+
+    if args.warm:
+        for path in args.workbooks:
+            with open(path, "rb") as fh:
+                file_bytes = fh.read()
+            core.load_workbook(core.dataset_id(file_bytes), file_bytes)
+            print(f"{path}: cached")
+        return 0
+
+    status = 0
+    for path in args.workbooks:
+        start = time.perf_counter()
+        try:
+            written = run_workbook(path, args.out, args.format, args.anomalies, args.contamination,
+                                   args.engine, args.jobs, args.incremental)
+        except Exception as e:
+            print(f"{path}: failed: {e}", file=sys.stderr)
+            status = 1
+            continue
+        print(f"{path}: wrote {len(written)} tables to {os.path.dirname(next(iter(written.values())))} "
+              f"in {time.perf_counter() - start:.1f}s")
+    return status
+
+if __name__ == "__main__":
+    sys.exit(main())
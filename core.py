@@ -0,0 +1,357 @@
+# core.py
+"""
+Streamlit-free data pipeline shared by the dashboard (apputil.py) and the
+batch CLI (cli.py): workbook parsing, normalization, rolling/YoY features,
+the indexed filter and the aggregation cube.
+"""
+import io
+import os
+import gzip
+import hashlib
+import pandas as pd
+import numpy as np
+import datastore
+import countries
+from profiling import timed, stage
+
+# Rolling windows (years) precomputed as roll<w> columns; the sidebar offers exactly these
+ROLL_WINDOWS = (1, 3, 5, 7)
+# Store loaded datasets with compact dtypes (see compact_frames); COMPACT_FRAMES=0 keeps the wide dtypes
+COMPACT_FRAMES = os.getenv("COMPACT_FRAMES", "1") != "0"
+
+@timed("excel_read")
+def _read_excel_from_bytes(file_bytes: bytes) -> pd.DataFrame:
+    return pd.read_excel(io.BytesIO(file_bytes))
+
+@timed("build_index")
+def build_long_index(long_df: pd.DataFrame) -> dict:
+    """
+    Pre-index the long frame for filtering: categorical disease/region/country,
+    rows sorted by (disease, region, year) and the row offsets of every
+    (disease, region) block. Build once per dataset and pass to apply_filters.
+    """
+    df = long_df.astype({c: "category" for c in ["disease","region","country"] if c in long_df.columns})
+    df = df.sort_values(["disease","region","year"], kind="mergesort").reset_index(drop=True)
+    years = df["year"].to_numpy(dtype="float64", na_value=np.nan)
+
+    blocks = {}
+    if len(df):
+        dis = df["disease"].cat.codes.to_numpy()
+        reg = df["region"].cat.codes.to_numpy()
+        change = np.flatnonzero((dis[1:] != dis[:-1]) | (reg[1:] != reg[:-1])) + 1
+        for start, end in zip(np.r_[0, change], np.r_[change, len(df)]):
+            blocks[(df["disease"].iat[start], df["region"].iat[start])] = (int(start), int(end))
+    return {"df": df, "years": years, "blocks": blocks}
+
+@timed("filter")
+def apply_filters(long_index: dict, disease_sel, regions, year_range) -> pd.DataFrame:
+    """
+    Filter a build_long_index() result by disease, region and inclusive year range.
+    Each (disease, region) block is narrowed to the year range with a binary
+    search; adjacent blocks are merged so the common cases return a slice view.
+    """
+    diseases = {"Measles","Rubella"} if disease_sel == "Both" else {disease_sel}
+    regions = set(regions) if regions else None
+    years = long_index["years"]
+
+    ranges = []
+    for (dis, reg), (start, end) in long_index["blocks"].items():
+        if dis not in diseases or (regions is not None and reg not in regions):
+            continue
+        lo = start + int(np.searchsorted(years[start:end], year_range[0], side="left"))
+        hi = start + int(np.searchsorted(years[start:end], year_range[1], side="right"))
+        if lo >= hi:
+            continue
+        if ranges and ranges[-1][1] == lo:
+            ranges[-1][1] = hi
+        else:
+            ranges.append([lo, hi])
+
+    df = long_index["df"]
+    if not ranges:
+        return df.iloc[0:0]
+    if len(ranges) == 1:
+        return df.iloc[ranges[0][0]:ranges[0][1]]
+    return df.take(np.concatenate([np.arange(lo, hi) for lo, hi in ranges]))
+
+def cube_measures(long_df: pd.DataFrame) -> list:
+    # Additive columns of the long frame: the value, its rolling means and a non-null count
+    return ["value"] + [c for c in long_df.columns if c.startswith("roll")] + ["count"]
+
+@timed("build_cube")
+def build_cube(long_df: pd.DataFrame) -> dict:
+    """
+    Pre-aggregate the long frame once per dataset.
+    "cell" holds sums by (disease, region, country, year); "region_year" rolls
+    that up to (disease, region, year). Both are indexed like build_long_index,
+    so cube_query can filter them with apply_filters.
+    """
+    measures = cube_measures(long_df)
+    # Sum in float64 even when the frame holds float32 measures
+    df = long_df.assign(count=long_df["value"].notna().astype("int64")).astype({m: "float64" for m in measures if m != "count"})
+    cell = df.groupby(["disease","region","country","year"], as_index=False, observed=True)[measures].sum()
+    region_year = cell.groupby(["disease","region","year"], as_index=False, observed=True)[measures].sum()
+    return {
+        "measures": measures,
+        "cell": build_long_index(cell),
+        "region_year": build_long_index(region_year),
+    }
+
+def cube_query(cube: dict, by, disease_sel, regions, year_range, countries=None) -> pd.DataFrame:
+    """
+    Sum the cube measures grouped by `by` for one filter combination.
+    Uses the small region_year roll-up unless country detail is needed.
+    `by=[]` returns a single-row total.
+    """
+    by = list(by)
+    with stage(f"aggregate:{'+'.join(by) or 'total'}") as rec:
+        coarse = countries is None and set(by) <= {"disease","region","year"}
+        df = apply_filters(cube["region_year" if coarse else "cell"], disease_sel, regions, year_range)
+        if countries is not None:
+            df = df[df["country"].isin(countries)]
+        if not by:
+            out = df[cube["measures"]].sum().to_frame().T
+        else:
+            out = df.groupby(by, as_index=False, observed=True)[cube["measures"]].sum()
+        if rec is not None:
+            rec.update(rows_in=len(df), rows_out=len(out))
+        return out
+
+def _segment_positions(df: pd.DataFrame, keys) -> np.ndarray:
+    # Position of each row inside its (already sorted) key group: 0, 1, 2, ...
+    n = len(df)
+    idx = np.arange(n)
+    if n == 0:
+        return idx
+    starts = np.zeros(n, dtype=bool)
+    starts[0] = True
+    for k in keys:
+        col = df[k].to_numpy()
+        starts[1:] |= col[1:] != col[:-1]
+    return idx - np.maximum.accumulate(np.where(starts, idx, 0))
+
+def _lag(values: np.ndarray, pos: np.ndarray, k: int) -> np.ndarray:
+    # values shifted k rows down, NaN where the lag would cross into the previous series
+    out = np.full(len(values), np.nan)
+    if k < len(values):
+        out[k:] = values[:len(values) - k]
+    out[pos < k] = np.nan
+    return out
+
+def add_rolls_yoy(long_df: pd.DataFrame, keys, windows=ROLL_WINDOWS) -> pd.DataFrame:
+    """
+    Add roll<w> (trailing mean, min_periods=1) and yoy columns for every series
+    identified by `keys`, in one vectorized pass over all series.
+    Output rows are sorted by keys + year, matching a per-group rolling/shift.
+    """
+    out = long_df.sort_values(list(keys) + ["year"], kind="mergesort")
+    values = out["value"].to_numpy(dtype="float64", na_value=np.nan)
+    pos = _segment_positions(out, keys)
+    lags = [values] + [_lag(values, pos, k) for k in range(1, max(windows, default=1))]
+
+    # Running nan-aware sums over lags 0..w-1 give every trailing window at once
+    total = np.zeros(len(values))
+    count = np.zeros(len(values))
+    for k, lagged in enumerate(lags, start=1):
+        ok = ~np.isnan(lagged)
+        total += np.where(ok, lagged, 0.0)
+        count += ok
+        if k in windows:
+            with np.errstate(invalid="ignore", divide="ignore"):
+                out[f"roll{k}"] = np.where(count > 0, total / count, np.nan)
+
+    prev = lags[1] if len(lags) > 1 else _lag(values, pos, 1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        out["yoy"] = np.where(~np.isnan(prev) & (prev != 0), values / prev - 1, np.nan)
+    return out
+
+# Source column names -> normalized names, shared by every ingestion path
+COLUMN_MAP = {
+    "Region":"region","Country":"country","Year":"year",
+    "Measles_Cases":"measles","Rubella_Cases":"rubella",
+    "Population":"population",
+    "Measles_Cases_Per_100K":"measles_per100k",
+    "Rubella_Cases_Per_100K":"rubella_per100k",
+}
+NUMERIC_COLUMNS = ["measles","rubella","population","measles_per100k","rubella_per100k"]
+
+def normalize_wide(df: pd.DataFrame) -> pd.DataFrame:
+    # Standardize columns (idempotent, so already-normalized chunks pass through)
+    df = df.rename(columns=COLUMN_MAP)
+    for c in ["region","country"]:
+        df[c] = df[c].astype(str).str.strip()
+    df["year"] = pd.to_numeric(df["year"], errors="coerce").astype("Int64")
+    for c in NUMERIC_COLUMNS:
+        if c in df.columns:
+            df[c] = pd.to_numeric(df[c], errors="coerce")
+    return df
+
+@timed("normalize")
+def normalize_and_transform(df: pd.DataFrame, windows=ROLL_WINDOWS):
+    df = normalize_wide(df)
+
+    # ISO-3 code per country for the map, resolved once per distinct name
+    iso3, _ = countries.iso3_lookup(df["country"].unique())
+    df["iso3"] = df["country"].map(iso3)
+
+    # Build long-form totals
+    measles_long = df[["region","country","year","measles"]].rename(columns={"measles":"value"}).assign(disease="Measles")
+    rubella_long = df[["region","country","year","rubella"]].rename(columns={"rubella":"value"}).assign(disease="Rubella")
+    long_df = pd.concat([measles_long, rubella_long], ignore_index=True)
+
+    # Rolling averages and YoY per country+disease
+    long_df = add_rolls_yoy(long_df, ["country","disease"], windows)
+
+    # Optional per-100k variants
+    extras = []
+    if "measles_per100k" in df.columns:
+        m100 = df[["region","country","year","measles_per100k"]].rename(columns={"measles_per100k":"value"}).assign(disease="Measles_per100k")
+        extras.append(add_rolls_yoy(m100, ["country"], windows))
+    if "rubella_per100k" in df.columns:
+        r100 = df[["region","country","year","rubella_per100k"]].rename(columns={"rubella_per100k":"value"}).assign(disease="Rubella_per100k")
+        extras.append(add_rolls_yoy(r100, ["country"], windows))
+    if extras:
+        long_df = pd.concat([long_df] + extras, ignore_index=True)
+
+    return df, long_df
+
+# Download formats: label -> (file extension, MIME type)
+EXPORT_FORMATS = {
+    "CSV": (".csv", "text/csv"),
+    "CSV (gzip)": (".csv.gz", "application/gzip"),
+    "Parquet": (".parquet", "application/vnd.apache.parquet"),
+}
+EXPORT_CHUNK_ROWS = 100_000
+
+@timed("export")
+def write_export(long_f: pd.DataFrame, path: str, fmt: str = "CSV", chunk_rows: int = EXPORT_CHUNK_ROWS) -> str:
+    """
+    Write a filtered long frame to `path` in one of EXPORT_FORMATS, sorted like
+    the dashboard table. Text formats are encoded `chunk_rows` at a time, so a
+    large selection is never held as one CSV string; the file appears atomically.
+    """
+    df = long_f.sort_values(["country","region","disease","year"])
+    with datastore.atomic_path(path) as tmp:
+        if fmt == "Parquet":
+            df.to_parquet(tmp, index=False, row_group_size=chunk_rows)
+        else:
+            opener = gzip.open if fmt == "CSV (gzip)" else open
+            with opener(tmp, "wt", encoding="utf-8", newline="") as fh:
+                for start in range(0, max(len(df), 1), chunk_rows):
+                    df.iloc[start:start + chunk_rows].to_csv(fh, header=start == 0, index=False)
+    return path
+
+# Float columns that stay float64 when compacted (values beyond float32's ~7 significant digits)
+WIDE_PRECISE_COLUMNS = {"population"}
+
+def _shared_categories(frames, columns) -> dict:
+    """
+    One CategoricalDtype per column from the values that column actually holds
+    across `frames`, so wide and long share categories and no row loses its
+    label (e.g. a country reported under two regions keeps both).
+    """
+    cats = {}
+    for c in columns:
+        values = set()
+        for df in frames:
+            if c in df.columns:
+                values.update(df[c].dropna().unique())
+        if values:
+            cats[c] = pd.CategoricalDtype(sorted(values))
+    return cats
+
+@timed("compact")
+def compact_frames(base_wide: pd.DataFrame, base_long: pd.DataFrame):
+    """
+    Memory-lean copies of a normalized dataset: region/country/iso3 as
+    categoricals shared by both frames, other text columns (disease) as their
+    own categoricals, Int16 years, float32 metrics (case counts stay exact up
+    to 16.7M; see WIDE_PRECISE_COLUMNS) and the smallest integer type for
+    integer columns.
+    Returns (base_wide, base_long).
+    """
+    cats = _shared_categories([base_wide, base_long], ["country", "region", "iso3"])
+
+    def _compact(df, precise=()):
+        out = {}
+        for c in df.columns:
+            col = df[c]
+            if c in cats:
+                out[c] = col.astype(cats[c])
+            elif c == "year":
+                out[c] = col.astype("Int16")
+            elif col.dtype == object:
+                out[c] = col.astype("category")
+            elif pd.api.types.is_float_dtype(col) and c not in precise:
+                out[c] = col.astype("float32")
+            elif pd.api.types.is_integer_dtype(col) and c not in precise:
+                out[c] = pd.to_numeric(col, downcast="integer")
+            else:
+                out[c] = col
+        return pd.DataFrame(out, index=df.index)
+
+    return _compact(base_wide, WIDE_PRECISE_COLUMNS), _compact(base_long)
+
+def _expanded(df: pd.DataFrame) -> pd.DataFrame:
+    # The default (non-compact) dtypes of a frame, for comparison in memory_report
+    out = {}
+    for c in df.columns:
+        col = df[c]
+        if isinstance(col.dtype, pd.CategoricalDtype):
+            out[c] = col.astype(object)
+        elif c == "year":
+            out[c] = col.astype("Int64")
+        elif pd.api.types.is_float_dtype(col):
+            out[c] = col.astype("float64")
+        elif pd.api.types.is_integer_dtype(col):
+            out[c] = col.astype("int64")
+        else:
+            out[c] = col
+    return pd.DataFrame(out, index=df.index)
+
+def memory_report(frames: dict) -> pd.DataFrame:
+    """
+    Deep memory use of each named frame as held and with the default dtypes.
+    Columns: frame, rows, held_mb, default_mb, saved (fraction of default).
+    """
+    rows = []
+    for name, df in frames.items():
+        held = df.memory_usage(deep=True).sum()
+        default = _expanded(df).memory_usage(deep=True).sum()
+        rows.append({"frame": name, "rows": len(df), "held_mb": held / 2**20, "default_mb": default / 2**20,
+                     "saved": 1 - held / default if default else 0.0})
+    return pd.DataFrame(rows)
+
+def country_codes(base_wide: pd.DataFrame):
+    """
+    Country -> ISO-3 table of a normalized dataset.
+    Returns ({country: iso3}, sorted list of countries without a code).
+    """
+    pairs = base_wide[["country","iso3"]].drop_duplicates("country")
+    matched = pairs.dropna(subset=["iso3"])
+    return dict(zip(matched["country"], matched["iso3"])), sorted(pairs.loc[pairs["iso3"].isna(), "country"])
+
+def dataset_id(file_bytes: bytes) -> str:
+    # Content hash of the upload; identical workbooks map to the same cached dataset
+    return hashlib.sha256(file_bytes).hexdigest()
+
+def _store_key(data_id: str) -> str:
+    # Different rolling windows and dtypes produce different frames, so they are part of the key
+    # (-c2: compacted frames from before region categories were built per column are not reused)
+    return f"{data_id}-r{'.'.join(str(w) for w in ROLL_WINDOWS)}{'-c2' if COMPACT_FRAMES else ''}"
+
+def load_workbook(data_id: str, file_bytes: bytes):
+    """
+    Parse and normalize a workbook, going through the on-disk columnar cache.
+    Returns (base_wide, base_long).
+    """
+    key = _store_key(data_id)
+    cached = datastore.load(key)
+    if cached is not None:
+        return cached
+    raw = _read_excel_from_bytes(file_bytes)
+    base_wide, base_long = normalize_and_transform(raw)
+    if COMPACT_FRAMES:
+        base_wide, base_long = compact_frames(base_wide, base_long)
+    datastore.save(key, base_wide, base_long)
+    return base_wide, base_long
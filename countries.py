@@ -0,0 +1,126 @@
+# countries.py
+"""
+Country name -> ISO 3166-1 alpha-3 resolution for the choropleth.
+
+Names are matched after a light normalization (case, accents, punctuation,
+"The" prefixes/suffixes, "St." abbreviations); WHO and World Bank naming
+variants that still differ are listed in ALIASES. Anything left over is
+reported by iso3_lookup instead of silently falling off the map.
+"""
+import re
+import unicodedata
+
+ISO3 = {
+    "Afghanistan":"AFG","Albania":"ALB","Algeria":"DZA","Andorra":"AND","Angola":"AGO",
+    "Antigua and Barbuda":"ATG","Argentina":"ARG","Armenia":"ARM","Australia":"AUS","Austria":"AUT",
+    "Azerbaijan":"AZE","Bahamas":"BHS","Bahrain":"BHR","Bangladesh":"BGD","Barbados":"BRB",
+    "Belarus":"BLR","Belgium":"BEL","Belize":"BLZ","Benin":"BEN","Bhutan":"BTN",
+    "Bolivia":"BOL","Bosnia and Herzegovina":"BIH","Botswana":"BWA","Brazil":"BRA","Brunei":"BRN",
+    "Bulgaria":"BGR","Burkina Faso":"BFA","Burundi":"BDI","Cabo Verde":"CPV","Cambodia":"KHM",
+    "Cameroon":"CMR","Canada":"CAN","Central African Republic":"CAF","Chad":"TCD","Chile":"CHL",
+    "China":"CHN","Colombia":"COL","Comoros":"COM","Democratic Republic of the Congo":"COD","Congo":"COG",
+    "Cook Islands":"COK","Costa Rica":"CRI","Cote d'Ivoire":"CIV","Croatia":"HRV","Cuba":"CUB",
+    "Cyprus":"CYP","Czechia":"CZE","Denmark":"DNK","Djibouti":"DJI","Dominica":"DMA",
+    "Dominican Republic":"DOM","Ecuador":"ECU","Egypt":"EGY","El Salvador":"SLV","Equatorial Guinea":"GNQ",
+    "Eritrea":"ERI","Estonia":"EST","Eswatini":"SWZ","Ethiopia":"ETH","Fiji":"FJI",
+    "Finland":"FIN","France":"FRA","Gabon":"GAB","Gambia":"GMB","Georgia":"GEO",
+    "Germany":"DEU","Ghana":"GHA","Greece":"GRC","Grenada":"GRD","Guatemala":"GTM",
+    "Guinea":"GIN","Guinea-Bissau":"GNB","Guyana":"GUY","Haiti":"HTI","Honduras":"HND",
+    "Hungary":"HUN","Iceland":"ISL","India":"IND","Indonesia":"IDN","Iran":"IRN",
+    "Iraq":"IRQ","Ireland":"IRL","Israel":"ISR","Italy":"ITA","Jamaica":"JAM",
+    "Japan":"JPN","Jordan":"JOR","Kazakhstan":"KAZ","Kenya":"KEN","Kiribati":"KIR",
+    "North Korea":"PRK","South Korea":"KOR","Kuwait":"KWT","Kyrgyzstan":"KGZ","Laos":"LAO",
+    "Latvia":"LVA","Lebanon":"LBN","Lesotho":"LSO","Liberia":"LBR","Libya":"LBY",
+    "Liechtenstein":"LIE","Lithuania":"LTU","Luxembourg":"LUX","Madagascar":"MDG","Malawi":"MWI",
+    "Malaysia":"MYS","Maldives":"MDV","Mali":"MLI","Malta":"MLT","Marshall Islands":"MHL",
+    "Mauritania":"MRT","Mauritius":"MUS","Mexico":"MEX","Micronesia":"FSM","Moldova":"MDA",
+    "Monaco":"MCO","Mongolia":"MNG","Montenegro":"MNE","Morocco":"MAR","Mozambique":"MOZ",
+    "Myanmar":"MMR","Namibia":"NAM","Nauru":"NRU","Nepal":"NPL","Netherlands":"NLD",
+    "New Zealand":"NZL","Nicaragua":"NIC","Niger":"NER","Nigeria":"NGA","Niue":"NIU",
+    "North Macedonia":"MKD","Norway":"NOR","Oman":"OMN","Pakistan":"PAK","Palau":"PLW",
+    "Palestine":"PSE","Panama":"PAN","Papua New Guinea":"PNG","Paraguay":"PRY","Peru":"PER",
+    "Philippines":"PHL","Poland":"POL","Portugal":"PRT","Qatar":"QAT","Romania":"ROU",
+    "Russia":"RUS","Rwanda":"RWA","Saint Kitts and Nevis":"KNA","Saint Lucia":"LCA",
+    "Saint Vincent and the Grenadines":"VCT","Samoa":"WSM","San Marino":"SMR","Sao Tome and Principe":"STP",
+    "Saudi Arabia":"SAU","Senegal":"SEN","Serbia":"SRB","Seychelles":"SYC","Sierra Leone":"SLE",
+    "Singapore":"SGP","Slovakia":"SVK","Slovenia":"SVN","Solomon Islands":"SLB","Somalia":"SOM",
+    "South Africa":"ZAF","South Sudan":"SSD","Spain":"ESP","Sri Lanka":"LKA","Sudan":"SDN",
+    "Suriname":"SUR","Sweden":"SWE","Switzerland":"CHE","Syria":"SYR","Tajikistan":"TJK",
+    "Tanzania":"TZA","Thailand":"THA","Timor-Leste":"TLS","Togo":"TGO","Tonga":"TON",
+    "Trinidad and Tobago":"TTO","Tunisia":"TUN","Turkiye":"TUR","Turkmenistan":"TKM","Tuvalu":"TUV",
+    "Uganda":"UGA","Ukraine":"UKR","United Arab Emirates":"ARE","United Kingdom":"GBR","United States":"USA",
+    "Uruguay":"URY","Uzbekistan":"UZB","Vanuatu":"VUT","Venezuela":"VEN","Viet Nam":"VNM",
+    "Yemen":"YEM","Zambia":"ZMB","Zimbabwe":"ZWE",
+    # Territories that appear in some WHO extracts
+    "Kosovo":"XKX","Taiwan":"TWN","Hong Kong":"HKG","Macao":"MAC","Puerto Rico":"PRI",
+    "Greenland":"GRL","Western Sahara":"ESH","Anguilla":"AIA","Aruba":"ABW","Bermuda":"BMU",
+    "British Virgin Islands":"VGB","Cayman Islands":"CYM","Curacao":"CUW","Montserrat":"MSR",
+    "Turks and Caicos Islands":"TCA","Tokelau":"TKL","French Guiana":"GUF","Guadeloupe":"GLP",
+    "Martinique":"MTQ","Reunion":"REU","Mayotte":"MYT","New Caledonia":"NCL","French Polynesia":"PYF",
+    "Guam":"GUM","American Samoa":"ASM","Northern Mariana Islands":"MNP","Faroe Islands":"FRO",
+}
+
+# WHO / World Bank / UN spellings -> ISO3 keys
+ALIASES = {
+    "Brunei Darussalam":"Brunei",
+    "Congo, Dem. Rep.":"Democratic Republic of the Congo",
+    "Democratic Republic of Congo":"Democratic Republic of the Congo",
+    "Congo, Rep.":"Congo","Republic of the Congo":"Congo","Republic of Congo":"Congo",
+    "Ivory Coast":"Cote d'Ivoire","Cape Verde":"Cabo Verde",
+    "Czech Republic":"Czechia","Swaziland":"Eswatini",
+    "Egypt, Arab Rep.":"Egypt",
+    "Iran, Islamic Rep.":"Iran","Iran (Islamic Republic of)":"Iran",
+    "Korea, Dem. People's Rep.":"North Korea","Democratic People's Republic of Korea":"North Korea",
+    "Korea, Rep.":"South Korea","Republic of Korea":"South Korea",
+    "Kyrgyz Republic":"Kyrgyzstan",
+    "Lao PDR":"Laos","Lao People's Democratic Republic":"Laos",
+    "Micronesia, Fed. Sts.":"Micronesia","Micronesia (Federated States of)":"Micronesia",
+    "Republic of Moldova":"Moldova","The former Yugoslav Republic of Macedonia":"North Macedonia",
+    "Macedonia":"North Macedonia",
+    "Russian Federation":"Russia",
+    "Slovak Republic":"Slovakia",
+    "Somalia, Fed. Rep.":"Somalia",
+    "Syrian Arab Republic":"Syria",
+    "United Republic of Tanzania":"Tanzania",
+    "Turkey":"Turkiye","Türkiye":"Turkiye",
+    "United Kingdom of Great Britain and Northern Ireland":"United Kingdom",
+    "United States of America":"United States","USA":"United States",
+    "Venezuela, RB":"Venezuela","Venezuela (Bolivarian Republic of)":"Venezuela",
+    "Bolivia (Plurinational State of)":"Bolivia",
+    "Vietnam":"Viet Nam",
+    "Yemen, Rep.":"Yemen",
+    "East Timor":"Timor-Leste",
+    "Burma":"Myanmar",
+    "West Bank and Gaza":"Palestine","occupied Palestinian territory":"Palestine",
+    "Hong Kong SAR, China":"Hong Kong","Macao SAR, China":"Macao",
+}
+
+def _key(name: str) -> str:
+    # Case/accent/punctuation-insensitive form used for matching
+    s = unicodedata.normalize("NFKD", str(name)).encode("ascii", "ignore").decode().lower()
+    s = s.replace("&", " and ")
+    s = re.sub(r"\bst\b\.?", "saint", s)
+    s = re.sub(r"[^a-z0-9]+", " ", s).strip()
+    s = re.sub(r"^the ", "", s)
+    return re.sub(r" the$", "", s)
+
+_LOOKUP = {_key(name): code for name, code in ISO3.items()}
+_LOOKUP.update({_key(alias): ISO3[target] for alias, target in ALIASES.items()})
+
+def to_iso3(name):
+    """ISO-3 code for one country name, or None when it is not recognized."""
+    return _LOOKUP.get(_key(name))
+
+def iso3_lookup(names):
+    """
+    Resolve every distinct name once.
+    Returns ({name: iso3}, sorted list of unmatched names).
+    """
+    mapping, unmatched = {}, []
+    for name in set(names):
+        code = to_iso3(name)
+        if code is None:
+            unmatched.append(name)
+        else:
+            mapping[name] = code
+    return mapping, sorted(unmatched, key=str)
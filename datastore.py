@@ -0,0 +1,124 @@
+# datastore.py
+"""
+On-disk columnar cache for normalized datasets.
+
+Each dataset is stored as two files (wide + long) named after the workbook's
+content hash, so re-uploads and fresh container replicas skip the Excel parse
+and the transform. Parquet is the default; DATA_CACHE_FORMAT=arrow stores
+Arrow IPC files that are read back through a memory map.
+save_object/load_object keep other pipeline state (e.g. fitted anomaly
+models) next to the datasets.
+"""
+import os
+import pickle
+import tempfile
+from contextlib import contextmanager
+import pandas as pd
+
+CACHE_DIR = os.getenv("DATA_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".data_cache"))
+CACHE_FORMAT = os.getenv("DATA_CACHE_FORMAT", "parquet")
+# Bump when the normalized output changes shape so stale files are ignored
+CACHE_VERSION = 2
+
+def _path(key: str, part: str, fmt: str) -> str:
+    ext = "arrow" if fmt == "arrow" else "parquet"
+    return os.path.join(CACHE_DIR, f"{key}.v{CACHE_VERSION}.{part}.{ext}")
+
+@contextmanager
+def atomic_path(path: str):
+    """
+    Yield a unique temp file next to `path`, moved over `path` when the block
+    succeeds and removed when it fails. Unique per call, so concurrent writers
+    (sessions are threads of one process, replicas share the directory) never
+    share a temp file, and readers never see a half-written file.
+    """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=os.path.basename(path) + ".", suffix=".tmp")
+    os.close(fd)
+    try:
+        yield tmp
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+def _write(df: pd.DataFrame, path: str, fmt: str):
+    with atomic_path(path) as tmp:
+        if fmt == "arrow":
+            import pyarrow as pa
+            table = pa.Table.from_pandas(df)
+            with pa.OSFile(tmp, "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        else:
+            df.to_parquet(tmp)
+
+def _read(path: str, fmt: str) -> pd.DataFrame:
+    if fmt == "arrow":
+        import pyarrow as pa
+        with pa.memory_map(path, "r") as source:
+            return pa.ipc.open_file(source).read_all().to_pandas()
+    return pd.read_parquet(path)
+
+def has(key: str, fmt: str = CACHE_FORMAT) -> bool:
+    return all(os.path.exists(_path(key, part, fmt)) for part in ("wide", "long"))
+
+def _write_errors() -> tuple:
+    # What a failed cache write can raise: I/O, a missing pyarrow, or a frame Arrow cannot convert
+    errors = (OSError, ImportError, ValueError, TypeError, NotImplementedError)
+    try:
+        import pyarrow as pa
+    except ImportError:
+        return errors
+    return errors + (pa.ArrowException,)
+
+def save(key: str, base_wide: pd.DataFrame, base_long: pd.DataFrame, fmt: str = CACHE_FORMAT) -> bool:
+    """
+    Persist a normalized dataset. Returns False (instead of raising) when the
+    cache directory is not writable, pyarrow is unavailable or a frame cannot
+    be converted (e.g. an object column with mixed types).
+    """
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        _write(base_wide, _path(key, "wide", fmt), fmt)
+        _write(base_long, _path(key, "long", fmt), fmt)
+        return True
+    except _write_errors():
+        return False
+
+def load(key: str, fmt: str = CACHE_FORMAT):
+    """
+    Return (base_wide, base_long) for a cached dataset, or None on a miss.
+    Unreadable files are treated as a miss so the caller rebuilds them.
+    """
+    if not has(key, fmt):
+        return None
+    try:
+        return _read(_path(key, "wide", fmt), fmt), _read(_path(key, "long", fmt), fmt)
+    except Exception:
+        return None
+
+def save_object(name: str, obj) -> bool:
+    """
+    Pickle any Python object (e.g. fitted models) into the cache directory.
+    Returns False when the directory is not writable.
+    """
+    path = os.path.join(CACHE_DIR, f"{name}.v{CACHE_VERSION}.pkl")
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with atomic_path(path) as tmp, open(tmp, "wb") as fh:
+            pickle.dump(obj, fh, protocol=pickle.HIGHEST_PROTOCOL)
+        return True
+    except OSError:
+        return False
+
+def load_object(name: str):
+    # Counterpart of save_object; None on a miss or an unreadable file
+    path = os.path.join(CACHE_DIR, f"{name}.v{CACHE_VERSION}.pkl")
+    try:
+        with open(path, "rb") as fh:
+            return pickle.load(fh)
+    except Exception:
+        # Also covers pickles from other library versions (AttributeError, ImportError, ...)
+        return None
@@ -0,0 +1,235 @@
+# ingest.py
+"""
+Chunked ingestion for large or multi-file surveillance extracts.
+
+Sources (.xlsx, .csv, .parquet paths or file objects) are read in chunks,
+normalized with core.normalize_wide and appended to Parquet files in the
+cache directory. Rows are hash-partitioned by country into buckets, so every
+country's full series sits in one bucket and the long-form/rolling transform
+can run one bucket at a time. The bucket count follows the input size (about
+CHUNK_ROWS rows per bucket), so peak memory is one chunk while reading and one
+bucket while transforming, whatever the total input size. A single country's
+series is never split, so one very long series still lands in one bucket.
+load_ingested() (the app's path) concatenates every bucket again and is bound
+by the full dataset; the bucketed store itself is what the batch CLI streams.
+"""
+import gzip
+import os
+import json
+import shutil
+import tempfile
+import hashlib
+import numpy as np
+import pandas as pd
+
+import core
+import datastore
+
+CHUNK_ROWS = int(os.getenv("INGEST_CHUNK_ROWS", "200000"))
+# Fewest buckets; larger inputs get about one bucket per CHUNK_ROWS rows (see bucket_count)
+INGEST_BUCKETS = int(os.getenv("INGEST_BUCKETS", "8"))
+WIDE_COLUMNS = ["region","country","year"] + core.NUMERIC_COLUMNS
+
+def _name(source) -> str:
+    return str(getattr(source, "name", source))
+
+def _rewind(source):
+    if hasattr(source, "seek"):
+        source.seek(0)
+
+def sources_digest(sources) -> str:
+    """
+    Content hash over all sources, read in blocks so large files are never held in memory.
+    A single source gives the same id as core.dataset_id on its bytes.
+    """
+    digests = []
+    for source in sources:
+        h = hashlib.sha256()
+        _rewind(source)
+        fh = source if hasattr(source, "read") else open(source, "rb")
+        try:
+            for block in iter(lambda: fh.read(1 << 20), b""):
+                h.update(block)
+        finally:
+            if fh is not source:
+                fh.close()
+        _rewind(source)
+        digests.append(h.hexdigest())
+    if len(digests) == 1:
+        return digests[0]
+    return hashlib.sha256("".join(digests).encode()).hexdigest()
+
+def _iter_xlsx(source, chunksize: int):
+    # openpyxl read-only mode streams rows instead of loading the sheet
+    from openpyxl import load_workbook
+    wb = load_workbook(source, read_only=True, data_only=True)
+    try:
+        rows = wb.worksheets[0].iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return
+        buf = []
+        for row in rows:
+            buf.append(row)
+            if len(buf) >= chunksize:
+                yield pd.DataFrame(buf, columns=header)
+                buf = []
+        if buf:
+            yield pd.DataFrame(buf, columns=header)
+    finally:
+        wb.close()
+
+def iter_chunks(source, chunksize: int = CHUNK_ROWS):
+    """
+    Yield raw DataFrame chunks of at most `chunksize` rows from an .xlsx, .csv
+    (optionally .gz) or .parquet path or file object.
+    """
+    name = _name(source).lower()
+    _rewind(source)
+    if name.endswith((".csv", ".csv.gz")):
+        yield from pd.read_csv(source, chunksize=chunksize)
+    elif name.endswith(".parquet"):
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(source).iter_batches(batch_size=chunksize):
+            yield batch.to_pandas()
+    elif name.endswith(".xlsx"):
+        yield from _iter_xlsx(source, chunksize)
+    else:
+        raise ValueError(f"Unsupported file type: {_name(source)}")
+
+def count_rows(source) -> int:
+    """
+    Data rows of a source without parsing it: Parquet and xlsx metadata, or a
+    newline count over the (decompressed) CSV bytes, read in blocks.
+    """
+    name = _name(source).lower()
+    _rewind(source)
+    try:
+        if name.endswith(".parquet"):
+            import pyarrow.parquet as pq
+            return pq.ParquetFile(source).metadata.num_rows
+        if name.endswith(".xlsx"):
+            from openpyxl import load_workbook
+            wb = load_workbook(source, read_only=True)
+            try:
+                return max((wb.worksheets[0].max_row or 1) - 1, 0)
+            finally:
+                wb.close()
+        opener = gzip.open if name.endswith(".gz") else open
+        fh = opener(source, "rb") if not hasattr(source, "read") or name.endswith(".gz") else source
+        try:
+            lines = sum(block.count(b"\n") for block in iter(lambda: fh.read(1 << 20), b""))
+        finally:
+            if fh is not source:
+                fh.close()
+        return max(lines - 1, 0)
+    finally:
+        _rewind(source)
+
+def bucket_count(total_rows: int, chunksize: int = CHUNK_ROWS) -> int:
+    # At least INGEST_BUCKETS, and enough that an even split keeps each bucket near chunksize rows
+    return max(INGEST_BUCKETS, -(-total_rows // max(chunksize, 1)))
+
+def _conform(chunk: pd.DataFrame) -> pd.DataFrame:
+    # Same mapping as normalize_and_transform, then a fixed column set and dtypes for Parquet
+    df = core.normalize_wide(chunk)
+    for c in core.NUMERIC_COLUMNS:
+        df[c] = df[c].astype("float64") if c in df.columns else np.nan
+    return df[WIDE_COLUMNS]
+
+def _root(key: str) -> str:
+    return os.path.join(datastore.CACHE_DIR, f"ingest-{key}.v{datastore.CACHE_VERSION}")
+
+def _part(root: str, part: str, bucket: int) -> str:
+    return os.path.join(root, f"{part}-{bucket:03d}.parquet")
+
+def _meta(key: str):
+    try:
+        with open(os.path.join(_root(key), "_meta.json")) as fh:
+            return json.load(fh)
+    except OSError:
+        return None
+
+def _write_store(tmp: str, sources, chunksize: int, buckets: int):
+    # Write every bucket's wide and long parts plus _meta.json into the staging dir `tmp`
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([("region", pa.string()), ("country", pa.string()), ("year", pa.int64())]
+                       + [(c, pa.float64()) for c in core.NUMERIC_COLUMNS])
+    writers, seen = {}, set()
+    try:
+        for source in sources:
+            for chunk in iter_chunks(source, chunksize):
+                seen.update(core.COLUMN_MAP.get(c, c) for c in chunk.columns)
+                df = _conform(chunk)
+                bucket = pd.util.hash_array(df["country"].to_numpy(dtype=object)) % buckets
+                for b in np.unique(bucket):
+                    if b not in writers:
+                        writers[b] = pq.ParquetWriter(_part(tmp, "wide", int(b)), schema)
+                    part = df[bucket == b]
+                    writers[b].write_table(pa.Table.from_pandas(part, schema=schema, preserve_index=False))
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+    # Columns no source had are dropped again and each bucket's wide part is replaced
+    # by the transformed one, so output matches normalize_and_transform
+    absent = [c for c in core.NUMERIC_COLUMNS if c not in seen]
+    for b in sorted(int(b) for b in writers):
+        wide = pd.read_parquet(_part(tmp, "wide", b)).drop(columns=absent)
+        wide, long_df = core.normalize_and_transform(wide)
+        wide.to_parquet(_part(tmp, "wide", b), index=False)
+        long_df.to_parquet(_part(tmp, "long", b), index=False)
+    with open(os.path.join(tmp, "_meta.json"), "w") as fh:
+        json.dump({"buckets": sorted(int(b) for b in writers), "absent": absent}, fh)
+
+def ingest(sources, key: str = None, chunksize: int = CHUNK_ROWS, buckets: int = None) -> str:
+    """
+    Stream `sources` into the bucketed columnar store and build the long form.
+    `buckets` defaults to bucket_count() of the sources' total rows.
+    Returns the store key (the content hash unless given); a store that already
+    exists for the key is reused as-is.
+    """
+    key = key or sources_digest(sources)
+    if _meta(key) is not None:
+        return key
+
+    if buckets is None:
+        buckets = bucket_count(sum(count_rows(source) for source in sources), chunksize)
+    root = _root(key)
+    os.makedirs(datastore.CACHE_DIR, exist_ok=True)
+    # A private staging dir per call, so concurrent ingests of one key never share it
+    tmp = tempfile.mkdtemp(dir=os.path.dirname(root), prefix=os.path.basename(root) + ".", suffix=".tmp")
+    try:
+        _write_store(tmp, sources, chunksize, buckets)
+        os.replace(tmp, root)
+    except OSError:
+        shutil.rmtree(tmp, ignore_errors=True)
+        if _meta(key) is None:
+            raise
+        # Another ingest finished the same store first
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    return key
+
+def iter_store(key: str, part: str = "long"):
+    """Yield the `part` ("wide" or "long") of an ingested store one bucket at a time."""
+    meta = _meta(key)
+    if meta is None:
+        raise KeyError(f"No ingested dataset {key}")
+    for b in meta["buckets"]:
+        yield pd.read_parquet(_part(_root(key), part, b))
+
+def load_ingested(key: str, compact: bool = True):
+    """
+    Read a whole ingested store back as (base_wide, base_long), compacted like
+    core.load_workbook. This holds the full dataset in memory; use iter_store to
+    stay within one bucket.
+    """
+    wide = pd.concat(list(iter_store(key, "wide")), ignore_index=True)
+    long = pd.concat(list(iter_store(key, "long")), ignore_index=True)
+    if compact and core.COMPACT_FRAMES:
+        return core.compact_frames(wide, long)
+    return wide, long
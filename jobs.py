@@ -0,0 +1,133 @@
+# jobs.py
+"""
+Process-wide background job runner, shared by every browser session (no Streamlit).
+
+Long computations such as the world-wide anomaly scan are submitted under a
+key and run on a small thread pool, so no script run waits for them. A job
+whose key is already queued, running or done is reused rather than started
+again, so identical requests from any session share one run. poll() returns a
+snapshot of a job's status, progress and the partial results it has streamed
+so far; cancel() stops it at its next progress report. Finished jobs are kept,
+least recently used first, up to MAX_FINISHED_JOBS.
+"""
+import os
+import time
+import queue
+import threading
+from collections import OrderedDict
+
+# Jobs running at once; the anomaly scan already spreads over ANOMALY_WORKERS processes
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "1"))
+MAX_FINISHED_JOBS = int(os.getenv("MAX_FINISHED_JOBS", "8"))
+
+ACTIVE = ("queued", "running")
+
+class Cancelled(Exception):
+    """Raised from a job's progress/partial callbacks once it has been cancelled."""
+
+_lock = threading.Lock()
+_jobs = OrderedDict()   # key -> job dict, least recently used first
+_queue = queue.Queue()  # (job, fn) waiting for a worker
+_workers = []
+
+def submit(key, fn) -> dict:
+    """
+    Run fn(progress, partial) in the background under `key`, unless a job with
+    that key is already queued, running or done. progress(fraction) and
+    partial(item) report back to pollers and raise Cancelled once the job is
+    cancelled; fn's return value becomes the job's "result". Returns a snapshot.
+    """
+    with _lock:
+        job = _jobs.get(key)
+        if job is not None and job["status"] in ACTIVE + ("done",):
+            _jobs.move_to_end(key)
+            return _snapshot(job)
+        job = {"key": key, "status": "queued", "progress": 0.0, "partial": [], "result": None, "error": None,
+               "submitted": time.time(), "started": None, "finished": None, "_cancel": threading.Event()}
+        _jobs[key] = job
+        _jobs.move_to_end(key)
+        _evict()
+        _queue.put((job, fn))
+        if len(_workers) < JOB_WORKERS:
+            # Daemon threads, so shutting the server down does not wait for a scan to finish
+            worker = threading.Thread(target=_work, name=f"job-{len(_workers)}", daemon=True)
+            worker.start()
+            _workers.append(worker)
+        return _snapshot(job)
+
+def _work():
+    while True:
+        _run(*_queue.get())
+
+def _run(job: dict, fn):
+    cancel = job["_cancel"]
+
+    def progress(fraction):
+        if cancel.is_set():
+            raise Cancelled()
+        with _lock:
+            job["progress"] = float(fraction)
+
+    def partial(item):
+        if cancel.is_set():
+            raise Cancelled()
+        with _lock:
+            job["partial"].append(item)
+
+    with _lock:
+        if cancel.is_set():
+            return
+        job["status"], job["started"] = "running", time.time()
+    result, error = None, None
+    try:
+        result = fn(progress, partial)
+    except Cancelled:
+        pass
+    except Exception as exc:
+        error = f"{type(exc).__name__}: {exc}"
+    with _lock:
+        if cancel.is_set():
+            job["status"], result = "cancelled", None
+        else:
+            job["status"] = "error" if error else "done"
+        if job["status"] == "done":
+            job["progress"] = 1.0
+        job.update(result=result, error=error, finished=time.time())
+        _evict()
+
+def poll(key) -> dict:
+    """Snapshot of the job under `key` (None if there is none)."""
+    with _lock:
+        job = _jobs.get(key)
+        if job is None:
+            return None
+        _jobs.move_to_end(key)
+        return _snapshot(job)
+
+def cancel(key) -> bool:
+    """
+    Cancel a queued or running job; it is shared, so every session polling it
+    sees it cancelled. Returns False if there was nothing to cancel.
+    """
+    with _lock:
+        job = _jobs.get(key)
+        if job is None or job["status"] not in ACTIVE:
+            return False
+        job["_cancel"].set()
+        # A running job stops at its next report; its status is final already
+        job["status"], job["finished"] = "cancelled", time.time()
+        return True
+
+def _snapshot(job: dict) -> dict:
+    # Caller holds _lock. Partial results are copied so pollers see a stable list.
+    snap = {k: v for k, v in job.items() if not k.startswith("_")}
+    snap["partial"] = list(job["partial"])
+    end = job["finished"] or time.time()
+    snap["seconds"] = end - job["started"] if job["started"] else 0.0
+    return snap
+
+def _evict():
+    # Caller holds _lock. Queued and running jobs are never dropped.
+    finished = [key for key, job in _jobs.items() if job["status"] not in ACTIVE]
+    for key in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+        del _jobs[key]
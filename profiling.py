@@ -0,0 +1,110 @@
+# profiling.py
+"""
+Opt-in stage timing for the pipeline (no Streamlit).
+
+Enabled with PROFILE_STAGES=1 or APP_ENV=development. Pipeline functions are
+wrapped with @timed("stage"); while a trace is active in the current thread
+(start_trace/stop_trace, one per app rerun or CLI run) every call records its
+wall time, rows in/out and the process RSS change. When disabled, or outside a
+trace, the wrapper is a plain pass-through.
+"""
+import os
+import json
+import time
+import threading
+import functools
+from contextlib import contextmanager
+
+ENABLED = os.getenv("PROFILE_STAGES", "") == "1" or os.getenv("APP_ENV", "production") == "development"
+
+_local = threading.local()
+
+def start_trace() -> list:
+    # Begin collecting records for this thread (Streamlit runs each session's script in its own thread)
+    _local.records = []
+    _local.depth = 0
+    return _local.records
+
+def stop_trace() -> list:
+    records = getattr(_local, "records", None) or []
+    _local.records = None
+    return records
+
+def _rss_mb() -> float:
+    try:
+        with open("/proc/self/statm") as fh:
+            return int(fh.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError, IndexError, AttributeError):
+        return float("nan")
+
+def _rows(obj):
+    # Row count of a frame, a build_long_index() result, or the first frame of a tuple
+    if isinstance(obj, tuple) and obj:
+        obj = obj[0]
+    if isinstance(obj, dict) and "df" in obj:
+        obj = obj["df"]
+    return len(obj) if hasattr(obj, "columns") else None
+
+@contextmanager
+def stage(name: str, rows_in=None):
+    """
+    Record one stage; the yielded dict accepts "rows_out" (None when not tracing).
+    """
+    records = getattr(_local, "records", None) if ENABLED else None
+    if records is None:
+        yield None
+        return
+    rec = {"stage": name, "depth": _local.depth, "rows_in": rows_in, "rows_out": None}
+    rss = _rss_mb()
+    _local.depth += 1
+    start = time.perf_counter()
+    try:
+        yield rec
+    finally:
+        rec["seconds"] = time.perf_counter() - start
+        rec["rss_delta_mb"] = _rss_mb() - rss
+        _local.depth -= 1
+        records.append(rec)
+
+def timed(name: str):
+    """Decorator form of stage(); rows come from the first argument and the return value."""
+    def wrap(fn):
+        @functools.wraps(fn)
+        def inner(*args, **kwargs):
+            if not ENABLED or getattr(_local, "records", None) is None:
+                return fn(*args, **kwargs)
+            with stage(name, _rows(args[0]) if args else None) as rec:
+                out = fn(*args, **kwargs)
+                rec["rows_out"] = _rows(out)
+                return out
+        return inner
+    return wrap
+
+def summarize(records: list) -> list:
+    # Per-stage totals in first-seen order: calls, seconds, max rows in/out, summed RSS change
+    out = {}
+    for rec in records:
+        s = out.setdefault(rec["stage"], {"stage": rec["stage"], "calls": 0, "seconds": 0.0,
+                                          "rows_in": None, "rows_out": None, "rss_delta_mb": 0.0})
+        s["calls"] += 1
+        s["seconds"] += rec["seconds"]
+        s["rss_delta_mb"] += rec["rss_delta_mb"]
+        for k in ["rows_in", "rows_out"]:
+            if rec[k] is not None:
+                s[k] = max(s[k] or 0, rec[k])
+    return list(out.values())
+
+def to_json(records: list, **meta) -> str:
+    return json.dumps({**meta, "stages": records}, indent=2, default=str)
+
+def profile_stats_bytes(profiler) -> bytes:
+    # A cProfile.Profile as .prof bytes (loadable with pstats or snakeviz)
+    import tempfile
+    with tempfile.NamedTemporaryFile(suffix=".prof", delete=False) as fh:
+        path = fh.name
+    try:
+        profiler.dump_stats(path)
+        with open(path, "rb") as fh:
+            return fh.read()
+    finally:
+        os.remove(path)
@@ -0,0 +1,148 @@
+# registry.py
+"""
+Process-wide registry of loaded datasets, shared by every browser session.
+
+Datasets are keyed by content hash, so identical uploads from any number of
+sessions are loaded and normalized once and then served as the same
+(base_wide, base_long) objects. They are shared between sessions and must be
+treated as read-only. Each session holds a reference to the dataset it is
+viewing; unreferenced datasets are evicted least recently used first once
+more than MAX_DATASETS are loaded (referenced and pinned ones count towards
+that budget but are never evicted). on_evict() hooks let callers drop caches
+built from an evicted dataset. A default dataset (DEFAULT_DATASET=path)
+can be preloaded and pinned so it is never evicted.
+"""
+import os
+import threading
+from collections import OrderedDict
+
+import core
+
+# Same budget as the Streamlit caches in apputil
+MAX_DATASETS = int(os.getenv("MAX_CACHED_DATASETS", "4"))
+DEFAULT_DATASET = os.getenv("DEFAULT_DATASET", "")
+
+_lock = threading.Lock()
+_datasets = OrderedDict()   # data_id -> (base_wide, base_long), least recently used first
+_loading = {}               # data_id -> lock held while that dataset is being built
+_refs = {}                  # data_id -> set of session ids viewing it
+_session_data = {}          # session id -> data_id
+_pinned = set()
+_evict_hooks = []           # callables receiving the data_ids just evicted
+
+def get(data_id: str, loader):
+    """
+    Return the shared (base_wide, base_long) for `data_id`, calling `loader()`
+    to build it on a miss. Concurrent requests for the same id wait for one load.
+    """
+    with _lock:
+        if data_id in _datasets:
+            _datasets.move_to_end(data_id)
+            return _datasets[data_id]
+        key_lock = _loading.setdefault(data_id, threading.Lock())
+    with key_lock:
+        with _lock:
+            if data_id in _datasets:
+                return _datasets[data_id]
+        try:
+            dataset = loader()
+        except BaseException:
+            with _lock:
+                _loading.pop(data_id, None)
+            raise
+        with _lock:
+            _datasets[data_id] = dataset
+            _loading.pop(data_id, None)
+            evicted = _evict()
+        _notify(evicted)
+        return dataset
+
+def has(data_id: str) -> bool:
+    with _lock:
+        return data_id in _datasets
+
+def acquire(session_id: str, data_id: str):
+    # Record that a session views data_id, dropping its reference to any previous dataset
+    with _lock:
+        previous = _session_data.get(session_id)
+        if previous == data_id:
+            return
+        if previous is not None:
+            _refs.get(previous, set()).discard(session_id)
+        _session_data[session_id] = data_id
+        _refs.setdefault(data_id, set()).add(session_id)
+
+def release(session_id: str):
+    with _lock:
+        data_id = _session_data.pop(session_id, None)
+        if data_id is not None:
+            _refs.get(data_id, set()).discard(session_id)
+        evicted = _evict()
+    _notify(evicted)
+
+def prune(is_alive):
+    """Release every session for which `is_alive(session_id)` is False."""
+    with _lock:
+        dead = [sid for sid in _session_data if not is_alive(sid)]
+    for sid in dead:
+        release(sid)
+
+def _evict() -> list:
+    # Caller holds _lock. Referenced and pinned datasets are never dropped, even over budget.
+    evicted = []
+    for data_id in list(_datasets):
+        if len(_datasets) <= MAX_DATASETS:
+            break
+        if data_id not in _pinned and not _refs.get(data_id):
+            del _datasets[data_id]
+            _refs.pop(data_id, None)
+            evicted.append(data_id)
+    return evicted
+
+def on_evict(hook):
+    """
+    Call `hook(data_ids)` after datasets are evicted, e.g. to drop caches
+    derived from their frames. Registering the same hook twice has no effect.
+    """
+    with _lock:
+        if hook not in _evict_hooks:
+            _evict_hooks.append(hook)
+
+def _notify(evicted: list):
+    # Runs outside _lock, so hooks may call back into the registry
+    if evicted:
+        for hook in list(_evict_hooks):
+            hook(evicted)
+
+def read_file(path: str) -> bytes:
+    with open(path, "rb") as fh:
+        return fh.read()
+
+def preload(path: str = None) -> str:
+    """
+    Load a workbook from disk into the registry and pin it.
+    Returns its data_id, or None when no path is configured.
+    """
+    path = path or DEFAULT_DATASET
+    if not path:
+        return None
+    file_bytes = read_file(path)
+    data_id = core.dataset_id(file_bytes)
+    get(data_id, lambda: core.load_workbook(data_id, file_bytes))
+    with _lock:
+        _pinned.add(data_id)
+    return data_id
+
+def sessions(data_id: str) -> int:
+    with _lock:
+        return len(_refs.get(data_id, ()))
+
+def stats() -> list:
+    # One row per loaded dataset: id, sessions viewing it, pinned, frame memory
+    with _lock:
+        items = list(_datasets.items())
+        refs = {k: len(v) for k, v in _refs.items()}
+        pinned = set(_pinned)
+    return [{"data_id": data_id[:12], "sessions": refs.get(data_id, 0), "pinned": data_id in pinned,
+             "mb": sum(df.memory_usage(deep=True).sum() for df in frames) / 2**20}
+            for data_id, frames in items]
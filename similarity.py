@@ -0,0 +1,92 @@
+# similarity.py
+"""
+Similar-country search for the Country Deep Dive (no Streamlit).
+
+build_similarity_index() turns one (disease metric, year range) selection of
+the aggregation cube into a countries x years matrix in one pass. Each row is
+normalized to a trend vector: log1p of the yearly cases, centred on the
+country's mean and scaled to unit length, with missing years left at zero so
+they do not count. The dot product of two rows is then the Pearson
+correlation of their log cases, so similar() answers a nearest-neighbour
+query with a single matrix-vector product over all countries.
+The per-country comparison statistics are computed in the same pass.
+"""
+import numpy as np
+import pandas as pd
+
+from core import cube_query
+from profiling import timed
+
+# Countries with fewer observed years are kept for the statistics but never matched
+MIN_YEARS = 3
+
+@timed("build_similarity")
+def build_similarity_index(cube: dict, disease_sel, year_range) -> dict:
+    """
+    Trend vectors and comparison statistics of every country for one disease
+    metric and year range (all regions; similar() narrows to a region subset).
+    """
+    cells = cube_query(cube, ["region", "country", "year"], disease_sel, None, year_range)
+    country_codes, names = pd.factorize(cells["country"].astype(str), sort=True)
+    years, cell_years = np.unique(cells["year"].to_numpy(dtype="float64"), return_inverse=True)
+    observed = np.zeros((len(names), len(years)), dtype=bool)
+    observed[country_codes, cell_years] = True
+    # A country listed under several regions sums its rows, as in the rankings
+    sums = np.zeros(observed.shape)
+    np.add.at(sums, (country_codes, cell_years), cells["value"].to_numpy(dtype="float64"))
+    values = np.where(observed, sums, np.nan)
+
+    counts = observed.sum(axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        total = np.where(observed, values, 0).sum(axis=1)
+        mean = total / counts
+        dev = np.where(observed, values - mean[:, None], 0)
+        std = np.where(counts > 1, np.sqrt((dev ** 2).sum(axis=1) / (counts - 1)), np.nan)
+        peak = np.where(observed, values, -np.inf).max(axis=1)
+        low = np.where(observed, values, np.inf).min(axis=1)
+
+        logs = np.log1p(np.clip(np.where(observed, values, 0), 0, None))
+        centred = np.where(observed, logs - (logs.sum(axis=1) / counts)[:, None], 0)
+        norm = np.sqrt((centred ** 2).sum(axis=1))
+        matchable = (counts >= MIN_YEARS) & (norm > 0)
+        unit = np.where(matchable[:, None], centred / norm[:, None], 0).astype("float32")
+
+    stats = pd.DataFrame({"Total": total, "Average": mean, "Peak": peak, "Min": low, "Std Dev": std},
+                         index=pd.Index(names, name="Country"))
+    region = cells.astype({"country": str, "region": str}).drop_duplicates("country").set_index("country")["region"]
+    return {
+        "countries": np.asarray(names),
+        "positions": {name: i for i, name in enumerate(names)},
+        "regions": region.reindex(names).to_numpy(),
+        "years": years.astype("int64"),
+        "unit": unit,
+        "matchable": matchable,
+        "stats": stats,
+    }
+
+def similar(index: dict, country: str, k: int = 10, regions=None) -> pd.DataFrame:
+    """
+    The `k` countries whose trends correlate best with `country`, most similar
+    first, optionally limited to `regions`. Columns: country, region, similarity
+    (the correlation, -1..1). Empty when the country has too few years or a flat trend.
+    """
+    pos = index["positions"].get(country)
+    if pos is None or not index["matchable"][pos]:
+        return pd.DataFrame(columns=["country", "region", "similarity"])
+    scores = index["unit"] @ index["unit"][pos]
+    candidates = index["matchable"].copy()
+    candidates[pos] = False
+    if regions:
+        candidates &= np.isin(index["regions"], list(regions))
+    rows = np.flatnonzero(candidates)
+    k = min(k, len(rows))
+    if k == 0:
+        return pd.DataFrame(columns=["country", "region", "similarity"])
+    best = rows[np.argpartition(-scores[rows], k - 1)[:k]]
+    best = best[np.argsort(-scores[best], kind="stable")]
+    return pd.DataFrame({"country": index["countries"][best], "region": index["regions"][best],
+                         "similarity": scores[best].astype("float64")})
+
+def comparison_stats(index: dict, countries) -> pd.DataFrame:
+    # Precomputed Total/Average/Peak/Min/Std Dev rows for these countries, in the given order
+    return index["stats"].reindex(list(countries)).reset_index()
@@ -2,7 +2,19 @@
 import pandas as pd
 import numpy as np
 
-from apputil import normalize_and_transform
+from apputil import normalize_and_transform, add_rolls_yoy, build_long_index, apply_filters, build_cube, cube_query, write_export
+from core import compact_frames, memory_report
+import datastore
+import ingest
+import countries
+import registry
+import profiling
+import anomaly_core
+import jobs
+import charts
+import similarity
+import api
+from anomaly_detector import score_robust, get_global_anomalies
 
 def test_normalize_and_transform_basic():
     # Create a tiny fake dataset that mimics our real schema
@@ -32,6 +44,404 @@ def test_normalize_and_transform_basic():
     for col in ["roll3", "roll5", "yoy"]:
         assert col in base_long.columns, f"{col} should be present in base_long"
 
+def _reference_rolls_yoy(long_df, keys, windows):
+    # The original per-group implementation, kept here as the ground truth
+    def per_group(g):
+        g = g.sort_values("year")
+        for w in windows:
+            g[f"roll{w}"] = g["value"].rolling(w, min_periods=1).mean()
+        prev = g["value"].shift(1)
+        g["yoy"] = np.where((prev.notna()) & (prev != 0), g["value"]/prev - 1, np.nan)
+        return g
+    return long_df.groupby(keys, group_keys=False)[list(long_df.columns)].apply(per_group)
+
+def test_add_rolls_yoy_matches_groupby_apply():
+    # Uneven series lengths, missing values and zeros across several groups
+    rng = np.random.default_rng(0)
+    n = 400
+    long_df = pd.DataFrame({
+        "region": "AFR",
+        "country": rng.choice([f"C{i}" for i in range(25)], n),
+        "disease": rng.choice(["Measles", "Rubella"], n),
+        "year": rng.permutation(n) + 1900,
+        "value": rng.integers(0, 50, n).astype(float),
+    })
+    long_df.loc[rng.choice(n, 40, replace=False), "value"] = np.nan
+
+    windows = (1, 2, 3, 5, 7)
+    expected = _reference_rolls_yoy(long_df, ["country", "disease"], windows)
+    result = add_rolls_yoy(long_df, ["country", "disease"], windows)
+    pd.testing.assert_frame_equal(result, expected)
+
+def _tiny_raw():
+    return pd.DataFrame({
+        "Region": ["AFR", "AFR", "EMR"],
+        "Country": ["CountryA", "CountryA", "CountryB"],
+        "Year": [2020, 2021, 2020],
+        "Measles_Cases": [100, 150, 200],
+        "Rubella_Cases": [10, 15, 20],
+        "Population": [1_000_000, 1_000_000, 2_000_000],
+    })
+
+def test_datastore_roundtrip(tmp_path, monkeypatch):
+    # Both cache formats must give back exactly what was stored
+    monkeypatch.setattr(datastore, "CACHE_DIR", str(tmp_path))
+    base_wide, base_long = normalize_and_transform(_tiny_raw())
+    for fmt in ["parquet", "arrow"]:
+        assert datastore.load("abc", fmt) is None, "Empty cache should miss"
+        assert datastore.save("abc", base_wide, base_long, fmt)
+        wide, long = datastore.load("abc", fmt)
+        pd.testing.assert_frame_equal(wide, base_wide)
+        pd.testing.assert_frame_equal(long, base_long)
+    mixed = base_wide.assign(country=["A", 1, 2.5])
+    assert not datastore.save("mixed", mixed, base_long), "Unconvertible frames should not raise"
+
+def test_ingest_split_sources_match_single_frame(tmp_path, monkeypatch):
+    # Chunked multi-file ingestion must give the same dataset as transforming one frame
+    monkeypatch.setattr(datastore, "CACHE_DIR", str(tmp_path))
+    raw = _tiny_raw()
+    raw.iloc[:2].to_csv(tmp_path / "a.csv", index=False)
+    raw.iloc[2:].to_parquet(tmp_path / "b.parquet", index=False)
+    key = ingest.ingest([str(tmp_path / "a.csv"), str(tmp_path / "b.parquet")], chunksize=1, buckets=3)
+    wide, long = ingest.load_ingested(key, compact=False)
+
+    base_wide, base_long = normalize_and_transform(raw)
+    order = ["disease","country","year"]
+    pd.testing.assert_frame_equal(
+        long.sort_values(order).reset_index(drop=True),
+        base_long.sort_values(order).reset_index(drop=True), check_dtype=False)
+    assert sorted(wide.columns) == sorted(base_wide.columns)
+    assert len(wide) == len(base_wide)
+    assert [ingest.count_rows(str(tmp_path / f)) for f in ["a.csv", "b.parquet"]] == [2, 1]
+    assert ingest.bucket_count(10, 1) == max(ingest.INGEST_BUCKETS, 10)
+
+def test_iso3_lookup_handles_who_variants():
+    mapping, unmatched = countries.iso3_lookup(
+        ["Bahamas, The", "Congo, Dem. Rep.", "St. Kitts and Nevis", "Côte d'Ivoire", "Türkiye", "Atlantis"])
+    assert mapping == {"Bahamas, The": "BHS", "Congo, Dem. Rep.": "COD", "St. Kitts and Nevis": "KNA",
+                       "Côte d'Ivoire": "CIV", "Türkiye": "TUR"}
+    assert unmatched == ["Atlantis"]
+
+def test_indexed_filters_match_boolean_masks():
+    # The indexed filter must select exactly the rows the old boolean masks did
+    rng = np.random.default_rng(1)
+    n = 600
+    long_df = pd.DataFrame({
+        "region": rng.choice(["AFR", "AMR", "EMR", "EUR"], n),
+        "country": rng.choice([f"C{i}" for i in range(30)], n),
+        "year": pd.array(rng.integers(2010, 2026, n), dtype="Int64"),
+        "value": rng.random(n),
+        "disease": rng.choice(["Measles", "Rubella", "Measles_per100k"], n),
+    })
+    index = build_long_index(long_df)
+    for disease_sel, regions, year_range in [
+        ("Both", ["AFR", "AMR", "EMR", "EUR"], (2010, 2025)),
+        ("Measles", ["EMR"], (2014, 2018)),
+        ("Measles_per100k", [], (2020, 2020)),
+        ("Rubella", ["AMR", "EUR"], (2030, 2040)),
+    ]:
+        diseases = ["Measles", "Rubella"] if disease_sel == "Both" else [disease_sel]
+        mask = long_df["disease"].isin(diseases) & long_df["year"].between(*year_range)
+        if regions:
+            mask &= long_df["region"].isin(regions)
+        # Compare the labels as str on both sides (object on pandas 2, StringDtype on pandas 3)
+        labels = {c: str for c in ["disease", "region", "country"]}
+        expected = long_df[mask].astype(labels).sort_values(["value"]).reset_index(drop=True)
+        result = apply_filters(index, disease_sel, regions, year_range)
+        result = result.astype(labels)
+        result = result.sort_values(["value"]).reset_index(drop=True)[list(long_df.columns)]
+        pd.testing.assert_frame_equal(result, expected)
+
+def test_cube_query_matches_groupby_on_filtered_frame():
+    # Every roll-up answered by the cube must equal a groupby over the filtered rows
+    raw = pd.DataFrame({
+        "Region": ["AFR", "AFR", "AFR", "EMR", "EMR", "EUR"],
+        "Country": ["A", "A", "B", "C", "C", "D"],
+        "Year": [2020, 2021, 2021, 2020, 2021, 2021],
+        "Measles_Cases": [100, 150, np.nan, 200, 50, 7],
+        "Rubella_Cases": [10, 15, 1, 20, 5, 0],
+    })
+    _, base_long = normalize_and_transform(raw)
+    cube = build_cube(base_long)
+    filters = ("Both", ["AFR", "EMR"], (2020, 2021))
+    long_f = apply_filters(build_long_index(base_long), *filters)
+    for by in [["year"], ["region", "year"], ["country"], ["country", "year"]]:
+        expected = long_f.groupby(by, as_index=False, observed=True)[["value", "roll3"]].sum()
+        result = cube_query(cube, by, *filters)[by + ["value", "roll3"]]
+        pd.testing.assert_frame_equal(result.reset_index(drop=True), expected, check_dtype=False, check_categorical=False)
+    one = cube_query(cube, ["year"], *filters, countries=["A"])
+    assert one["value"].tolist() == [110, 165], "Country slice should only sum country A"
+
+def test_chunked_export_matches_single_encode(tmp_path):
+    # Chunked CSV/gzip writes must be byte-identical to one to_csv call
+    import gzip
+    _, base_long = normalize_and_transform(_tiny_raw())
+    expected = base_long.sort_values(["country","region","disease","year"]).to_csv(index=False).encode("utf-8")
+    assert open(write_export(base_long, str(tmp_path / "a.csv"), "CSV", chunk_rows=2), "rb").read() == expected
+    assert gzip.decompress(open(write_export(base_long, str(tmp_path / "a.csv.gz"), "CSV (gzip)", chunk_rows=2), "rb").read()) == expected
+    assert len(pd.read_parquet(write_export(base_long, str(tmp_path / "a.parquet"), "Parquet"))) == len(base_long)
+    assert not list(tmp_path.glob("*.tmp")), "Temp files are moved into place"
+
+def test_compact_frames_shrink_without_changing_aggregates():
+    base_wide, base_long = normalize_and_transform(_tiny_raw())
+    wide, long = compact_frames(base_wide, base_long)
+    assert str(long["year"].dtype) == "Int16" and long["roll3"].dtype == "float32"
+    assert long["value"].dtype.itemsize < 8
+    assert isinstance(long["country"].dtype, pd.CategoricalDtype)
+    assert wide["population"].dtype == base_wide["population"].dtype, "Population keeps its precision"
+    assert (memory_report({"long": long})["saved"] > 0).all()
+
+    expected = cube_query(build_cube(base_long), ["region", "year"], "Both", None, (2020, 2021))
+    result = cube_query(build_cube(long), ["region", "year"], "Both", None, (2020, 2021))
+    pd.testing.assert_frame_equal(result.astype({"region": str, "year": "int64"}),
+                                  expected.astype({"region": str, "year": "int64"}))
+
+    # A country listed under two regions keeps both
+    moved = _tiny_raw().assign(Country="CountryA")
+    wide, long = compact_frames(*normalize_and_transform(moved))
+    assert wide["region"].notna().all() and set(long["region"]) == {"AFR", "EMR"}
+
+def test_registry_shares_and_evicts_unreferenced(monkeypatch):
+    monkeypatch.setattr(registry, "MAX_DATASETS", 1)
+    monkeypatch.setattr(registry, "_datasets", type(registry._datasets)())
+    monkeypatch.setattr(registry, "_refs", {})
+    monkeypatch.setattr(registry, "_session_data", {})
+    monkeypatch.setattr(registry, "_evict_hooks", [])
+    evicted = []
+    registry.on_evict(evicted.extend)
+    loads = []
+    def loader(name):
+        return lambda: loads.append(name) or (name, name)
+
+    registry.acquire("s1", "a")
+    registry.acquire("s2", "a")
+    assert registry.get("a", loader("a")) is registry.get("a", loader("a"))
+    assert loads == ["a"], "Identical datasets should load once"
+
+    registry.acquire("s3", "b")
+    registry.get("b", loader("b"))
+    assert registry.has("a"), "Datasets with viewers are kept over budget"
+    registry.release("s1")
+    registry.release("s2")
+    assert not registry.has("a") and registry.has("b")
+    assert evicted == ["a"], "Eviction hooks see the dropped dataset"
+
+def test_synthetic_data_matches_workbook_schema():
+    import bench
+    raw = bench.synthetic_raw(countries=4, units=2, periods=5)
+    workbook_cols = ["Region", "Country", "Year", "Measles_Cases", "Rubella_Cases", "Population",
+                     "Measles_Cases_Per_100K", "Rubella_Cases_Per_100K"]
+    assert list(raw.columns) == workbook_cols
+    base_wide, base_long = normalize_and_transform(raw)
+    assert len(base_wide) == 4 * 2 * 5 and base_wide["country"].nunique() == 8
+    assert len(bench.synthetic_scale(10)) == 10 * len(bench.synthetic_scale(1))
+
+def test_stage_trace_records_rows_and_time(monkeypatch):
+    monkeypatch.setattr(profiling, "ENABLED", True)
+    profiling.start_trace()
+    _, base_long = normalize_and_transform(_tiny_raw())
+    cube_query(build_cube(base_long), ["year"], "Both", None, (2020, 2021))
+    records = profiling.stop_trace()
+    stages = {r["stage"]: r for r in records}
+    assert {"normalize", "build_cube", "aggregate:year"} <= set(stages)
+    assert stages["normalize"]["rows_in"] == 3 and stages["aggregate:year"]["rows_out"] == 2
+    assert all(r["seconds"] >= 0 for r in records)
+    assert profiling.stop_trace() == [], "Nothing is recorded outside a trace"
+
+def test_score_robust_flags_spike():
+    # A single outbreak year should be the one flagged, with the same columns as the forest engine
+    years = list(range(2010, 2024))
+    base = [100, 110, 95, 105, 98, 102, 5000, 101, 99, 97, 103, 100, 96, 104]
+    df_wide = pd.DataFrame({
+        "region": "AFR", "country": ["A"] * 14 + ["B"] * 2,
+        "year": years + [2010, 2011],
+        "measles": base + [1, 2],
+        "rubella": [10] * 14 + [1, 2],
+    })
+    result = score_robust(df_wide, contamination=0.1)
+    assert set(result["country"]) == {"A"}, "Countries with fewer than 3 years should be dropped"
+    for col in ["measles_anomaly", "measles_anomaly_score", "rubella_anomaly", "joint_anomaly", "joint_anomaly_score"]:
+        assert col in result.columns, f"{col} should be present"
+    flagged = result.loc[result["measles_anomaly"] == -1, "year"].tolist()
+    assert 2016 in flagged, "The spike year should be flagged"
+
+def test_incremental_global_anomalies_refits_only_changed(monkeypatch):
+    # Appending a year reuses saved forests; editing history forces a refit
+    rng = np.random.default_rng(2)
+    df_wide = pd.DataFrame({
+        "region": "AFR",
+        "country": np.repeat(["A", "B", "C"], 8),
+        "year": np.tile(np.arange(2010, 2018), 3),
+        "measles": rng.integers(50, 150, 24).astype(float),
+        "rubella": rng.integers(5, 15, 24).astype(float),
+    })
+    state = {}
+    first = get_global_anomalies(df_wide, n_jobs=1, state=state)
+    pd.testing.assert_frame_equal(first, get_global_anomalies(df_wide, n_jobs=1))
+
+    fitted = []
+    fit = anomaly_core._fit_country
+    monkeypatch.setattr(anomaly_core, "_fit_country", lambda rows, c: (fitted.append(rows["country"].iat[0]), fit(rows, c))[1])
+    new_year = pd.DataFrame({"region": "AFR", "country": ["A", "B", "C"], "year": 2018,
+                             "measles": [100.0, 900.0, 100.0], "rubella": [10.0, 10.0, 10.0]})
+    updated = pd.concat([df_wide, new_year], ignore_index=True)
+    updated.loc[(updated["country"] == "C") & (updated["year"] == 2012), "measles"] = 1.0
+    result = get_global_anomalies(updated, n_jobs=1, state=state)
+
+    assert fitted == ["C"], "Only the country with edited history should be refitted"
+    assert len(result) == len(updated), "Appended years should be scored"
+    assert result["measles_anomaly"].notna().all()
+
+def test_incremental_scan_keeps_full_scan_dtypes():
+    # Appended years scored with saved forests must come back with the same dtypes as a full scan
+    rng = np.random.default_rng(3)
+    df_wide = pd.DataFrame({"region": "AFR", "country": np.repeat(["A", "B"], 8), "year": np.tile(np.arange(2010, 2018), 2),
+                            "measles": rng.integers(50, 150, 16).astype(float), "rubella": rng.integers(5, 15, 16).astype(float)})
+    state = {}
+    anomaly_core.scan_anomalies(df_wide.astype({"region": "category", "country": "category"}),
+                                n_jobs=1, engine="isolation_forest", state=state)
+    # A new region in the update gives the compact categoricals different categories
+    new_rows = pd.DataFrame({"region": ["AFR", "AFR", "EMR"], "country": ["A", "B", "C"], "year": 2018,
+                             "measles": [100.0, 900.0, 100.0], "rubella": 10.0})
+    updated = pd.concat([df_wide, new_rows], ignore_index=True).astype({"region": "category", "country": "category"})
+    incremental = anomaly_core.scan_anomalies(updated, n_jobs=1, engine="isolation_forest", state=state)[0]
+    full = anomaly_core.scan_anomalies(updated, n_jobs=1, engine="isolation_forest")[0]
+    assert incremental.dtypes.equals(full.dtypes)
+    assert incremental["measles_anomaly"].dtype == "int64"
+
+def test_background_jobs_dedupe_stream_and_cancel():
+    import threading
+    import time
+    gate, calls = threading.Event(), []
+
+    def work(progress, partial):
+        calls.append(1)
+        partial("first")
+        gate.wait(5)
+        progress(0.5)
+        partial("second")
+        return "done"
+
+    def wait(key):
+        for _ in range(200):
+            snap = jobs.poll(key)
+            if snap["status"] not in jobs.ACTIVE:
+                return snap
+            time.sleep(0.01)
+
+    jobs.submit("a", work)
+    assert jobs.submit("a", work)["status"] in jobs.ACTIVE
+    gate.set()
+    snap = wait("a")
+    assert snap["status"] == "done" and snap["result"] == "done" and snap["partial"] == ["first", "second"]
+    assert jobs.submit("a", work)["status"] == "done" and calls == [1], "Identical jobs should run once"
+
+    gate.clear()
+    jobs.submit("b", work)
+    for _ in range(200):
+        if jobs.poll("b")["partial"]:
+            break
+        time.sleep(0.01)
+    assert jobs.cancel("b")
+    gate.set()
+    snap = wait("b")
+    assert snap["status"] == "cancelled" and snap["partial"] == ["first"] and snap["result"] is None
+
+def test_scan_streams_per_country_results():
+    df_wide = pd.DataFrame({"region": "AFR", "country": np.repeat(["A", "B", "C"], [6, 6, 2]),
+                            "year": [*range(2012, 2018)] * 2 + [2012, 2013],
+                            "measles": np.arange(14, dtype=float), "rubella": 1.0})
+    streamed = []
+    combined, skipped = anomaly_core.scan_anomalies(df_wide, engine="robust",
+                                                    on_result=lambda c, r: streamed.append((c, r)))
+    assert [c for c, _ in streamed] == ["A", "B", "C"] and skipped == ["C"] and streamed[-1][1] is None
+    pd.testing.assert_frame_equal(pd.concat([r for _, r in streamed[:2]]), combined, check_index_type=False)
+    top = anomaly_core.top_anomalies(combined, 3)
+    assert len(top) <= 3 and top["score"].is_monotonic_increasing
+
+def test_lttb_downsampling_keeps_shape():
+    x = np.arange(5000, dtype=float)
+    y = np.sin(x / 300) * 100
+    y[1234] = 1000.0
+    idx = charts.lttb_indices(x, y, 500)
+    assert len(idx) == 500 and idx[0] == 0 and idx[-1] == 4999 and (np.diff(idx) > 0).all()
+    assert 1234 in idx, "The spike should survive downsampling"
+
+    frame = pd.DataFrame({"year": x, "value": y})
+    assert len(charts.downsample(frame, "value", n=500)) == 500
+    assert len(charts.downsample(frame.head(100), "value", n=500)) == 100
+    assert charts.scatter_type(10) is not charts.scatter_type(10**6)
+
+def test_similarity_index_ranks_trends_and_matches_loop_stats():
+    years = np.arange(2012, 2020)
+    rising = 1000 * 10.0 ** (years - 2012)
+    series = {"Up": rising, "UpToo": rising * 3, "Down": rising[::-1], "Flat": np.full(8, 5.0)}
+    long_df = pd.DataFrame([{"disease": "Measles", "region": "AFR" if name != "UpToo" else "EMR",
+                             "country": name, "year": y, "value": v}
+                            for name, vals in series.items() for y, v in zip(years, vals)])
+    for w in (1, 3):
+        long_df[f"roll{w}"] = long_df["value"]
+    cube = build_cube(long_df)
+    index = similarity.build_similarity_index(cube, "Measles", (2012, 2019))
+
+    found = similarity.similar(index, "Up", k=3)
+    assert found["country"].tolist() == ["UpToo", "Down"], "Flat trends are never matched"
+    assert abs(found["similarity"].iloc[0] - 1) < 1e-4 and found["similarity"].iloc[1] < -0.99
+    assert similarity.similar(index, "Up", regions=["AFR"])["country"].tolist() == ["Down"]
+    assert similarity.similar(index, "Flat").empty
+
+    stats = similarity.comparison_stats(index, ["Down", "Up"]).set_index("Country")
+    for name in ["Down", "Up"]:
+        vals = long_df.loc[long_df["country"] == name, "value"]
+        expected = [vals.sum(), vals.mean(), vals.max(), vals.min(), vals.std()]
+        assert np.allclose(stats.loc[name].to_numpy(dtype=float), expected)
+
+def test_api_serves_filtered_aggregates_with_etags_and_gzip():
+    import gzip
+    import http.client
+    import threading
+    import json
+    raw = pd.DataFrame({"Region": np.repeat(["AFR", "EMR"], 60), "Country": np.repeat([f"C{i}" for i in range(12)], 10),
+                        "Year": np.tile(np.arange(2012, 2022), 12), "Measles_Cases": np.arange(120) * 10.0,
+                        "Rubella_Cases": 1.0, "Population": 1e6})
+    base_wide, base_long = normalize_and_transform(raw)
+    registry.get("api-test", lambda: (base_wide, base_long))
+    server = api.serve(["api-test"], port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    conn = http.client.HTTPConnection("127.0.0.1", server.server_address[1], timeout=10)
+    try:
+        def get(path, **headers):
+            conn.request("GET", path, headers=headers)
+            resp = conn.getresponse()
+            return resp, resp.read()
+
+        resp, body = get("/trend?region=AFR&year_min=2015&year_max=2017")
+        rows = json.loads(body)["rows"]
+        expected = apply_filters(build_long_index(base_long), "Measles", ["AFR"], (2015, 2017)).groupby("year")["value"].sum()
+        assert resp.status == 200 and [r["year"] for r in rows] == [2015, 2016, 2017]
+        assert np.allclose([r["value"] for r in rows], expected.to_numpy())
+
+        etag = resp.getheader("ETag")
+        resp, body = get("/trend?year_max=2017&region=AFR&year_min=2015", **{"If-None-Match": etag})
+        assert resp.status == 304 and body == b"", "Equivalent queries share the ETag"
+
+        resp, body = get("/trend?by=region", **{"Accept-Encoding": "gzip"})
+        assert resp.getheader("Content-Encoding") == "gzip" and json.loads(gzip.decompress(body))["by"] == ["region", "year"]
+        for refused in ["gzip;q=0", "identity", "*;q=0", "br, gzip; q=0.0"]:
+            resp, body = get("/trend?by=region", **{"Accept-Encoding": refused})
+            assert resp.getheader("Content-Encoding") is None and json.loads(body)["by"] == ["region", "year"], refused
+        assert get("/trend?by=region", **{"Accept-Encoding": "br;q=1, GZIP;q=0.5"})[0].getheader("Content-Encoding") == "gzip"
+        assert get("/rankings?top=3")[0].status == 200 and get("/country/C0")[0].status == 200
+        assert get("/country/Nowhere")[0].status == 404 and get("/trend?disease=Flu")[0].status == 400
+        assert get("/anomalies")[0].status == 200
+        assert ("api-test", 0.1, anomaly_core.DEFAULT_ENGINE) in api._scans, "Same default engine as the app"
+        for bad in ["/rankings?top=0", "/anomalies?top=-1", "/anomalies?contamination=2", "/anomalies?contamination=nan"]:
+            assert get(bad)[0].status == 400, bad
+    finally:
+        conn.close()
+        server.shutdown()
+        server.server_close()
+
 if __name__ == "__main__":
     # Simple manual runner: python test_app_utils.py
     try:
@@ -39,3 +449,8 @@ if __name__ == "__main__":
         print("test_normalize_and_transform_basic: PASSED")
     except AssertionError as e:
         print(f"test_normalize_and_transform_basic: FAILED - {e}")
+    try:
+        test_add_rolls_yoy_matches_groupby_apply()
+        print("test_add_rolls_yoy_matches_groupby_apply: PASSED")
+    except AssertionError as e:
+        print(f"test_add_rolls_yoy_matches_groupby_apply: FAILED - {e}")